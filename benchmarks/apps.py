@@ -0,0 +1,97 @@
+"""
+ASGI application used by the benchmark server, every scenario has its own path.
+"""
+import os
+
+SMALL_BODY = b"hello world"
+STREAM_CHUNK = b"x" * 16384
+STREAM_CHUNKS = 64
+
+broadcast_group = set()
+
+
+async def read_body(receive):
+    size = 0
+    while True:
+        message = await receive()
+        size += len(message.get("body", b""))
+        if not message.get("more_body"):
+            return size
+
+
+async def http_app(scope, receive, send):
+    path = scope["path"]
+    if path == "/upload":
+        size = await read_body(receive)
+        body = b"%i" % (size,)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [[b"content-length", b"%i" % (len(body),)]],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+        return
+
+    await read_body(receive)
+    if path == "/stream":
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        for _ in range(STREAM_CHUNKS):
+            await send(
+                {"type": "http.response.body", "body": STREAM_CHUNK, "more_body": True}
+            )
+        await send({"type": "http.response.body", "body": b""})
+    elif path == "/sendfile":
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    [b"x-sendfile", os.environ["BENCHMARK_SENDFILE"].encode("utf-8")]
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": b""})
+    else:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    [b"content-type", b"text/plain"],
+                    [b"content-length", b"%i" % (len(SMALL_BODY),)],
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": SMALL_BODY})
+
+
+async def websocket_app(scope, receive, send):
+    is_broadcast = scope["path"] == "/broadcast"
+    try:
+        while True:
+            message = await receive()
+            if message["type"] == "websocket.connect":
+                await send({"type": "websocket.accept"})
+                if is_broadcast:
+                    broadcast_group.add(send)
+            elif message["type"] == "websocket.receive":
+                reply = {"type": "websocket.send", "text": message.get("text")}
+
+                if is_broadcast:
+                    for member in list(broadcast_group):
+                        await member(reply)
+                else:
+                    await send(reply)
+            else:
+                break
+    finally:
+        broadcast_group.discard(send)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http":
+        await http_app(scope, receive, send)
+    elif scope["type"] == "websocket":
+        await websocket_app(scope, receive, send)
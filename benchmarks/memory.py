@@ -0,0 +1,129 @@
+"""
+Memory used per idle connection.
+
+Opens idle WebSocket connections and long-polling HTTP requests in-process,
+over string transports, and reports the bytes allocated per connection
+as traced by tracemalloc. The application only waits in receive(), so the
+numbers are the cost of txasgiresource, Twisted and autobahn themselves.
+
+    python -m benchmarks.memory
+    python -m benchmarks.memory --connections 20000 --output memory.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from twisted.internet import asyncioreactor  # isort:skip
+
+if "twisted.internet.reactor" not in sys.modules:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(loop)
+
+from twisted.internet.testing import StringTransport  # NOQA isort:skip
+from twisted.web import server  # NOQA isort:skip
+
+from txasgiresource import ASGIResource, __version__  # NOQA isort:skip
+
+
+async def idle_application(scope, receive, send):
+    if scope["type"] == "websocket":
+        await receive()
+        await send({"type": "websocket.accept"})
+    while True:
+        message = await receive()
+        if message["type"] in ("http.disconnect", "websocket.disconnect"):
+            return
+
+
+REQUESTS = {
+    "websocket": (
+        b"GET /ws HTTP/1.1\r\n"
+        b"Host: localhost\r\n"
+        b"Upgrade: websocket\r\n"
+        b"Connection: Upgrade\r\n"
+        b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+        b"Sec-WebSocket-Version: 13\r\n\r\n"
+    ),
+    "http": b"GET /poll HTTP/1.1\r\nHost: localhost\r\n\r\n",
+}
+
+
+def settle():
+    loop = asyncio.get_event_loop()
+    for _ in range(5):
+        loop.run_until_complete(asyncio.sleep(0))
+
+
+def measure(site, kind, count):
+    transports = []
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+
+    for _ in range(count):
+        channel = site.buildProtocol(None)
+        transport = StringTransport()
+        transport.protocol = channel
+        channel.makeConnection(transport)
+        channel.dataReceived(REQUESTS[kind])
+        transports.append(transport)
+    settle()
+    for transport in transports:
+        transport.clear()
+
+    gc.collect()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    allocated -= sys.getsizeof(transports)
+    return allocated / count, transports
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--output", help="store results as json in this file")
+    args = parser.parse_args()
+
+    resource = ASGIResource(idle_application)
+    site = server.Site(resource)
+    site.noisy = False
+
+    tracemalloc.start()
+    connections = []  # kept open until the end
+
+    # warm up caches and lazily imported modules before measuring
+    connections.append(measure(site, "websocket", 10)[1])
+    connections.append(measure(site, "http", 10)[1])
+
+    results = {}
+    for kind in ("websocket", "http"):
+        per_connection, transports = measure(site, kind, args.connections)
+        connections.append(transports)
+        results[kind] = {"bytes_per_connection": per_connection}
+        print("%-10s %10.0f bytes per idle connection" % (kind, per_connection))
+    tracemalloc.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "version": __version__,
+                    "python": platform.python_version(),
+                    "timestamp": int(time.time()),
+                    "connections": args.connections,
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
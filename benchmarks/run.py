@@ -0,0 +1,370 @@
+"""
+Request/response benchmark suite for ASGIResource.
+
+Starts the benchmark server in a subprocess and runs the registered scenarios
+against it over loopback, reporting req/s, p50/p99 latency and server RSS.
+
+    python -m benchmarks.run                      # all scenarios
+    python -m benchmarks.run small_get ws_echo    # selected scenarios
+    python -m benchmarks.run --output results/2.3.0.json
+    python -m benchmarks.run --compare results/2.2.1.json results/2.3.0.json
+
+X-Sendfile with and without sendfile(2):
+
+    python -m benchmarks.run x_sendfile --output zero-copy.json
+    python -m benchmarks.run x_sendfile --no-zero-copy-sendfile --output copy.json
+    python -m benchmarks.run --compare copy.json zero-copy.json
+
+More scenarios can be added by registering them with @scenario in a module
+passed with --module.
+"""
+import argparse
+import asyncio
+import base64
+import importlib
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from txasgiresource import __version__
+
+SENDFILE_SIZE = 1024 * 1024
+
+scenarios = {}
+
+
+def scenario(name, concurrency=50, requests=5000, **options):
+    """
+    Registers a scenario, `func(client, **options)` is called once for every
+    measured operation and must return when it is done.
+
+    HTTP scenarios get a keep-alive HTTPClient per concurrent worker, scenarios
+    with a `websocket` path get a connected WebSocketClient instead. With
+    `shared_clients` the function gets all the clients at once.
+    """
+
+    def decorator(func):
+        scenarios[name] = {
+            "func": func,
+            "concurrency": concurrency,
+            "requests": requests,
+            "options": options,
+        }
+        return func
+
+    return decorator
+
+
+class HTTPClient:
+    """
+    Minimal keep-alive HTTP/1.1 client, enough to talk to the benchmark server.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=b"", chunk_size=65536):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                "127.0.0.1", self.port
+            )
+
+        self.writer.write(
+            b"%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %i\r\n\r\n"
+            % (method, path, len(body))
+        )
+        for i in range(0, len(body), chunk_size):
+            self.writer.write(body[i : i + chunk_size])
+            await self.writer.drain()
+
+        status = int((await self.reader.readline()).split(b" ")[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line == b"\r\n":
+                break
+            name, value = line.split(b":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+        if b"content-length" in headers:
+            body = await self.reader.readexactly(int(headers[b"content-length"]))
+        elif headers.get(b"transfer-encoding") == b"chunked":
+            body = []
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                body.append(await self.reader.readexactly(size + 2))
+                if size == 0:
+                    break
+            body = b"".join(body)
+        else:
+            body = await self.reader.read()
+            self.close()
+
+        return status, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+class WebSocketClient:
+    """
+    Minimal WebSocket client, text frames only.
+    """
+
+    async def connect(self, port, path):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        key = base64.b64encode(os.urandom(16))
+        self.writer.write(
+            b"GET %s HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+            b"Connection: Upgrade\r\nSec-WebSocket-Key: %s\r\n"
+            b"Sec-WebSocket-Version: 13\r\n\r\n" % (path, key)
+        )
+        status = await self.reader.readuntil(b"\r\n\r\n")
+        if b" 101 " not in status.split(b"\r\n", 1)[0]:
+            raise Exception("Upgrade failed: %r" % (status,))
+
+    async def send(self, text):
+        payload = text.encode("utf-8")
+        mask = os.urandom(4)
+        if len(payload) < 126:
+            header = struct.pack("!BB", 0x81, 0x80 | len(payload))
+        else:
+            header = struct.pack("!BBH", 0x81, 0x80 | 126, len(payload))
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.writer.write(header + mask + masked)
+
+    async def receive(self):
+        _, length = await self.reader.readexactly(2)
+        if length == 126:
+            (length,) = struct.unpack("!H", await self.reader.readexactly(2))
+        elif length == 127:
+            (length,) = struct.unpack("!Q", await self.reader.readexactly(8))
+        return (await self.reader.readexactly(length)).decode("utf-8")
+
+    def close(self):
+        self.writer.close()
+
+
+@scenario("small_get", concurrency=50, requests=10000)
+async def small_get(client):
+    await client.request(b"GET", b"/small")
+
+
+@scenario("large_upload", concurrency=4, requests=100, size=8 * 1024 * 1024)
+async def large_upload(client, size):
+    status, body = await client.request(b"POST", b"/upload", b"u" * size)
+    assert int(body) == size
+
+
+@scenario("streaming_response", concurrency=10, requests=500)
+async def streaming_response(client):
+    await client.request(b"GET", b"/stream")
+
+
+@scenario("x_sendfile", concurrency=10, requests=1000)
+async def x_sendfile(client):
+    status, body = await client.request(b"GET", b"/sendfile")
+    assert len(body) == SENDFILE_SIZE
+
+
+@scenario("ws_echo", concurrency=200, requests=20000, websocket="/echo")
+async def ws_echo(client):
+    await client.send("ping")
+    await client.receive()
+
+
+@scenario(
+    "ws_broadcast",
+    concurrency=500,
+    requests=50,
+    websocket="/broadcast",
+    shared_clients=True,
+)
+async def ws_broadcast(clients):
+    """Measured from the broadcast until every connection got it."""
+    await clients[0].send("broadcast")
+    await asyncio.gather(*[client.receive() for client in clients])
+
+
+def get_rss_kb(pid):
+    with open("/proc/%i/status" % (pid,)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run_scenario(port, pid, name, definition):
+    func = definition["func"]
+    options = dict(definition["options"])
+    websocket_path = options.pop("websocket", None)
+    shared_clients = options.pop("shared_clients", False)
+
+    concurrency, total = definition["concurrency"], definition["requests"]
+    latencies = []
+
+    if websocket_path:
+        clients = []
+        for _ in range(concurrency):
+            client = WebSocketClient()
+            await client.connect(port, websocket_path.encode("ascii"))
+            clients.append(client)
+    else:
+        clients = [HTTPClient(port) for _ in range(concurrency)]
+
+    async def worker(client, count):
+        for _ in range(count):
+            start = time.perf_counter()
+            await func(client, **options)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if shared_clients:
+        await worker(clients, total)
+    else:
+        per_client = [total // concurrency] * concurrency
+        per_client[0] += total - sum(per_client)
+        await asyncio.gather(
+            *[worker(client, count) for client, count in zip(clients, per_client)]
+        )
+    elapsed = time.perf_counter() - start
+
+    rss_kb = get_rss_kb(pid)
+    for client in clients:
+        client.close()
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "rss_kb": rss_kb,
+    }
+
+
+def start_server(stream_request_body, zero_copy_sendfile):
+    cmd = [sys.executable, "-m", "benchmarks.server"]
+    if stream_request_body:
+        cmd.append("--stream-request-body")
+    if not zero_copy_sendfile:
+        cmd.append("--no-zero-copy-sendfile")
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    port = int(process.stdout.readline())
+    return process, port
+
+
+def print_results(results):
+    print(
+        "%-20s %10s %10s %10s %10s"
+        % ("scenario", "req/s", "p50 ms", "p99 ms", "rss MB")
+    )
+    for name, result in results.items():
+        print(
+            "%-20s %10.0f %10.2f %10.2f %10.1f"
+            % (
+                name,
+                result["rps"],
+                result["p50_ms"],
+                result["p99_ms"],
+                result["rss_kb"] / 1024.0,
+            )
+        )
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    print("%s -> %s" % (old["version"], new["version"]))
+    print("%-20s %-8s %10s %10s %8s" % ("scenario", "metric", "old", "new", "change"))
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        for metric in ["rps", "p50_ms", "p99_ms", "rss_kb"]:
+            old_value, new_value = old["results"][name][metric], result[metric]
+            change = (new_value - old_value) / old_value * 100 if old_value else 0
+            print(
+                "%-20s %-8s %10.2f %10.2f %+7.1f%%"
+                % (name, metric, old_value, new_value, change)
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run, default all")
+    parser.add_argument("--output", help="store results as json in this file")
+    parser.add_argument("--module", action="append", default=[])
+    parser.add_argument("--stream-request-body", action="store_true")
+    parser.add_argument("--no-zero-copy-sendfile", action="store_true")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    for module in args.module:
+        importlib.import_module(module)
+
+    selected = args.scenarios or list(scenarios)
+
+    with tempfile.NamedTemporaryFile(suffix=".bin") as sendfile:
+        sendfile.write(os.urandom(SENDFILE_SIZE))
+        sendfile.flush()
+        os.environ["BENCHMARK_SENDFILE"] = sendfile.name
+
+        process, port = start_server(
+            args.stream_request_body, not args.no_zero_copy_sendfile
+        )
+        try:
+            loop = asyncio.new_event_loop()
+            results = {}
+            for name in selected:
+                results[name] = loop.run_until_complete(
+                    run_scenario(port, process.pid, name, scenarios[name])
+                )
+        finally:
+            process.terminate()
+            process.wait()
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "version": __version__,
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "timestamp": int(time.time()),
+                    "options": {
+                        "stream_request_body": args.stream_request_body,
+                        "zero_copy_sendfile": not args.no_zero_copy_sendfile,
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Microbenchmark of the scope built by ASGIResource.render for every request.
+
+Compares the current single pass builder with the builder used up to 2.2.1,
+which decoded the path per segment, split the uri again and copied the scope
+in the protocol.
+
+    python -m benchmarks.scope
+"""
+import timeit
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from txasgiresource import ASGIResource
+
+HEADERS = [
+    (b"Host", b"example.com"),
+    (b"User-Agent", b"Mozilla/5.0 (X11; Linux x86_64; rv:81.0) Gecko/20100101"),
+    (b"Accept", b"text/html,application/xhtml+xml,application/xml;q=0.9"),
+    (b"Accept-Language", b"en-US,en;q=0.5"),
+    (b"Accept-Encoding", b"gzip, deflate, br"),
+    (b"Cookie", b"sessionid=abcdefghijklmnopqrstuvwxyz0123456789"),
+    (b"Connection", b"keep-alive"),
+    (b"Cache-Control", b"max-age=0"),
+]
+
+
+def make_request():
+    request = DummyRequest([b"api", b"v1", b"items", b"1234"])
+    request.uri = b"/api/v1/items/1234?page=2&sort=name"
+    request.clientproto = b"HTTP/1.1"
+    request.isSecure = lambda: False
+    for name, value in HEADERS:
+        request.requestHeaders.addRawHeader(name, value)
+    return request
+
+
+def legacy_build_scope(resource, request):
+    path = [b""] + request.postpath
+    path = "/".join(p.decode("utf-8") for p in path)
+
+    if b"?" in request.uri:
+        query_string = request.uri.split(b"?", 1)[1]
+    else:
+        query_string = ""
+
+    is_websocket = False
+    headers = []
+    for name, values in request.requestHeaders.getAllRawHeaders():
+        if b"_" in name:
+            continue
+
+        name = name.lower()
+        for value in values:
+            headers.append([name, value])
+            if name == b"upgrade" and value.lower() == b"websocket":
+                is_websocket = True
+
+    base_scope = {
+        "asgi": {"version": "3.0", "spec_version": "2.0"},
+        "path": path,
+        "raw_path": request.uri,
+        "query_string": query_string,
+        "root_path": resource.root_path,
+        "headers": headers,
+        "client": None,
+        "server": None,
+        "_ssl": request.isSecure() and "s" or "",
+    }
+
+    scope = dict(base_scope)
+    scope["type"] = "http"
+    scope["http_version"] = request.clientproto.decode("utf8").split("/")[1]
+    scope["scheme"] = "http%s" % (scope.pop("_ssl"))
+    scope["method"] = request.method.decode("utf8")
+    return is_websocket, scope
+
+
+def main(number=200000):
+    resource = ASGIResource(None)
+    resource.dispatch_http = lambda request, scope: scope
+    request = make_request()
+
+    results = {}
+    for name, func in [
+        ("legacy", lambda: legacy_build_scope(resource, request)),
+        ("current", lambda: resource.render(request)),
+    ]:
+        best = min(timeit.repeat(func, number=number, repeat=5))
+        results[name] = best / number * 1e6
+        print(
+            "%-8s %6.2f us/request  %9.0f scopes/s"
+            % (name, results[name], number / best)
+        )
+
+    print("saved    %6.2f us/request" % (results["legacy"] - results["current"],))
+    resource.ws_factory.stopFactory()
+
+
+if __name__ == "__main__":
+    main()
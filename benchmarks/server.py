@@ -0,0 +1,49 @@
+"""
+Benchmark server, ASGIResource with the benchmark application on a loopback port.
+
+Prints the port it listens on and serves until it is killed.
+"""
+import argparse
+import asyncio
+import sys
+
+from twisted.internet import asyncioreactor  # isort:skip
+
+if "twisted.internet.reactor" not in sys.modules:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(loop)
+
+from twisted.internet import reactor  # NOQA isort:skip
+from twisted.web import server  # NOQA isort:skip
+
+from txasgiresource import ASGIRequest, ASGIResource  # NOQA isort:skip
+
+from .apps import application  # NOQA isort:skip
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--stream-request-body", action="store_true")
+    parser.add_argument("--no-zero-copy-sendfile", action="store_true")
+    args = parser.parse_args()
+
+    resource = ASGIResource(
+        application,
+        use_x_sendfile=True,
+        use_zero_copy_sendfile=not args.no_zero_copy_sendfile,
+    )
+    if args.stream_request_body:
+        site = server.Site(resource, requestFactory=ASGIRequest)
+    else:
+        site = server.Site(resource)
+    site.noisy = False
+
+    port = reactor.listenTCP(args.port, site, interface="127.0.0.1")
+    print(port.getHost().port, flush=True)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
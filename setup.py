@@ -24,6 +24,9 @@ setup(
         'autobahn>=0.12',
         'asgiref>=2.3.2'
     ],
+    extras_require={
+        'http2': ['twisted[http2]'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
@@ -9,6 +9,7 @@ if "twisted.internet.reactor" not in sys.modules:
     asyncioreactor.install(loop)
 
 import importlib
+import os
 
 
 from zope.interface import implementer
@@ -17,11 +18,38 @@ from twisted.application.service import IServiceMaker, MultiService, Service
 from twisted.internet import defer, endpoints, reactor, threads
 from twisted.plugin import IPlugin
 from twisted.python import usage
-from twisted.web import server
-from txasgiresource import ASGIResource
+from twisted.web import http, server
+from txasgiresource import ASGIRequest, ASGIResource
+from txasgiresource.offload import ProcessWorkerPool
+from txasgiresource.workers import WorkerSupervisor
 
 
 class Options(usage.Options):
+    optFlags = [
+        [
+            "stream_request_body",
+            "s",
+            "Send the request body to the application while it is being received",
+        ],
+        ["compression", "c", "Compress responses for clients that accept it"],
+        ["http2", "2", "Offer HTTP/2 to TLS clients, requires twisted[http2]"],
+        ["watchdog_stacks", None, "Log the stack when the watchdog reports"],
+        [
+            "websocket_compression",
+            None,
+            "Accept permessage-deflate WebSocket compression offered by clients",
+        ],
+        [
+            "websocket_no_context_takeover",
+            None,
+            "Reset the WebSocket compressor after every message to save memory",
+        ],
+        [
+            "websocket_no_utf8_validate",
+            None,
+            "Do not validate incoming WebSocket text messages as UTF-8",
+        ],
+    ]
 
     optParameters = [
         ["application", "a", None, "Application"],
@@ -37,21 +65,175 @@ class Options(usage.Options):
             False,
             "Parse proxy header and use them to replace client ip",
         ],
+        [
+            "workers",
+            "w",
+            1,
+            "Number of worker processes sharing the listening socket",
+            int,
+        ],
+        [
+            "watchdog",
+            None,
+            None,
+            "Report when the event loop is blocked for more than this many seconds",
+            float,
+        ],
+        [
+            "offload",
+            None,
+            None,
+            "Run application instances in this many separate worker processes",
+            int,
+        ],
+        [
+            "offload_paths",
+            None,
+            None,
+            "Comma separated path prefixes to run in the offload workers, default all",
+        ],
+        [
+            "websocket_window_bits",
+            None,
+            15,
+            "WebSocket compression window bits (9-15) for both directions",
+            int,
+        ],
+        [
+            "websocket_max_message_size",
+            None,
+            0,
+            "Fail WebSocket connections sending larger messages, 0 is unlimited",
+            int,
+        ],
+        [
+            "websocket_max_frame_size",
+            None,
+            0,
+            "Fail WebSocket connections sending larger frames, 0 is unlimited",
+            int,
+        ],
+        [
+            "websocket_auto_fragment_size",
+            None,
+            0,
+            "Split outgoing WebSocket messages in frames of this size, 0 is disabled",
+            int,
+        ],
+        [
+            "websocket_handshake_timeout",
+            None,
+            5,
+            "Seconds a WebSocket client has to complete the opening handshake",
+            float,
+        ],
+        [
+            "drain_timeout",
+            None,
+            None,
+            "On shutdown stop listening and give running requests and WebSockets "
+            "this many seconds to finish",
+            float,
+        ],
+        [
+            "max_http_instances",
+            None,
+            None,
+            "Answer HTTP requests with 503 while this many are running",
+            int,
+        ],
+        [
+            "max_websocket_instances",
+            None,
+            None,
+            "Refuse WebSockets with 503 while this many are open",
+            int,
+        ],
+        [
+            "admission_queue_size",
+            None,
+            0,
+            "HTTP requests over --max_http_instances that wait for a slot",
+            int,
+        ],
+        # used by the supervisor when starting workers
+        ["inherited_fd", None, None, "Listening socket inherited from supervisor", int],
+        ["address_family", None, None, "Address family of inherited socket", int],
     ]
 
+    def postOptions(self):
+        if self["http2"] and not http.H2_ENABLED:
+            raise usage.UsageError("HTTP/2 requires the h2 module, see twisted[http2]")
+        if not 9 <= self["websocket_window_bits"] <= 15:
+            raise usage.UsageError("--websocket_window_bits must be between 9 and 15")
+        if self["workers"] > 1:
+            # workers adopt the bare listening socket, TLS would be lost
+            if self["description"].split(":", 1)[0].strip().lower() != "tcp":
+                raise usage.UsageError(
+                    "--workers only supports plain tcp: descriptions, "
+                    "terminate TLS in front of the workers instead"
+                )
+            if self["http2"]:
+                raise usage.UsageError(
+                    "--http2 needs TLS, which is not supported with --workers"
+                )
+
+
+class ASGISite(server.Site):
+    """
+    Site that only offers HTTP/2 with ALPN when enabled.
+    """
+
+    http2 = False
+
+    def acceptableProtocols(self):
+        protocols = server.Site.acceptableProtocols(self)
+        if not self.http2:
+            protocols = [protocol for protocol in protocols if protocol != b"h2"]
+        return protocols
+
 
 class ASGIService(Service):
-    def __init__(self, resource, description):
+    port = None
+
+    def __init__(
+        self,
+        resource,
+        description,
+        request_factory=server.Request,
+        inherited_fd=None,
+        address_family=None,
+        http2=False,
+    ):
         self.resource = resource
+        self.http2 = http2
         self.description = description
+        self.request_factory = request_factory
+        self.inherited_fd = inherited_fd
+        self.address_family = address_family
 
     @defer.inlineCallbacks
     def startService(self):
-        self.endpoint = yield endpoints.serverFromString(reactor, self.description)
-        self.endpoint.listen(server.Site(self.resource))
+        # the application must be ready before we accept connections
+        yield self.resource.start()
+
+        site = ASGISite(self.resource, requestFactory=self.request_factory)
+        site.http2 = self.http2
+        if self.inherited_fd is not None:
+            self.port = reactor.adoptStreamPort(
+                self.inherited_fd, self.address_family, site
+            )
+        else:
+            self.endpoint = yield endpoints.serverFromString(reactor, self.description)
+            self.port = yield self.endpoint.listen(site)
 
+    @defer.inlineCallbacks
     def stopService(self):
-        self.resource.stop()
+        # no new connections while running instances are drained
+        port, self.port = self.port, None
+        if port is not None:
+            yield port.stopListening()
+        yield self.resource.stop()
 
 
 @implementer(IServiceMaker, IPlugin)
@@ -63,15 +245,111 @@ class ServiceMaker(object):
     def makeService(self, options):
         asyncio.set_event_loop(reactor._asyncioEventloop)
 
+        if options["inherited_fd"] is not None:
+            # a worker, signals sent to the group of the supervisor are
+            # forwarded by it and must not reach the worker a second time
+            os.setpgid(0, 0)
+
+        if options["workers"] > 1:
+            return WorkerSupervisor(
+                options["description"],
+                options["workers"],
+                self.get_worker_args(options),
+            )
+
         module, function = options["application"].split(":")
         application = getattr(importlib.import_module(module), function)
 
         ms = MultiService()
 
-        resource = ASGIResource(application, use_proxy_headers=options["proxy_headers"])
-        ms.addService(ASGIService(resource, options["description"]))
+        offload_pool, offload_paths = None, None
+        if options["offload"]:
+            offload_pool = ProcessWorkerPool(options["application"], options["offload"])
+            if options["offload_paths"]:
+                offload_paths = options["offload_paths"].split(",")
+
+        resource = ASGIResource(
+            application,
+            offload_pool=offload_pool,
+            offload_paths=offload_paths,
+            use_proxy_headers=options["proxy_headers"],
+            use_compression=options["compression"],
+            watchdog_threshold=options["watchdog"],
+            watchdog_sample_stacks=options["watchdog_stacks"],
+            drain_timeout=options["drain_timeout"],
+            websocket_compression=options["websocket_compression"],
+            websocket_compression_window_bits=options["websocket_window_bits"],
+            websocket_compression_client_window_bits=options["websocket_window_bits"],
+            websocket_compression_no_context_takeover=options[
+                "websocket_no_context_takeover"
+            ],
+            websocket_max_message_size=options["websocket_max_message_size"],
+            websocket_max_frame_size=options["websocket_max_frame_size"],
+            websocket_auto_fragment_size=options["websocket_auto_fragment_size"],
+            websocket_utf8_validate=not options["websocket_no_utf8_validate"],
+            websocket_handshake_timeout=options["websocket_handshake_timeout"],
+            max_http_instances=options["max_http_instances"],
+            max_websocket_instances=options["max_websocket_instances"],
+            admission_queue_size=options["admission_queue_size"],
+        )
+        if options["stream_request_body"]:
+            request_factory = ASGIRequest
+        else:
+            request_factory = server.Request
+
+        ms.addService(
+            ASGIService(
+                resource,
+                options["description"],
+                request_factory,
+                inherited_fd=options["inherited_fd"],
+                address_family=options["address_family"],
+                http2=options["http2"],
+            )
+        )
 
         return ms
 
+    def get_worker_args(self, options):
+        args = ["-m", "twisted", self.tapname, "-a", options["application"]]
+        if options["proxy_headers"]:
+            args += ["-p", options["proxy_headers"]]
+        if options["stream_request_body"]:
+            args.append("--stream_request_body")
+        if options["compression"]:
+            args.append("--compression")
+        if options["http2"]:
+            args.append("--http2")
+        if options["watchdog"]:
+            args += ["--watchdog", str(options["watchdog"])]
+        if options["watchdog_stacks"]:
+            args.append("--watchdog_stacks")
+        if options["offload"]:
+            args += ["--offload", str(options["offload"])]
+        if options["offload_paths"]:
+            args += ["--offload_paths", options["offload_paths"]]
+        if options["drain_timeout"]:
+            args += ["--drain_timeout", str(options["drain_timeout"])]
+        for name in ("max_http_instances", "max_websocket_instances"):
+            if options[name]:
+                args += ["--%s" % (name,), str(options[name])]
+        for flag in (
+            "websocket_compression",
+            "websocket_no_context_takeover",
+            "websocket_no_utf8_validate",
+        ):
+            if options[flag]:
+                args.append("--%s" % (flag,))
+        for name in (
+            "websocket_window_bits",
+            "websocket_max_message_size",
+            "websocket_max_frame_size",
+            "websocket_auto_fragment_size",
+            "websocket_handshake_timeout",
+            "admission_queue_size",
+        ):
+            args += ["--%s" % (name,), str(options[name])]
+        return args
+
 
 txasgi = ServiceMaker()
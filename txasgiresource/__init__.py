@@ -1,11 +1,13 @@
 import sys
 
-from .asgiresource import ASGIResource  # NOQA
-
 from twisted.internet import asyncioreactor  # isort:skip
 
+# must be installed before the modules below import the reactor
 if "twisted.internet.reactor" not in sys.modules:
     asyncioreactor.install()
 
+from .asgiresource import ASGIResource  # NOQA isort:skip
+from .http import ASGIRequest  # NOQA isort:skip
+
 
 __version__ = "2.2.1"
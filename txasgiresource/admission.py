@@ -0,0 +1,174 @@
+import logging
+from collections import Counter, deque
+
+from twisted.internet import defer, reactor
+
+from .utils import send_error_page
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when an application instance cannot be started because its
+    budget is used up and it cannot wait for a slot.
+    """
+
+
+class AdmissionControl:
+    """
+    Limits the number of application instances running at once.
+
+    HTTP and WebSocket have separate budgets: a global limit per scope type
+    and limits per path prefix, the longest matching prefix applies. An
+    instance needs a free slot in every budget that applies to it.
+
+    HTTP requests over the limit wait in a queue of `queue_size` for up to
+    `queue_timeout` seconds, WebSockets are long-lived and are refused right
+    away. Refused requests are answered with 503 and a Retry-After of
+    `retry_after` seconds.
+    """
+
+    clock = reactor
+
+    def __init__(
+        self,
+        http_limit=None,
+        websocket_limit=None,
+        http_route_limits=None,
+        websocket_route_limits=None,
+        queue_size=0,
+        queue_timeout=5,
+        retry_after=1,
+    ):
+        self.limits = {}
+        if http_limit:
+            self.limits[("http", None)] = http_limit
+        if websocket_limit:
+            self.limits[("websocket", None)] = websocket_limit
+
+        self.prefixes = {}
+        for scope_type, route_limits in (
+            ("http", http_route_limits),
+            ("websocket", websocket_route_limits),
+        ):
+            route_limits = route_limits or {}
+            for prefix, limit in route_limits.items():
+                self.limits[(scope_type, prefix)] = limit
+            # longest prefix first so the first match is the most specific
+            self.prefixes[scope_type] = sorted(route_limits, key=len, reverse=True)
+
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = Counter()
+        self.waiters = deque()
+        self.rejected = Counter()
+
+    def budgets(self, scope_type, path):
+        """
+        Returns the keys of the budgets an instance of scope_type for path
+        needs a slot in.
+        """
+        keys = []
+        if (scope_type, None) in self.limits:
+            keys.append((scope_type, None))
+        for prefix in self.prefixes.get(scope_type, ()):
+            if path.startswith(prefix):
+                keys.append((scope_type, prefix))
+                break
+        return keys
+
+    def has_room(self, keys):
+        return all(self.active[key] < self.limits[key] for key in keys)
+
+    def can_wait(self, scope_type):
+        return scope_type == "http" and len(self.waiters) < self.queue_size
+
+    def check(self, scope_type, path):
+        """
+        Returns True if an instance can be started now or wait for a slot,
+        counts a rejection otherwise.
+        """
+        if self.has_room(self.budgets(scope_type, path)) or self.can_wait(scope_type):
+            return True
+
+        self.rejected[scope_type] += 1
+        return False
+
+    def acquire(self, scope_type, path):
+        """
+        Takes a slot in every budget for the instance.
+
+        Returns the budget keys to release when the instance is done, or a
+        Deferred firing with them when the request has to wait. Raises
+        AdmissionRejected when there is no room to wait either.
+        """
+        keys = self.budgets(scope_type, path)
+        if self.has_room(keys):
+            self.take(keys)
+            return keys
+
+        if not self.can_wait(scope_type):
+            self.rejected[scope_type] += 1
+            raise AdmissionRejected()
+
+        d = defer.Deferred(self.cancel_waiter)
+        timeout_call = self.clock.callLater(
+            self.queue_timeout, self.waiter_timed_out, d
+        )
+        self.waiters.append((keys, d, timeout_call))
+        return d
+
+    def take(self, keys):
+        for key in keys:
+            self.active[key] += 1
+
+    def release(self, keys):
+        for key in keys:
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+
+        # waiters for other routes can go ahead of one still waiting for room
+        for waiter in list(self.waiters):
+            if self.has_room(waiter[0]) and self.remove_waiter(waiter[1]):
+                self.take(waiter[0])
+                waiter[1].callback(waiter[0])
+
+    def remove_waiter(self, d):
+        for waiter in self.waiters:
+            if waiter[1] is d:
+                self.waiters.remove(waiter)
+                if waiter[2].active():
+                    waiter[2].cancel()
+                return True
+        return False
+
+    def cancel_waiter(self, d):
+        self.remove_waiter(d)
+
+    def waiter_timed_out(self, d):
+        if self.remove_waiter(d):
+            self.rejected["http"] += 1
+            logger.debug("Request timed out waiting for admission")
+            d.errback(AdmissionRejected())
+
+    def stats(self):
+        """
+        Returns the number of rejected instances keyed by scope type labels.
+        """
+        return {
+            (("type", scope_type),): rejected
+            for scope_type, rejected in self.rejected.items()
+        }
+
+
+def send_overloaded(request, retry_after):
+    """
+    Answers request with 503 and Retry-After.
+    """
+    request.setHeader(b"retry-after", str(int(retry_after)).encode("ascii"))
+    send_error_page(
+        request, 503, "Service Unavailable", "The server is too busy, try again later"
+    )
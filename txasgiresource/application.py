@@ -1,37 +1,339 @@
 import asyncio
-from concurrent.futures import CancelledError
+import functools
+import logging
+from collections import Counter, deque
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
+
+from .lifespan import Lifespan
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_LIMIT = 16
+
+SERVICE_RESTART = 1012  # WebSocket close code
+
+
+class ApplicationQueue:
+    """
+    Queue of messages waiting to be received by an application instance.
+
+    Messages are never refused as the protocol has already read them from
+    the transport, instead the protocol can pause a producer when the queue
+    is full and it is resumed again when the application has made room.
+
+    Most connections are idle most of the time, so unlike asyncio.Queue
+    the buffers are only allocated while something is waiting in them.
+    """
+
+    __slots__ = (
+        "limit",
+        "on_limit_hit",
+        "scope_type",
+        "paused_producer",
+        "items",
+        "getters",
+    )
+
+    def __init__(self, limit=DEFAULT_QUEUE_LIMIT, on_limit_hit=None, scope_type=None):
+        self.limit = limit
+        self.on_limit_hit = on_limit_hit  # called with scope_type
+        self.scope_type = scope_type
+        self.paused_producer = None
+        self.items = None
+        self.getters = None
+
+    def qsize(self):
+        return len(self.items) if self.items else 0
+
+    def empty(self):
+        return not self.items
+
+    def is_full(self):
+        return self.limit > 0 and self.qsize() >= self.limit
+
+    def pause_producer(self, producer):
+        if self.paused_producer is None:
+            self.paused_producer = producer
+            producer.pauseProducing()
+            if self.on_limit_hit is not None:
+                self.on_limit_hit(self.scope_type)
+
+    def put_nowait(self, item):
+        if self.items is None:
+            self.items = deque()
+        self.items.append(item)
+        self._wakeup_next()
+
+    def get_nowait(self):
+        if not self.items:
+            raise asyncio.QueueEmpty()
+
+        item = self.items.popleft()
+        if not self.items:
+            self.items = None
+
+        if self.paused_producer is not None and not self.is_full():
+            producer, self.paused_producer = self.paused_producer, None
+            producer.resumeProducing()
+        return item
+
+    async def get(self):
+        while not self.items:
+            getter = asyncio.get_event_loop().create_future()
+            if self.getters is None:
+                self.getters = []
+            self.getters.append(getter)
+            try:
+                await getter
+            except BaseException:
+                getter.cancel()
+                if self.getters is not None and getter in self.getters:
+                    self.getters.remove(getter)
+                if self.items and not getter.cancelled():
+                    self._wakeup_next()
+                raise
+        return self.get_nowait()
+
+    def _wakeup_next(self):
+        getters = self.getters
+        while getters:
+            getter = getters.pop(0)
+            if not getter.done():
+                getter.set_result(None)
+                break
+        if not getters:
+            self.getters = None
 
 
 class ApplicationManager:
-    def __init__(self, application):
+    """
+    Runs the application instances of all protocols.
+
+    With a `drain_timeout` stop() drains first: no new instances are
+    accepted, WebSockets are closed with code 1012 in batches of
+    `close_batch_size` every `close_batch_interval` seconds and running
+    instances get until the timeout to finish before they are cancelled.
+
+    With `admission` (an AdmissionControl) instances only start when there
+    is room in their budgets, see create_application_instance().
+    """
+
+    clock = reactor
+    draining = False
+
+    def __init__(
+        self,
+        application,
+        queue_limits=None,
+        metrics=None,
+        offload_pool=None,
+        offload_paths=None,
+        drain_timeout=None,
+        close_batch_size=100,
+        close_batch_interval=0.1,
+        admission=None,
+    ):
         self.application = application
+        self.admission = admission
+        self.admitted = {}  # protocol: budget keys to release
+        self.drain_timeout = drain_timeout
+        self.close_batch_size = close_batch_size
+        self.close_batch_interval = close_batch_interval
+        self.offload_pool = offload_pool
+        self.offload_paths = offload_paths and tuple(offload_paths)
         self.application_instances = {}
+        self.application_queues = {}
+        self.queue_limits = queue_limits or {}
+        self.queue_limit_hits = Counter()
+        self.lifespan = None
+        self.state = None
+
+        self.metrics = metrics
+        if metrics is not None and hasattr(metrics, "register_gauge"):
+            metrics.register_gauge(
+                "txasgi_active_instances", lambda: self.instance_stats()[0]
+            )
+            metrics.register_gauge(
+                "txasgi_queued_messages", lambda: self.instance_stats()[1]
+            )
+            metrics.register_gauge(
+                "txasgi_queue_limit_hits_total",
+                lambda: {
+                    (("type", scope_type),): hits
+                    for scope_type, hits in self.queue_limit_hits.items()
+                },
+            )
+            if admission is not None:
+                metrics.register_gauge(
+                    "txasgi_admission_rejected_total", admission.stats
+                )
+
+    @defer.inlineCallbacks
+    def start(self):
+        self.lifespan = Lifespan(self)
+        yield self.lifespan.startup()
+        if self.lifespan.supported:
+            self.state = self.lifespan.state
 
     @defer.inlineCallbacks
     def stop(self):
+        if self.drain_timeout:
+            yield self.drain(self.drain_timeout)
+
         wait_for = []
         for protocol in list(self.application_instances.keys()):
+            if protocol is self.lifespan:
+                continue
+
             promise = protocol.do_cleanup()
             if promise:
-                wait_for.append(promise)
+                wait_for.append(defer.Deferred.fromFuture(promise))
+
+        yield defer.DeferredList(wait_for, consumeErrors=True)
+
+        if self.lifespan is not None:
+            yield self.lifespan.shutdown()
+            self.lifespan = None
+
+        if self.offload_pool is not None:
+            yield self.offload_pool.stop()
+
+    @defer.inlineCallbacks
+    def drain(self, timeout):
+        """
+        Waits up to timeout seconds for the running instances to finish,
+        closing WebSockets along the way. Returns True if all finished.
+        """
+        self.draining = True
+
+        instances = [
+            defer.Deferred.fromFuture(instance)
+            for protocol, instance in self.application_instances.items()
+            if protocol is not self.lifespan
+        ]
+        logger.info("Draining %s application instances" % (len(instances),))
+
+        finished = defer.Deferred()
+
+        def instances_done(result):
+            if not finished.called:
+                finished.callback(True)
+
+        def timed_out():
+            if not finished.called:
+                finished.callback(False)
+
+        defer.DeferredList(instances, consumeErrors=True).addCallback(instances_done)
+        timeout_call = self.clock.callLater(timeout, timed_out)
+        closing = self.close_websockets()
+        closing.addErrback(lambda f: f.trap(defer.CancelledError))
 
-        for d in wait_for:
-            yield defer.Deferred.fromFuture(d)
+        all_finished = yield finished
+        closing.cancel()
+        if timeout_call.active():
+            timeout_call.cancel()
+
+        if not all_finished:
+            logger.warning(
+                "Drain timeout, cancelling %s application instances"
+                % (len(self.application_instances) - (self.lifespan is not None),)
+            )
+        defer.returnValue(all_finished)
+
+    @defer.inlineCallbacks
+    def close_websockets(self):
+        websockets = [
+            protocol
+            for protocol, queue in self.application_queues.items()
+            if queue.scope_type == "websocket"
+        ]
+        for i in range(0, len(websockets), self.close_batch_size):
+            if i:
+                yield task.deferLater(self.clock, self.close_batch_interval)
+            for protocol in websockets[i : i + self.close_batch_size]:
+                if protocol in self.application_queues:
+                    protocol.close_connection(SERVICE_RESTART)
+
+    def should_offload(self, scope):
+        """
+        Returns True if the instance for scope runs in the offload pool,
+        lifespan always runs on the reactor loop.
+        """
+        if self.offload_pool is None or scope["type"] == "lifespan":
+            return False
+        return self.offload_paths is None or scope["path"].startswith(
+            self.offload_paths
+        )
+
+    @staticmethod
+    async def dispatch_reply(protocol, msg):
+        """
+        The send() of every application instance, shared instead of a closure
+        per instance.
+        """
+        d = protocol.handle_reply(msg)
+        if d is not None:  # protocol wants the application to wait
+            await d.asFuture(asyncio.get_event_loop())
 
     def create_application_instance(self, protocol, scope):
-        async def handle_reply(msg):
-            protocol.handle_reply(msg)
+        """
+        Starts an application instance for protocol and returns its queue.
+
+        With admission control it can instead return a Deferred firing with
+        the queue once the instance is admitted, or raise AdmissionRejected.
+        """
+        if self.admission is not None and scope["type"] != "lifespan":
+            keys = self.admission.acquire(scope["type"], scope["path"])
+            if isinstance(keys, defer.Deferred):
+                return keys.addCallback(self.start_admitted, protocol, scope)
+            return self.start_admitted(keys, protocol, scope)
 
-        queue = asyncio.Queue()
+        return self.start_instance(protocol, scope)
 
-        self.application_instances[protocol] = asyncio.ensure_future(
-            self.application(scope=scope, receive=queue.get, send=handle_reply)
+    def start_admitted(self, keys, protocol, scope):
+        if keys:
+            self.admitted[protocol] = keys
+        return self.start_instance(protocol, scope)
+
+    def start_instance(self, protocol, scope):
+        handle_reply = functools.partial(self.dispatch_reply, protocol)
+
+        scope_type = scope["type"]
+        queue = ApplicationQueue(
+            self.queue_limits.get(scope_type, DEFAULT_QUEUE_LIMIT),
+            self.queue_limit_hit,
+            scope_type,
         )
+        self.application_queues[protocol] = queue
+
+        if self.should_offload(scope):
+            instance = self.offload_pool.run(
+                self.application, scope, queue.get, handle_reply
+            )
+        else:
+            instance = self.application(
+                scope=scope, receive=queue.get, send=handle_reply
+            )
+        self.application_instances[protocol] = asyncio.ensure_future(instance)
 
         return queue
 
+    def queue_limit_hit(self, scope_type):
+        self.queue_limit_hits[scope_type] += 1
+
+    def instance_stats(self):
+        """
+        Returns the number of running instances and the number of messages
+        waiting in their queues, both keyed by scope type labels.
+        """
+        instances, queued = {}, {}
+        for queue in self.application_queues.values():
+            labels = (("type", queue.scope_type),)
+            instances[labels] = instances.get(labels, 0) + 1
+            queued[labels] = queued.get(labels, 0) + queue.qsize()
+        return instances, queued
+
     def finish_protocol(self, protocol):
         wait_for = None
         if protocol in self.application_instances:
@@ -41,7 +343,7 @@ class ApplicationManager:
                     def handle_cancel_exception(f):
                         try:
                             f.exception()
-                        except CancelledError:
+                        except asyncio.CancelledError:
                             pass
 
                     self.application_instances[protocol].add_done_callback(
@@ -50,4 +352,9 @@ class ApplicationManager:
                     self.application_instances[protocol].cancel()
                 wait_for = self.application_instances[protocol]
             del self.application_instances[protocol]
+        self.application_queues.pop(protocol, None)
+
+        keys = self.admitted.pop(protocol, None)
+        if keys is not None:
+            self.admission.release(keys)
         return wait_for
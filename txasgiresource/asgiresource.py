@@ -2,16 +2,54 @@ import ipaddress
 import logging
 
 from asgiref.compatibility import guarantee_single_callable
-from autobahn.twisted.resource import WebSocketResource
 
 from twisted.web import resource, server
 
-from .application import ApplicationManager
+from .admission import AdmissionControl, send_overloaded
+from .application import DEFAULT_QUEUE_LIMIT, ApplicationManager
+from .cache import DEFAULT_MAX_ENTRY_SIZE, ResponseCache
+from .compression import ResponseCompression
 from .http import ASGIHTTPResource
-from .ws import ASGIWebSocketServerFactory
+from .sendfile import SendfileCache
+from .singleflight import SingleFlight
+from .utils import ASGI_VERSION, send_error_page
+from .watchdog import LoopWatchdog
+from .ws import ASGIWebSocketResource, ASGIWebSocketServerFactory, DeflateAccept
 
 logger = logging.getLogger(__name__)
 
+HTTP_VERSIONS = {b"HTTP/1.0": "1.0", b"HTTP/1.1": "1.1", b"HTTP/2": "2"}
+
+# response extensions advertised in HTTP scopes, trailers need a chunked response
+HTTP_EXTENSIONS = {
+    "http.response.zerocopysend": {},
+    "http.response.pathsend": {},
+}
+HTTP11_EXTENSIONS = dict(HTTP_EXTENSIONS, **{"http.response.trailers": {}})
+WEBSOCKET_EXTENSIONS = {"websocket.broadcast": {}}
+
+MAXIMUM_HEADER_NAME_CACHE = 1024
+
+# maps raw header names to the lowercased name passed on, or None if it is dropped
+header_name_cache = {}
+
+
+def get_header_name(name):
+    try:
+        return header_name_cache[name]
+    except KeyError:
+        pass
+
+    if b"_" in name:  # Prevent CVE-2015-0219
+        lowered = None
+    else:
+        lowered = name.lower()
+
+    if len(header_name_cache) < MAXIMUM_HEADER_NAME_CACHE:
+        header_name_cache[name] = lowered
+
+    return lowered
+
 
 class ASGIResource(resource.Resource):
     isLeaf = True
@@ -25,13 +63,80 @@ class ASGIResource(resource.Resource):
         ping_interval=20,
         ping_timeout=30,
         ws_protocols=None,
+        websocket_compression=False,  # accept permessage-deflate offered by clients
+        websocket_compression_window_bits=15,  # 9-15, for messages we send
+        websocket_compression_client_window_bits=15,  # requested from clients
+        websocket_compression_no_context_takeover=False,
+        websocket_max_message_size=0,  # 0 is unlimited, larger messages fail the connection
+        websocket_max_frame_size=0,
+        websocket_auto_fragment_size=0,  # split outgoing messages in frames of this size
+        websocket_utf8_validate=True,
+        websocket_handshake_timeout=5,
+        broadcast_max_buffer_size=1024 * 1024,  # skip slower group members, 0 never skips
         use_proxy_headers=False,
         use_proxy_proto_header=False,
         automatic_proxy_header_handling=False,  # ignores use_proxy_headers and use_proxy_proto_header
         use_x_sendfile=False,
+        use_zero_copy_sendfile=True,  # sendfile(2) for X-Sendfile over plain TCP
+        use_compression=False,
+        compression_level=6,
+        compression_minimum_size=500,
+        compression_thread_size=256 * 1024,  # None compresses in the reactor thread
+        watchdog_threshold=None,  # report when the event loop is blocked this long
+        watchdog_sample_stacks=False,
+        offload_pool=None,  # offload.ThreadWorkerPool or offload.ProcessWorkerPool
+        offload_paths=None,  # path prefixes to offload, all when None
+        metrics=None,  # e.g. metrics.Metrics(), served with metrics.MetricsResource
+        stream_request_body=True,  # only has an effect when the site uses ASGIRequest
+        drain_timeout=None,  # seconds stop() lets running instances finish
+        websocket_close_batch_size=100,  # WebSockets closed at a time when draining
+        websocket_close_batch_interval=0.1,
+        http_queue_limit=DEFAULT_QUEUE_LIMIT,  # 0 is unbounded
+        websocket_queue_limit=DEFAULT_QUEUE_LIMIT,
+        max_http_instances=None,  # concurrent instances, None is unlimited
+        max_websocket_instances=None,
+        http_route_limits=None,  # {path prefix: max instances}
+        websocket_route_limits=None,
+        admission_queue_size=0,  # HTTP requests waiting for a slot, more get 503
+        admission_queue_timeout=5,
+        retry_after=1,  # seconds, sent with 503 when over the limits
+        response_cache_size=None,  # bytes of public GET responses to cache, None disables
+        response_cache_max_entry_size=DEFAULT_MAX_ENTRY_SIZE,
+        single_flight_paths=None,  # path prefixes where identical GETs share an instance
     ):
+        if (
+            max_http_instances
+            or max_websocket_instances
+            or http_route_limits
+            or websocket_route_limits
+        ):
+            admission = AdmissionControl(
+                http_limit=max_http_instances,
+                websocket_limit=max_websocket_instances,
+                http_route_limits=http_route_limits,
+                websocket_route_limits=websocket_route_limits,
+                queue_size=admission_queue_size,
+                queue_timeout=admission_queue_timeout,
+                retry_after=retry_after,
+            )
+        else:
+            admission = None
 
-        self.application = ApplicationManager(guarantee_single_callable(application))
+        self.application = ApplicationManager(
+            guarantee_single_callable(application),
+            queue_limits={"http": http_queue_limit, "websocket": websocket_queue_limit},
+            metrics=metrics,
+            offload_pool=offload_pool,
+            offload_paths=offload_paths,
+            drain_timeout=drain_timeout,
+            close_batch_size=websocket_close_batch_size,
+            close_batch_interval=websocket_close_batch_interval,
+            admission=admission,
+        )
+        self.metrics = metrics
+        self.watchdog_threshold = watchdog_threshold
+        self.watchdog_sample_stacks = watchdog_sample_stacks
+        self.watchdog = None
         self.root_path = root_path
 
         self.http_timeout = http_timeout
@@ -43,58 +148,135 @@ class ASGIResource(resource.Resource):
         self.use_proxy_proto_header = use_proxy_proto_header
         self.automatic_proxy_header_handling = automatic_proxy_header_handling
         self.use_x_sendfile = use_x_sendfile
+        if use_x_sendfile:
+            self.sendfile_cache = SendfileCache(zero_copy=use_zero_copy_sendfile)
+        else:
+            self.sendfile_cache = None
+        if use_compression:
+            self.compression = ResponseCompression(
+                level=compression_level,
+                minimum_size=compression_minimum_size,
+                thread_size=compression_thread_size,
+            )
+        else:
+            self.compression = None
+        self.stream_request_body = stream_request_body
+        if response_cache_size:
+            self.response_cache = ResponseCache(
+                max_size=response_cache_size,
+                max_entry_size=response_cache_max_entry_size,
+            )
+        else:
+            self.response_cache = None
+        if single_flight_paths:
+            self.single_flight = SingleFlight(
+                single_flight_paths, cache=self.response_cache
+            )
+        else:
+            self.single_flight = None
 
-        resource.Resource.__init__(self)
-
-    def stop(self):
-        return self.application.stop()
-
-    def dispatch_websocket(self, request, base_scope):
-        wsfactory = ASGIWebSocketServerFactory(
+        self.ws_factory = ASGIWebSocketServerFactory(
             application=self.application,
-            base_scope=base_scope,
             idle_timeout=self.websocket_timeout,
+            broadcast_max_buffer_size=broadcast_max_buffer_size,
             protocols=self.ws_protocols,
         )
-
-        wsfactory.setProtocolOptions(
-            autoPingInterval=self.ping_interval, autoPingTimeout=self.ping_timeout
+        if websocket_compression:
+            compression_accept = DeflateAccept(
+                window_bits=websocket_compression_window_bits,
+                client_window_bits=websocket_compression_client_window_bits,
+                no_context_takeover=websocket_compression_no_context_takeover,
+            )
+        else:
+            compression_accept = None
+        self.ws_factory.setProtocolOptions(
+            autoPingInterval=self.ping_interval,
+            autoPingTimeout=self.ping_timeout,
+            perMessageCompressionAccept=compression_accept,
+            maxMessagePayloadSize=websocket_max_message_size,
+            maxFramePayloadSize=websocket_max_frame_size,
+            autoFragmentSize=websocket_auto_fragment_size,
+            utf8validateIncoming=websocket_utf8_validate,
+            openHandshakeTimeout=websocket_handshake_timeout,
         )
-        wsfactory.startFactory()
-        return WebSocketResource(wsfactory).render(request)
+        self.ws_factory.startFactory()
+        self.ws_resource = ASGIWebSocketResource(self.ws_factory)
+        self.groups = self.ws_factory.groups
+
+        resource.Resource.__init__(self)
+
+    def start(self):
+        if self.watchdog_threshold and self.watchdog is None:
+            self.watchdog = LoopWatchdog(
+                self.application,
+                self.watchdog_threshold,
+                sample_stacks=self.watchdog_sample_stacks,
+            )
+            self.watchdog.start()
+        return self.application.start()
+
+    def stop(self):
+        if self.watchdog is not None:
+            self.watchdog.stop()
+            self.watchdog = None
+        self.ws_factory.stopFactory()
+        if self.sendfile_cache is not None:
+            self.sendfile_cache.clear()
+        if self.response_cache is not None:
+            self.response_cache.clear()
+        return self.application.stop()
 
-    def dispatch_http(self, request, base_scope):
+    def dispatch_websocket(self, request, scope):
+        return self.ws_resource.render_with_scope(request, scope)
+
+    def dispatch_http(self, request, scope):
         return ASGIHTTPResource(
             application=self.application,
-            base_scope=base_scope,
+            scope=scope,
             timeout=self.http_timeout,
             use_x_sendfile=self.use_x_sendfile,
+            sendfile_cache=self.sendfile_cache,
+            compression=self.compression,
+            cache=self.response_cache,
+            single_flight=self.single_flight,
         ).render(request)
 
     def render(self, request):
-        path = [b""] + request.postpath
-        path = "/".join(p.decode("utf-8") for p in path)
+        if self.application.draining:
+            request.setHeader(b"connection", b"close")
+            send_error_page(
+                request, 503, "Service Unavailable", "The server is shutting down"
+            )
+            return server.NOT_DONE_YET
 
-        if b"?" in request.uri:
-            query_string = request.uri.split(b"?", 1)[1]
-        else:
-            query_string = ""
+        raw_path, _, query_string = request.uri.partition(b"?")
+        path = b"/".join([b""] + request.postpath).decode("utf-8")
+
+        upgrade = request.requestHeaders.getRawHeaders(b"upgrade")
+        is_websocket = upgrade is not None and any(
+            value.lower() == b"websocket" for value in upgrade
+        )
+
+        # refuse before doing any work when over the limits
+        admission = self.application.admission
+        if admission is not None and not admission.check(
+            is_websocket and "websocket" or "http", path
+        ):
+            send_overloaded(request, admission.retry_after)
+            return server.NOT_DONE_YET
 
-        is_websocket = False
         headers = []
         for name, values in request.requestHeaders.getAllRawHeaders():
-            # Prevent CVE-2015-0219
-            if b"_" in name:
+            name = get_header_name(name)
+            if name is None:
                 continue
 
-            name = name.lower()
             for value in values:
                 headers.append([name, value])
-                if name == b"upgrade" and value.lower() == b"websocket":
-                    is_websocket = True
 
-        if hasattr(request.client, "host") and hasattr(request.client, "port"):
-            client_info = [request.client.host, request.client.port]
+        client = request.client
+        if hasattr(client, "host") and hasattr(client, "port"):
+            client_info = [client.host, client.port]
             server_info = [request.host.host, request.host.port]
         else:
             client_info = None
@@ -104,7 +286,7 @@ class ASGIResource(resource.Resource):
         use_proxy_proto_header = self.use_proxy_proto_header
 
         if self.automatic_proxy_header_handling and client_info:
-            ipaddr = ipaddress.ip_address(request.client.host)
+            ipaddr = ipaddress.ip_address(client.host)
             if ipaddr.is_private:
                 use_proxy_headers = True
                 use_proxy_proto_header = False
@@ -134,27 +316,50 @@ class ASGIResource(resource.Resource):
 
                 client_info = [proxy_forwarded_host.decode("utf-8"), port]
 
+        is_secure = request.isSecure()
         if use_proxy_proto_header:
-            headers.append(
-                [b"x-forwarded-proto", b"http%s" % (request.isSecure() and b"s" or b"")]
-            )
+            headers.append([b"x-forwarded-proto", is_secure and b"https" or b"http"])
 
-        # build base payload used by both websocket and normal as handshake
-        base_scope = {
-            "asgi": {"version": "3.0", "spec_version": "2.0"},
+        # the complete scope is built here, protocols use it as-is
+        scope = {
+            "asgi": ASGI_VERSION,
             "path": path,
-            "raw_path": request.uri,
+            "raw_path": raw_path,
             "query_string": query_string,
             "root_path": self.root_path,
             "headers": headers,
             "client": client_info,
             "server": server_info,
-            "_ssl": request.isSecure() and "s" or "",
         }
 
+        state = self.application.state
+        if state is not None:
+            scope["state"] = dict(state)
+
         if is_websocket:
-            return self.dispatch_websocket(request, base_scope)
-        else:
-            return self.dispatch_http(request, base_scope)
+            subprotocols = []
+            for value in request.requestHeaders.getRawHeaders(
+                b"sec-websocket-protocol", []
+            ):
+                subprotocols += [
+                    x.strip() + " " for x in value.decode("ascii").split(",")
+                ]
 
-        return server.NOT_DONE_YET
+            scope["type"] = "websocket"
+            scope["scheme"] = is_secure and "wss" or "ws"
+            scope["subprotocols"] = subprotocols
+            scope["extensions"] = dict(WEBSOCKET_EXTENSIONS)
+            return self.dispatch_websocket(request, scope)
+        else:
+            scope["type"] = "http"
+            scope["scheme"] = is_secure and "https" or "http"
+            scope["method"] = request.method.decode("ascii")
+            try:
+                scope["http_version"] = HTTP_VERSIONS[request.clientproto]
+            except KeyError:
+                scope["http_version"] = request.clientproto.decode("ascii").split("/")[1]
+            if scope["http_version"] == "1.1":
+                scope["extensions"] = dict(HTTP11_EXTENSIONS)
+            else:
+                scope["extensions"] = dict(HTTP_EXTENSIONS)
+            return self.dispatch_http(request, scope)
@@ -0,0 +1,247 @@
+import logging
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_ENTRY_SIZE = 1024 * 1024
+
+# not replayed from the cache, they belong to the connection or the exchange
+UNCACHED_HEADERS = {
+    b"connection",
+    b"keep-alive",
+    b"transfer-encoding",
+    b"date",
+    b"age",
+    b"x-sendfile",
+}
+
+
+def parse_cache_control(values):
+    """
+    Returns the directives of Cache-Control header values as a dict,
+    directives without a value map to None.
+    """
+    directives = {}
+    for value in values:
+        for directive in value.split(b","):
+            name, _, argument = directive.strip().partition(b"=")
+            if name:
+                directives[name.lower()] = argument.strip(b'"') or None
+    return directives
+
+
+def get_max_age(status, headers):
+    """
+    Returns the seconds a response may be cached for, None if it must not
+    be cached. Only explicitly public responses are cached.
+    """
+    if status != 200:
+        return None
+
+    cache_control, vary = [], []
+    for name, value in headers:
+        name = name.lower()
+        if name == b"cache-control":
+            cache_control.append(value)
+        elif name == b"set-cookie":
+            return None
+        elif name == b"vary":
+            vary.append(value)
+
+    if any(value.strip() == b"*" for value in vary):
+        return None
+
+    directives = parse_cache_control(cache_control)
+    if b"public" not in directives or directives.keys() & {
+        b"private",
+        b"no-store",
+        b"no-cache",
+    }:
+        return None
+
+    max_age = directives.get(b"s-maxage") or directives.get(b"max-age")
+    try:
+        max_age = int(max_age)
+    except (TypeError, ValueError):
+        return None
+    return max_age if max_age > 0 else None
+
+
+def get_vary(headers):
+    names = []
+    for name, value in headers:
+        if name.lower() == b"vary":
+            names.extend(v.strip().lower() for v in value.split(b",") if v.strip())
+    return tuple(sorted(set(names)))
+
+
+class CachedResponse:
+    __slots__ = ("status", "headers", "body", "etag", "stored_at", "expires", "size")
+
+    def __init__(self, status, headers, body, etag, stored_at, expires):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        self.stored_at = stored_at
+        self.expires = expires
+        self.size = len(body) + sum(len(name) + len(value) for name, value in headers)
+
+
+class ResponseCache:
+    """
+    In-process cache of responses to GET and HEAD requests.
+
+    Responses are cached when the application marks them
+    `Cache-Control: public` with a max-age, they are keyed by method, path,
+    query string and the request headers named in Vary. The least recently
+    used entries are evicted when the bodies exceed `max_size` bytes,
+    larger responses than `max_entry_size` are never cached.
+
+    Expired entries with an ETag are revalidated with the application using
+    If-None-Match. Concurrent misses for the same key wait for the first
+    one instead of all running the application.
+    """
+
+    clock = reactor
+
+    def __init__(
+        self, max_size=DEFAULT_MAX_SIZE, max_entry_size=DEFAULT_MAX_ENTRY_SIZE
+    ):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.vary = {}  # (method, path, query_string): header names in Vary
+        self.in_flight = {}  # key: Deferreds of requests waiting for the first
+
+    def is_cacheable_request(self, scope):
+        if scope["method"] not in ("GET", "HEAD"):
+            return False
+
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                return False
+            if name == b"cache-control" and b"no-cache" in value.lower():
+                return False
+        return True
+
+    def get_key(self, scope, vary=None):
+        resource_key = (scope["method"], scope["path"], scope["query_string"])
+        if vary is None:
+            vary = self.vary.get(resource_key, ())
+
+        values = []
+        for header in vary:
+            values.append(
+                b",".join(value for name, value in scope["headers"] if name == header)
+            )
+        return resource_key + tuple(values)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def is_fresh(self, entry):
+        return entry.expires > self.clock.seconds()
+
+    def begin(self, key, scope):
+        """
+        Returns a Deferred firing with the entry stored by the request
+        already fetching key, or None when the caller should fetch it.
+        """
+        waiters = self.in_flight.get(key)
+        if waiters is None:
+            self.in_flight[key] = []
+            return None
+
+        d = defer.Deferred(lambda d: self.cancel_waiter(key, d))
+        waiters.append((d, scope))
+        return d
+
+    def cancel_waiter(self, key, d):
+        waiters = self.in_flight.get(key, [])
+        for waiter in waiters:
+            if waiter[0] is d:
+                waiters.remove(waiter)
+                break
+
+    def finish(self, key, entry=None):
+        """
+        Called by the request fetching key, entry is the response to pass on
+        or None if the waiters have to fetch it themselves. Requests call it
+        as soon as they know their response is not cached, so the waiters are
+        not held back by a long response.
+        """
+        for d, scope in self.in_flight.pop(key, ()):
+            # the Vary of the response may not have been known when they waited
+            if entry is not None and self.entries.get(self.get_key(scope)) is not entry:
+                d.callback(None)
+            else:
+                d.callback(entry)
+
+    def store(self, scope, status, headers, body):
+        """
+        Caches a response if it is allowed to, returns the entry or None.
+        """
+        max_age = get_max_age(status, headers)
+        if max_age is None or len(body) > self.max_entry_size:
+            return None
+
+        vary = get_vary(headers)
+        resource_key = (scope["method"], scope["path"], scope["query_string"])
+        if self.vary.get(resource_key, ()) != vary:
+            self.vary[resource_key] = vary
+
+        etag = None
+        cached_headers = []
+        for name, value in headers:
+            lowered = name.lower()
+            if lowered == b"etag":
+                etag = value
+            if lowered not in UNCACHED_HEADERS:
+                cached_headers.append((name, value))
+
+        now = self.clock.seconds()
+        entry = CachedResponse(status, cached_headers, body, etag, now, now + max_age)
+        if entry.size > self.max_size:
+            return None
+
+        self.put(self.get_key(scope, vary), entry)
+        return entry
+
+    def refresh(self, entry, headers):
+        """
+        Makes entry fresh again after the application answered 304 Not Modified.
+        """
+        max_age = get_max_age(200, headers)
+        if max_age is not None:
+            now = self.clock.seconds()
+            entry.stored_at = now
+            entry.expires = now + max_age
+        return entry
+
+    def put(self, key, entry):
+        self.remove(key)
+        self.entries[key] = entry
+        self.size += entry.size
+
+        while self.size > self.max_size:
+            key, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            logger.debug("Evicted %r from the response cache" % (key,))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def clear(self):
+        self.entries.clear()
+        self.vary.clear()
+        self.size = 0
@@ -0,0 +1,176 @@
+import logging
+import zlib
+
+from twisted.internet import threads
+
+try:
+    import brotli
+except ImportError:  # brotli is optional
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_CONTENT_TYPES = (
+    b"text/",
+    b"application/json",
+    b"application/javascript",
+    b"application/xml",
+    b"application/xhtml+xml",
+    b"application/rss+xml",
+    b"application/atom+xml",
+    b"application/manifest+json",
+    b"application/wasm",
+    b"image/svg+xml",
+)
+
+
+def parse_accept_encoding(accept_encoding):
+    """
+    Returns a dict of content-coding to q-value from an Accept-Encoding header.
+    """
+    encodings = {}
+    for part in accept_encoding.split(b","):
+        encoding, _, params = part.strip().partition(b";")
+        encoding = encoding.strip().lower()
+        if not encoding:
+            continue
+
+        q = 1.0
+        params = params.strip()
+        if params.startswith(b"q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        encodings[encoding] = q
+    return encodings
+
+
+class Compressor:
+    """
+    Streaming compressor for one response.
+    """
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == b"br":
+            self.compressor = brotli.Compressor(quality=min(level, 11))
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data, finish, flush=True):
+        """
+        Compresses data. With flush, everything given so far is flushed so
+        streamed responses are not held back, without it the compressor
+        keeps what it needs for a better ratio.
+        """
+        if self.encoding == b"br":
+            data = self.compressor.process(data)
+            if finish:
+                return data + self.compressor.finish()
+        else:
+            data = self.compressor.compress(data)
+            if finish:
+                return data + self.compressor.flush()
+
+        if flush:
+            return data + self.flush()
+        return data
+
+    def flush(self):
+        if self.encoding == b"br":
+            return self.compressor.flush()
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ResponseCompression:
+    """
+    Decides which responses are compressed and compresses them.
+
+    Responses are compressed when the client accepts gzip (or br if
+    the brotli module is installed), the content type is compressible and
+    the response is not already encoded or smaller than `minimum_size`.
+    Chunks of at least `thread_size` bytes are compressed in the reactor
+    thread pool, set it to None to always compress in the reactor thread.
+    """
+
+    def __init__(self, level=6, minimum_size=500, thread_size=256 * 1024):
+        self.level = level
+        self.minimum_size = minimum_size
+        self.thread_size = thread_size
+
+        self.encodings = [b"gzip"]
+        if brotli is not None:
+            self.encodings.insert(0, b"br")
+
+    def negotiate(self, accept_encoding):
+        if not accept_encoding:
+            return None
+
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_q = None, 0.0
+        for encoding in self.encodings:
+            q = accepted.get(encoding, accepted.get(b"*", 0.0))
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def is_compressible(self, request, status):
+        # only successful responses, partial content must keep its byte ranges
+        if request.method == b"HEAD" or not 200 <= status < 300 or status in (204, 206):
+            return False
+
+        headers = request.responseHeaders
+        if headers.hasHeader(b"content-encoding"):
+            return False
+
+        content_type = headers.getRawHeaders(b"content-type", [b""])[0].lower()
+        if not content_type.startswith(COMPRESSIBLE_CONTENT_TYPES):
+            return False
+
+        for cache_control in headers.getRawHeaders(b"cache-control", []):
+            if b"no-transform" in cache_control.lower():
+                return False
+
+        content_length = headers.getRawHeaders(b"content-length")
+        if content_length:
+            try:
+                if int(content_length[0]) < self.minimum_size:
+                    return False
+            except ValueError:
+                return False
+
+        return True
+
+    def get_compressor(self, request, status):
+        """
+        Returns a Compressor if the response to request should be compressed.
+        Call `start` with it before the first body is written.
+        """
+        if not self.is_compressible(request, status):
+            return None
+
+        request.responseHeaders.addRawHeader(b"vary", b"Accept-Encoding")
+        encoding = self.negotiate(request.getHeader(b"accept-encoding"))
+        if encoding is None:
+            return None
+
+        return Compressor(encoding, self.level)
+
+    def start(self, request, compressor):
+        headers = request.responseHeaders
+        headers.removeHeader(b"content-length")
+        headers.setRawHeaders(b"content-encoding", [compressor.encoding])
+
+        etags = headers.getRawHeaders(b"etag")
+        if etags and not etags[0].startswith(b"W/"):
+            headers.setRawHeaders(b"etag", [b"W/" + etags[0]])
+
+    def compress(self, compressor, data, finish, flush=True):
+        """
+        Returns the compressed data, or a Deferred with it if it is compressed
+        in a thread.
+        """
+        if self.thread_size is not None and len(data) >= self.thread_size:
+            return threads.deferToThread(compressor.compress, data, finish, flush)
+        return compressor.compress(data, finish, flush)
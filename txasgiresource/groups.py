@@ -0,0 +1,90 @@
+import logging
+
+from .metrics import WEBSOCKET_LABELS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BUFFER_SIZE = 1024 * 1024
+
+
+class GroupManager:
+    """
+    Named groups of WebSocket connections that messages can be broadcast to.
+
+    A broadcast message is encoded and framed once and the frame written to
+    every open member. Once the transport of a member pauses it, at most
+    `max_buffer_size` more bytes are broadcast to it until it resumes, so
+    a slow consumer does not buffer an unbounded backlog.
+    """
+
+    def __init__(self, factory, max_buffer_size=DEFAULT_MAX_BUFFER_SIZE):
+        self.factory = factory
+        self.max_buffer_size = max_buffer_size
+        self.groups = {}
+
+    def add(self, group, protocol):
+        self.groups.setdefault(group, set()).add(protocol)
+        if protocol.group_names is None:
+            protocol.group_names = set()
+        protocol.group_names.add(group)
+
+    def discard(self, group, protocol):
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(protocol)
+            if not members:
+                del self.groups[group]
+        if protocol.group_names is not None:
+            protocol.group_names.discard(group)
+
+    def remove_protocol(self, protocol):
+        for group in list(protocol.group_names or ()):
+            self.discard(group, protocol)
+
+    def broadcast(self, group, text=None, bytes=None, exclude=None):
+        """
+        Sends text or bytes to the members of group, except exclude. The
+        arguments are named like the keys of the websocket.broadcast message.
+
+        Returns the number of members the message was written to.
+        """
+        if bytes is not None:
+            payload, is_binary = bytes, True
+        elif text is not None:
+            payload, is_binary = text.encode("utf8"), False
+        else:
+            raise ValueError("A broadcast needs text or bytes")
+
+        members = self.groups.get(group)
+        if not members:
+            return 0
+        message = self.factory.prepareMessage(payload, is_binary)
+
+        sent = skipped = 0
+        for protocol in members:
+            if protocol is exclude or protocol.state != protocol.STATE_OPEN:
+                continue
+
+            if self.max_buffer_size and not protocol.producing:
+                if protocol.paused_backlog + len(payload) > self.max_buffer_size:
+                    skipped += 1
+                    continue
+                protocol.paused_backlog += len(payload)
+
+            protocol.sendPreparedMessage(message)
+            sent += 1
+
+        if skipped:
+            logger.debug(
+                "Skipped %s slow members of group %s in broadcast" % (skipped, group)
+            )
+
+        metrics = self.factory.application.metrics
+        if metrics is not None:
+            metrics.increment(
+                "txasgi_bytes_sent_total", len(payload) * sent, WEBSOCKET_LABELS
+            )
+            if skipped:
+                metrics.increment("txasgi_broadcast_skipped_total", skipped)
+
+        return sent
@@ -1,31 +1,163 @@
-import hashlib
 import logging
 import os
+from collections import deque
+from io import BytesIO
 
-from twisted.internet import defer, error, reactor
-from twisted.web import http, resource, server, static
+from zope.interface import implementer
 
-from .utils import send_error_page
+from twisted.internet import defer, interfaces, reactor
+from twisted.web import http, resource, server
+
+from .admission import AdmissionRejected, send_overloaded
+from .cache import get_max_age
+from .metrics import HTTP_LABELS
+from .sendfile import SendfileCache, read_range, send_descriptor, send_file
+from .singleflight import EMPTY_REQUEST
+from .utils import ReplyQueue, send_error_page
 
 logger = logging.getLogger(__name__)
 
 MAXIMUM_CONTENT_SIZE = 950 * 1024
 
-
+# the application waits in send() until the file of these has been sent
+FILE_MESSAGES = ("http.response.zerocopysend", "http.response.pathsend")
+
+# connection-specific headers are not allowed in HTTP/2 responses
+HTTP2_FORBIDDEN_HEADERS = {
+    b"connection",
+    b"keep-alive",
+    b"proxy-connection",
+    b"transfer-encoding",
+    b"upgrade",
+}
+
+
+class ASGIRequest(server.Request):
+    """
+    Request that dispatches to a resource with `stream_request_body` set
+    as soon as the headers are received, the body is then handed to
+    the `body_consumer` as it arrives instead of being buffered first.
+
+    Use it as `requestFactory` for the `server.Site`.
+    """
+
+    body_streaming = False
+    body_finished = False
+    body_consumer = None
+
+    def gotLength(self, length):
+        if length != 0 and self._dispatch_early():
+            self.body_streaming = True
+            self.content = BytesIO()
+            self.process()
+        else:
+            server.Request.gotLength(self, length)
+
+    def _dispatch_early(self):
+        channel = self.channel
+        if hasattr(channel, "streamID"):  # HTTP/2 stream
+            command, uri, version = channel.command, channel.path, b"HTTP/2"
+        else:
+            try:
+                command, uri, version = (
+                    channel._command,
+                    channel._path,
+                    channel._version,
+                )
+            except AttributeError:  # not a channel we know how to read early from
+                return False
+
+        self.method, self.uri, self.clientproto = command, uri, version
+        self.path = uri.split(b"?", 1)[0]
+        self.args = {}
+
+        self.prepath = []
+        self.postpath = list(map(http.unquote, self.path[1:].split(b"/")))
+        try:
+            resrc = channel.site.getResourceFor(self)
+        except Exception:
+            return False
+
+        return getattr(resrc, "stream_request_body", False)
+
+    def handleContentChunk(self, data):
+        if self.body_consumer is not None:
+            self.body_consumer.body_chunk_received(data)
+        elif not self.finished:
+            server.Request.handleContentChunk(self, data)
+
+    def requestReceived(self, command, path, version):
+        if not self.body_streaming:
+            return server.Request.requestReceived(self, command, path, version)
+
+        self.body_finished = True
+        if self.body_consumer is not None:
+            self.body_consumer.body_done()
+
+    def finish(self):
+        if self.body_streaming and not self.body_finished:
+            # the response is done before the client sent the whole body,
+            # the rest of the body is thrown away and the connection closed.
+            self.body_consumer = None
+            self.channel.persistent = False
+        return server.Request.finish(self)
+
+
+@implementer(interfaces.IPushProducer)
 class ASGIHTTPResource(resource.Resource):
     isLeaf = True
     request = None
-
-    def __init__(self, application, base_scope, timeout=None, use_x_sendfile=False):
+    request_transport = None
+    producing = True
+    resume_defer = None
+    clock = reactor
+    started_at = None
+    bytes_received = 0
+    compressor = None
+    compressing = False
+    compressing_body = False  # a chunk is being compressed, maybe in a thread
+    unflushed = False  # the compressor holds data back while the transport is full
+    cache_key = None
+    cache_scope = None
+    cache_response = None  # [status, headers, body chunks] while it can be cached
+    cache_size = 0
+    cache_entry = None
+    revalidating = None
+    file_sends = None  # Deferreds of file messages the application waits for
+    flight = None
+    queue = None
+
+    def __init__(
+        self,
+        application,
+        scope,
+        timeout=None,
+        use_x_sendfile=False,
+        sendfile_cache=None,
+        compression=None,
+        cache=None,
+        single_flight=None,
+    ):
         self.application = application
-        self.base_scope = base_scope
+        self.scope = scope
         self.timeout = timeout
         self.use_x_sendfile = use_x_sendfile
-        self.reply_defer = defer.Deferred()
+        if use_x_sendfile and sendfile_cache is None:
+            sendfile_cache = SendfileCache()
+        self.sendfile_cache = sendfile_cache
+        self.compression = compression
+        self.cache = cache
+        self.single_flight = single_flight
+        self.metrics = application.metrics
+        self.replies = ReplyQueue(self.clock)
 
         resource.Resource.__init__(self)
 
     def send_request_to_application(self, request, content):
+        if getattr(request, "body_streaming", False):
+            self.stream_request_to_application(request, content)
+            return
+
         # get size to figure out if we need to chunk request
         if content.closed:
             logger.info("Seems like we tried to work on a closed connection")
@@ -34,6 +166,7 @@ class ASGIHTTPResource(resource.Resource):
         content.seek(0, os.SEEK_END)
         content_size = content.tell()
         content.seek(0, 0)
+        self.bytes_received = content_size
 
         logger.debug("Sending initial HTTP request")
         while True:
@@ -49,31 +182,75 @@ class ASGIHTTPResource(resource.Resource):
 
         self.wait_for_application_reply(request)
 
+    def stream_request_to_application(self, request, content):
+        logger.debug("Streaming HTTP request body")
+        self.request_transport = request.channel.transport
+        if self.request_transport is None:
+            # a HTTP/2 stream, pausing it only holds back the window of this stream
+            self.request_transport = request.channel
+
+        content.seek(0, 0)
+        body = content.read()
+        content.seek(0, 0)
+        content.truncate()
+        if body:
+            self.body_chunk_received(body)
+
+        if request.body_finished:
+            self.body_done()
+        else:
+            request.body_consumer = self
+
+        self.wait_for_application_reply(request)
+
+    def body_chunk_received(self, data):
+        self.bytes_received += len(data)
+        self.queue.put_nowait({"type": "http.request", "body": data, "more_body": True})
+
+        if self.queue.is_full() and self.request_transport is not None:
+            self.queue.pause_producer(self.request_transport)
+
+    def body_done(self):
+        self.request.body_consumer = None
+        self.queue.put_nowait({"type": "http.request", "body": b"", "more_body": False})
+
     @defer.inlineCallbacks
     def wait_for_application_reply(self, request):
         def connection_lost(failure):
             failure.trap(Exception)
             request.finished = 1
-            self.queue.put_nowait({"type": "http.disconnect"})
+            # a flight keeps going while other requests wait for it
+            if self.queue is not None and (
+                self.flight is None or self.flight.is_last(self)
+            ):
+                self.queue.put_nowait({"type": "http.disconnect"})
             self.do_cleanup(is_finished=True)
 
         request.notifyFinish().addErrback(connection_lost)
 
         sent_header = False
-        while True:
+        body_finished = False
+        expect_trailers = False
+        trailers = []
+        done = False
+        while not done:
             try:
-                self.reply_defer.addTimeout(self.timeout, reactor)
-                reply = yield self.reply_defer
+                replies = yield self.replies.get(self.timeout)
             except defer.TimeoutError:
                 logger.debug("We hit a timeout")
+                if self.metrics is not None:
+                    self.metrics.increment("txasgi_http_timeouts_total")
                 send_error_page(
                     request,
                     504,
                     "Timeout while waiting for upstream",
                     "Timeout while waiting for upstream",
                 )
+                self.do_cleanup()
                 defer.returnValue(None)
             except defer.CancelledError:
+                if self.metrics is not None:
+                    self.metrics.increment("txasgi_http_cancelled_total")
                 send_error_page(
                     request,
                     503,
@@ -82,96 +259,513 @@ class ASGIHTTPResource(resource.Resource):
                 )
                 defer.returnValue(None)
 
-            if reply["type"] == "http.response.start":
-                if sent_header:
-                    raise ValueError("Headers already sent")
-
-                x_sendfile_path = None
-                for name, value in reply["headers"]:
-                    if self.use_x_sendfile and name.lower() == b"x-sendfile":
-                        x_sendfile_path = value
+            # body chunks from the same batch are written to the transport together
+            body = []
+            for reply in replies:
+                reply_type = reply["type"]
+                if reply_type == "http.response.start":
+                    if sent_header:
+                        raise ValueError("Headers already sent")
+
+                    if self.metrics is not None:
+                        self.metrics.observe(
+                            "txasgi_http_first_byte_seconds",
+                            self.clock.seconds() - self.started_at,
+                        )
+
+                    if self.revalidating is not None and reply["status"] == 304:
+                        self.cache_entry = self.cache.refresh(
+                            self.revalidating, reply["headers"]
+                        )
+                        yield self.replay(request, self.cache_entry)
+                        done = True
+                        break
+
+                    x_sendfile_path = None
+                    is_http2 = request.clientproto == b"HTTP/2"
+                    for name, value in reply["headers"]:
+                        if self.use_x_sendfile and name.lower() == b"x-sendfile":
+                            x_sendfile_path = value
+                        elif is_http2 and name.lower() in HTTP2_FORBIDDEN_HEADERS:
+                            continue
+                        else:
+                            request.responseHeaders.addRawHeader(name, value)
+
+                    if x_sendfile_path and request.method != b"HEAD":
+                        logger.debug(
+                            "We got a request for sendfile at %s" % (x_sendfile_path,)
+                        )
+                        self.finish_caching()
+                        yield self.do_sendfile(request, x_sendfile_path)
+                        done = True
+                        break
                     else:
-                        request.responseHeaders.addRawHeader(name, value)
-
-                if x_sendfile_path and request.method != b"HEAD":
-                    logger.debug(
-                        "We got a request for sendfile at %s" % (x_sendfile_path,)
+                        request.setResponseCode(reply["status"])
+                        request.registerProducer(self, True)
+                        expect_trailers = reply.get("trailers", False)
+                        if self.cache_key is not None:
+                            if not expect_trailers and get_max_age(
+                                reply["status"], reply["headers"]
+                            ):
+                                self.cache_response = [
+                                    reply["status"],
+                                    reply["headers"],
+                                    [],
+                                ]
+                            else:  # requests waiting for it can go ahead
+                                self.finish_caching()
+                        if self.compression is not None:
+                            self.compressor = self.compression.get_compressor(
+                                request, reply["status"]
+                            )
+
+                    sent_header = True
+
+                elif reply_type == "http.response.trailers":
+                    if not expect_trailers:
+                        continue
+
+                    trailers.extend(reply.get("headers", []))
+                    if not reply.get("more_trailers", False):
+                        expect_trailers = False
+                        done = body_finished
+                        if done:
+                            break
+
+                elif body_finished:
+                    continue
+
+                elif reply_type == "http.response.body":
+                    body.append(reply.get("body", b"") or b"")
+                    if self.cache_response is not None:
+                        self.cache_body_received(body[-1])
+
+                    if not reply.get("more_body", False):
+                        body_finished = True
+                        done = not expect_trailers
+                        if done:
+                            break
+
+                elif reply_type in FILE_MESSAGES:
+                    self.cache_response = None
+                    self.finish_caching()
+                    yield self.write_body(request, b"".join(body), False)
+                    body = []
+
+                    finished = reply_type == "http.response.pathsend" or not reply.get(
+                        "more_body", False
                     )
-                    yield self.do_sendfile(request, x_sendfile_path)
-                    break
-                else:
-                    request.setResponseCode(reply["status"])
+                    try:
+                        yield self.send_file_reply(request, reply, finished)
+                    finally:
+                        self.file_sent()
+                    if finished:
+                        body_finished = True
+                        done = not expect_trailers
+                        if done:
+                            break
+
+                    if request.finished or not request.channel:
+                        break
+
+            yield self.write_body(request, b"".join(body), body_finished)
+
+            if request.finished or not request.channel:
+                break
+
+        if done and self.cache_response is not None:
+            status, headers, chunks = self.cache_response
+            self.cache_entry = self.cache.store(
+                self.cache_scope, status, headers, b"".join(chunks)
+            )
+        self.cache_response = None
+        self.finish_caching()
 
-                sent_header = True
-                continue
+        if not request.finished:
+            request.unregisterProducer()
+            if trailers:
+                self.write_trailers(request, trailers)
+            request.finish()
 
-            elif reply["type"] == "http.response.body":
-                if not sent_header:
-                    pass
+        self.do_cleanup()
 
-                if not request.finished and request.channel is not None:
-                    request.write(reply.get("body", b"") or b"")
+    @defer.inlineCallbacks
+    def write_body(self, request, body, finished):
+        """
+        Writes a part of the response body, compressing it if negotiated.
+        """
+        compressor = self.compressor
+        if compressor is not None and body and not self.compressing:
+            if finished and len(body) < self.compression.minimum_size:
+                compressor = self.compressor = None
+            else:
+                self.compression.start(request, compressor)
+                self.compressing = True
+
+        if self.compressing and (body or finished):
+            # flushing costs ratio, only flush what goes to the transport now
+            flush = finished or self.producing
+            self.compressing_body = True
+            try:
+                body = yield self.compression.compress(
+                    compressor, body, finished, flush
+                )
+            finally:
+                self.compressing_body = False
 
-                if (
-                    not reply.get("more_body", False)
-                    or request.finished
-                    or not request.channel
-                ):
-                    break
+            if not flush and self.producing:  # resumed while compressing
+                body += compressor.flush()
+                flush = True
+            self.unflushed = not flush
+            if finished:
+                self.compressing = False
+                self.compressor = None
 
-        if not request.finished:
+        if body and not request.finished and request.channel is not None:
+            request.write(body)
+
+    @defer.inlineCallbacks
+    def send_file_reply(self, request, reply, finished):
+        """
+        Sends the file of a zerocopysend or pathsend message, the application
+        waits in send() until it is written.
+        """
+        if reply["type"] == "http.response.pathsend":
+            try:
+                fd = os.open(reply["path"], os.O_RDONLY)
+            except OSError as e:
+                logger.warning("Unable to open %s for pathsend: %s" % (reply["path"], e))
+                request.loseConnection()
+                defer.returnValue(None)
+            offset, count, owned = 0, None, True
+        else:
+            fd = reply["file"].fileno()
+            offset, count, owned = reply.get("offset"), reply.get("count"), False
+
+        try:
+            if offset is None:
+                offset = os.lseek(fd, 0, os.SEEK_CUR)
+            if count is None:
+                count = os.fstat(fd).st_size - offset
+
+            if self.compressor is not None and not self.compressing:
+                self.compressor = None  # files are sent as they are
+
+            if self.compressing:
+                yield self.write_body(request, read_range(fd, offset, count), finished)
+            elif not request.finished and request.channel is not None:
+                zero_copy = (
+                    self.sendfile_cache is None or self.sendfile_cache.zero_copy
+                )
+                request.unregisterProducer()
+                self.producing = False
+                try:
+                    yield send_descriptor(request, fd, offset, count, zero_copy)
+                finally:
+                    if not request.finished and request.channel is not None:
+                        request.registerProducer(self, True)
+                    self.resumeProducing()
+        finally:
+            if owned:
+                os.close(fd)
+
+    def cache_body_received(self, data):
+        self.cache_size += len(data)
+        if self.cache_size > self.cache.max_entry_size:
+            self.cache_response = None
+            self.finish_caching()
+        else:
+            self.cache_response[2].append(data)
+
+    @defer.inlineCallbacks
+    def render_cached(self, request):
+        """
+        Answers request from the cache, or from the application while
+        other requests for the same response wait for it.
+        """
+        cache = self.cache
+        key = cache.get_key(self.scope)
+        entry = cache.get(key)
+        if entry is None or not cache.is_fresh(entry):
+            waiting = cache.begin(key, self.scope)
+            if waiting is not None:
+                if self.timeout is not None:
+                    waiting.addTimeout(self.timeout, self.clock)
+                try:
+                    entry = yield waiting
+                except defer.TimeoutError:
+                    logger.debug("Timeout while waiting for a response to cache")
+                    entry = None
+                if entry is None:  # it could not be cached, ask the application
+                    self._render(request)
+                    defer.returnValue(None)
+            else:
+                if self.metrics is not None:
+                    self.metrics.increment("txasgi_response_cache_misses_total")
+                self.cache_key = key
+                self.cache_scope = self.scope
+                if entry is not None and entry.etag is not None:
+                    self.revalidate(entry)
+                self._render(request)
+                defer.returnValue(None)
+
+        if self.metrics is not None:
+            self.metrics.increment("txasgi_response_cache_hits_total")
+        yield self.replay(request, entry)
+
+    def revalidate(self, entry):
+        """
+        Asks the application if the expired entry is still valid, unless the
+        client sent conditions of its own.
+        """
+        headers = self.scope["headers"]
+        for name, value in headers:
+            if name in (b"if-none-match", b"if-modified-since"):
+                return
+
+        self.revalidating = entry
+        headers = headers + [[b"if-none-match", entry.etag]]
+        self.scope = dict(self.scope, headers=headers)
+
+    @defer.inlineCallbacks
+    def replay(self, request, entry):
+        """
+        Writes a cached response to request.
+        """
+        if request.finished or request.channel is None:
+            defer.returnValue(None)
+
+        is_http2 = request.clientproto == b"HTTP/2"
+        for name, value in entry.headers:
+            if not (is_http2 and name.lower() in HTTP2_FORBIDDEN_HEADERS):
+                request.responseHeaders.addRawHeader(name, value)
+        age = max(0, int(self.clock.seconds() - entry.stored_at))
+        request.setHeader(b"age", str(age).encode("ascii"))
+
+        if_none_match = request.getHeader(b"if-none-match")
+        if entry.etag is not None and if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(b",")]
+            if entry.etag in tags or b"*" in tags:
+                request.setResponseCode(http.NOT_MODIFIED)
+                request.finish()
+                defer.returnValue(None)
+
+        request.setResponseCode(entry.status)
+        if self.compression is not None:
+            self.compressor = self.compression.get_compressor(request, entry.status)
+        yield self.write_body(request, entry.body, True)
+        if not request.finished and request.channel is not None:
             request.finish()
 
-        self.do_cleanup()
+    def finish_caching(self):
+        if self.cache_key is not None:
+            key, self.cache_key = self.cache_key, None
+            self.cache.finish(key, self.cache_entry)
+
+    def write_trailers(self, request, trailers):
+        """
+        Trailers can only be sent in a chunked HTTP/1.1 response,
+        they are dropped otherwise.
+        """
+        if not request.startedWriting:
+            request.write(b"")
+
+        if not getattr(request, "chunked", False) or request.channel is None:
+            logger.debug("Response is not chunked, dropping trailers")
+            return
+
+        request.chunked = 0  # finish() must not end the chunked body again
+        lines = [b"0\r\n"]
+        for name, value in trailers:
+            lines.append(name + b": " + value + b"\r\n")
+        lines.append(b"\r\n")
+        request.channel.writeSequence(lines)
 
     def handle_reply(self, msg):
-        d = self.reply_defer
-        self.reply_defer = defer.Deferred()
-        d.callback(msg)
+        self.replies.put(msg)
+
+        if msg["type"] in FILE_MESSAGES:
+            # the file may be closed as soon as send() returns
+            d = defer.Deferred()
+            if self.file_sends is None:
+                self.file_sends = deque()
+            self.file_sends.append(d)
+            return d
+
+        if not self.producing:
+            if self.resume_defer is None:
+                self.resume_defer = defer.Deferred()
+            return self.resume_defer
+
+    def file_sent(self, all_files=False):
+        """
+        Lets the application return from send() of the oldest file message,
+        or of all of them when the response is done.
+        """
+        while self.file_sends:
+            self.file_sends.popleft().callback(None)
+            if not all_files:
+                break
+        if not self.file_sends:
+            self.file_sends = None
+
+    def pauseProducing(self):
+        logger.debug("Transport is full, pausing application")
+        self.producing = False
+
+    def resumeProducing(self):
+        self.producing = True
+        if self.unflushed and not self.compressing_body:
+            self.flush_compressor()
+        if self.resume_defer is not None:
+            d, self.resume_defer = self.resume_defer, None
+            d.callback(None)
+
+    def flush_compressor(self):
+        """
+        Writes what the compressor held back while the transport was full.
+        """
+        self.unflushed = False
+        body = self.compressor.flush()
+        request = self.request
+        if body and not request.finished and request.channel is not None:
+            request.write(body)
+
+    def stopProducing(self):
+        self.resumeProducing()
 
     @defer.inlineCallbacks
     def _render(self, request):
         self.request = request
+        self.started_at = self.clock.seconds()
 
-        scope = dict(self.base_scope)
-        scope["type"] = "http"
-        scope["http_version"] = request.clientproto.decode("utf8").split("/")[1]
-        scope["scheme"] = "http%s" % (scope.pop("_ssl"))
-        scope["method"] = request.method.decode("utf8")
+        protocol = self
+        if self.can_join_flight(request):
+            if not self.single_flight.join(self):
+                self.wait_for_application_reply(request)
+                defer.returnValue(None)
+            protocol = self.flight
+
+        def abandoned(failure):
+            # others in the flight still need the instance
+            if not admitted.called and (
+                self.flight is None or self.flight.is_last(self)
+            ):
+                admitted.cancel()
+
+        try:
+            queue = self.application.create_application_instance(protocol, self.scope)
+            if isinstance(queue, defer.Deferred):  # waiting for admission
+                admitted = queue
+                request.notifyFinish().addErrback(abandoned)
+                queue = yield admitted
+        except AdmissionRejected:
+            retry_after = self.application.admission.retry_after
+            if self.flight is not None:
+                self.flight.reject(retry_after)
+            else:
+                self.finish_caching()
+                send_overloaded(request, retry_after)
+            defer.returnValue(None)
+        except defer.CancelledError:  # client went away while waiting
+            self.finish_caching()
+            if self.flight is not None:
+                self.flight.unsubscribe(self)
+                self.flight = None
+            defer.returnValue(None)
 
-        self.queue = yield defer.maybeDeferred(
-            self.application.create_application_instance, self, scope
-        )
+        if self.metrics is not None:
+            self.metrics.observe(
+                "txasgi_http_app_start_seconds", self.clock.seconds() - self.started_at
+            )
+
+        if self.flight is not None:
+            self.flight.set_queue(queue)
+            if request.finished or request.channel is None:
+                self.do_cleanup(is_finished=True)
+            else:
+                self.wait_for_application_reply(request)
+        else:
+            self.queue = queue
+            self.send_request_to_application(request, request.content)
 
-        self.send_request_to_application(request, request.content)
+    @defer.inlineCallbacks
+    def leave_flight(self):
+        """
+        Runs an application instance of its own after the response of the
+        flight turned out to be for the first request only. The reply loop
+        keeps running, only its source changes.
+        """
+        request = self.request
+        self.flight = None
+        self.queue = None
+        try:
+            queue = yield defer.maybeDeferred(
+                self.application.create_application_instance, self, self.scope
+            )
+        except AdmissionRejected:
+            send_overloaded(request, self.application.admission.retry_after)
+            self.do_cleanup()
+            defer.returnValue(None)
+
+        self.queue = queue
+        queue.put_nowait(dict(EMPTY_REQUEST))
+        if request.finished or request.channel is None:
+            queue.put_nowait({"type": "http.disconnect"})
+            self.do_cleanup(is_finished=True)
+
+    def can_join_flight(self, request):
+        """
+        Only requests without a body can share an application instance,
+        the instance gets an empty http.request from the flight.
+        """
+        if (
+            self.single_flight is None
+            or self.revalidating is not None
+            or getattr(request, "body_streaming", False)
+            or not self.single_flight.is_eligible(self.scope)
+        ):
+            return False
+
+        content = request.content
+        if content is None or content.closed:
+            return False
+        content.seek(0, os.SEEK_END)
+        has_body = content.tell() > 0
+        content.seek(0, 0)
+        return not has_body
 
     def render(self, request):
-        self._render(request)
+        if self.cache is not None and self.cache.is_cacheable_request(self.scope):
+            self.render_cached(request)
+        else:
+            self._render(request)
 
         return server.NOT_DONE_YET
 
-    @defer.inlineCallbacks
-    def do_sendfile(self, request, path):
-        if not os.path.isfile(path):
-            request.setResponseCode(404)
-            defer.returnValue(None)
+    def record_metrics(self):
+        metrics = self.metrics
+        metrics.increment("txasgi_http_requests_total")
+        metrics.observe(
+            "txasgi_http_duration_seconds", self.clock.seconds() - self.started_at
+        )
+        metrics.increment("txasgi_bytes_received_total", self.bytes_received, HTTP_LABELS)
+        if self.request is not None:
+            metrics.increment(
+                "txasgi_bytes_sent_total", self.request.sentLength, HTTP_LABELS
+            )
+        self.started_at = None
 
-        etag = hashlib.sha1(path).hexdigest()[:16].encode("ascii")
-        if request.setETag(etag) != http.CACHED:
-            finished_defer = request.notifyFinish()
-            static.File(path).render(request)
-            try:
-                yield finished_defer
-            except error.ConnectionDone:
-                logger.debug("sendfile done")
+    def do_sendfile(self, request, path):
+        return send_file(request, self.sendfile_cache, path)
 
     def do_cleanup(self, is_finished=False):
         logger.debug(
             "Cleaning up after finished request that are finished:%s path:%s?%s"
             % (
                 is_finished,
-                self.base_scope["path"],
-                self.base_scope.get("query_string", b""),
+                self.scope["path"],
+                self.scope.get("query_string", b""),
             )
         )
 
@@ -181,13 +775,22 @@ class ASGIHTTPResource(resource.Resource):
             and not self.request.finished
             and self.request.channel
         ):
+            self.request.unregisterProducer()
             self.request.finish()
 
-        if (
-            self.reply_defer
-            and not self.reply_defer.called
-            and self.reply_defer.callbacks
-        ):
-            self.reply_defer.cancel()
+        self.resumeProducing()
+        self.file_sent(all_files=True)
+        self.finish_caching()
+
+        if self.replies.waiter is not None:
+            self.replies.cancel()
+        else:
+            self.replies.stop_timeout()
+
+        if self.metrics is not None and self.started_at is not None:
+            self.record_metrics()
 
+        if self.flight is not None:
+            flight, self.flight = self.flight, None
+            return flight.unsubscribe(self)
         return self.application.finish_protocol(self)
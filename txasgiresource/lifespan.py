@@ -0,0 +1,92 @@
+import logging
+
+from twisted.internet import defer, reactor
+
+from .utils import ASGI_VERSION
+
+logger = logging.getLogger(__name__)
+
+
+class LifespanError(Exception):
+    pass
+
+
+class Lifespan:
+    """
+    Runs the ASGI lifespan protocol for an application.
+
+    Applications that exit or fail without answering lifespan.startup are
+    treated as not supporting lifespan and are served without it.
+    """
+
+    supported = None
+    waiter = None
+    clock = reactor
+
+    def __init__(self, application, timeout=60):
+        self.application = application
+        self.timeout = timeout
+        self.state = {}
+
+    @defer.inlineCallbacks
+    def startup(self):
+        scope = {"type": "lifespan", "asgi": ASGI_VERSION, "state": self.state}
+        self.queue = self.application.create_application_instance(self, scope)
+        self.application.application_instances[self].add_done_callback(
+            self.application_exited
+        )
+
+        reply = yield self.send_event("lifespan.startup")
+        if reply is None:
+            logger.info("Application does not support lifespan, continuing without")
+            self.supported = False
+            self.do_cleanup()
+            return
+
+        if reply["type"] == "lifespan.startup.failed":
+            self.do_cleanup()
+            raise LifespanError(reply.get("message", ""))
+
+        logger.debug("Application startup complete")
+        self.supported = True
+
+    @defer.inlineCallbacks
+    def shutdown(self):
+        if self.supported:
+            try:
+                reply = yield self.send_event("lifespan.shutdown")
+            except defer.TimeoutError:
+                logger.warning("Timeout while waiting for application shutdown")
+            else:
+                if reply and reply["type"] == "lifespan.shutdown.failed":
+                    logger.error(
+                        "Application shutdown failed: %s" % (reply.get("message", ""),)
+                    )
+
+        wait_for = self.do_cleanup()
+        if wait_for:
+            yield defer.Deferred.fromFuture(wait_for)
+
+    def send_event(self, event_type):
+        self.waiter = defer.Deferred()
+        self.waiter.addTimeout(self.timeout, self.clock)
+        self.queue.put_nowait({"type": event_type})
+        return self.waiter
+
+    def handle_reply(self, msg):
+        if msg is not None and not msg["type"].startswith("lifespan."):
+            logger.warning("Unexpected message during lifespan: %s" % (msg["type"],))
+            return
+
+        if self.waiter is not None and not self.waiter.called:
+            d, self.waiter = self.waiter, None
+            d.callback(msg)
+
+    def application_exited(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.debug("Lifespan application exited: %r" % (future.exception(),))
+
+        self.handle_reply(None)
+
+    def do_cleanup(self):
+        return self.application.finish_protocol(self)
@@ -0,0 +1,158 @@
+import bisect
+
+from twisted.web import resource
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HTTP_LABELS = (("protocol", "http"),)
+WEBSOCKET_LABELS = (("protocol", "websocket"),)
+
+DESCRIPTIONS = {
+    "txasgi_http_requests_total": "HTTP requests handled",
+    "txasgi_http_timeouts_total": "HTTP requests answered with 504 after a timeout",
+    "txasgi_http_cancelled_total": "HTTP requests answered with 503 after cancellation",
+    "txasgi_http_app_start_seconds": "Time from request until the application instance is started",
+    "txasgi_http_first_byte_seconds": "Time from request until the response starts",
+    "txasgi_http_duration_seconds": "Time from request until the response is finished",
+    "txasgi_bytes_received_total": "Body and message bytes received from clients",
+    "txasgi_bytes_sent_total": "Body and message bytes sent to clients",
+    "txasgi_active_instances": "Running application instances",
+    "txasgi_queued_messages": "Messages waiting to be received by application instances",
+    "txasgi_queue_limit_hits_total": "Times a protocol was paused by a full application queue",
+    "txasgi_loop_lag_seconds": "How late the event loop watchdog heartbeat ran",
+    "txasgi_loop_blocked_total": "Times the event loop was blocked longer than the threshold",
+    "txasgi_broadcast_skipped_total": "Broadcast messages not sent to slow WebSocket consumers",
+    "txasgi_admission_rejected_total": "Requests and WebSockets refused with 503 by admission control",
+    "txasgi_response_cache_hits_total": "GET and HEAD requests answered from the response cache",
+    "txasgi_response_cache_misses_total": "Cacheable requests passed on to the application",
+    "txasgi_single_flight_joined_total": "GET requests answered by the instance of an identical request",
+}
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    In-memory metrics sink that can be rendered in the Prometheus text format.
+
+    Any object with the same `increment` and `observe` methods can be used as
+    sink instead, e.g. to forward to statsd. Labels are tuples of
+    (name, value) pairs.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def increment(self, name, value=1, labels=()):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def register_gauge(self, name, callback):
+        """
+        Registers a gauge that is read when rendered, callback must return
+        a dict of labels to value.
+        """
+        self.gauges[name] = callback
+
+    def render_prometheus(self):
+        lines = []
+        seen = set()
+
+        def add_header(name, metric_type):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in DESCRIPTIONS:
+                lines.append("# HELP %s %s" % (name, DESCRIPTIONS[name]))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+
+        for (name, labels), value in sorted(self.counters.items()):
+            add_header(name, "counter")
+            lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+
+        for name, callback in sorted(self.gauges.items()):
+            metric_type = "counter" if name.endswith("_total") else "gauge"
+            add_header(name, metric_type)
+            for labels, value in sorted(callback().items()):
+                lines.append(
+                    "%s%s %s" % (name, format_labels(labels), format_value(value))
+                )
+
+        for (name, labels), histogram in sorted(
+            self.histograms.items(), key=lambda item: item[0]
+        ):
+            add_header(name, "histogram")
+            cumulative = 0
+            for le, count in zip(
+                histogram.buckets + (float("inf"),), histogram.counts
+            ):
+                cumulative += count
+                lines.append(
+                    "%s_bucket%s %s"
+                    % (
+                        name,
+                        format_labels(labels, (("le", format_value(le)),)),
+                        cumulative,
+                    )
+                )
+            lines.append(
+                "%s_sum%s %s"
+                % (name, format_labels(labels), format_value(histogram.sum))
+            )
+            lines.append("%s_count%s %s" % (name, format_labels(labels), histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsResource(resource.Resource):
+    """
+    Serves the metrics in the Prometheus text format.
+    """
+
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")
+        return self.metrics.render_prometheus().encode("utf-8")
@@ -0,0 +1,451 @@
+"""
+Runs application instances away from the reactor loop.
+
+ThreadWorkerPool runs them on event loops in worker threads, which helps
+applications that block in code releasing the GIL (sync database drivers,
+file I/O, C extensions). ProcessWorkerPool runs them in worker processes
+that import the application themselves, so CPU-bound applications use
+other cores.
+
+Either way receive() and send() are bridged to the reactor loop, so the
+protocols and their backpressure work unchanged.
+"""
+import asyncio
+import importlib
+import itertools
+import logging
+import os
+import pickle
+import struct
+import sys
+import threading
+from collections import deque
+
+from asgiref.compatibility import guarantee_single_callable
+
+from twisted.internet import defer, protocol, reactor
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct("!I")
+STOP_TIMEOUT = 10
+
+# files cannot be passed to a worker process
+FILE_EXTENSIONS = ("http.response.zerocopysend", "http.response.pathsend")
+
+
+class WorkerLoop:
+    """
+    Event loop running forever in its own thread.
+    """
+
+    clock = reactor
+
+    def __init__(self, name):
+        self.active = 0
+        self.loop = asyncio.new_event_loop()
+        self.stopped = defer.Deferred()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True)
+            )
+            self.loop.close()
+        finally:
+            reactor.callFromThread(self.stopped.callback, None)
+
+    def stop(self):
+        """
+        Returns a Deferred firing when the loop has stopped, or after
+        STOP_TIMEOUT seconds if an instance is still blocking it.
+        """
+
+        def timed_out(failure):
+            failure.trap(defer.TimeoutError)
+            logger.warning(
+                "Worker thread %s did not stop in time" % (self.thread.name,)
+            )
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        d = defer.Deferred()
+        self.stopped.chainDeferred(d)
+        d.addTimeout(STOP_TIMEOUT, self.clock)
+        return d.addErrback(timed_out)
+
+
+class ThreadWorkerPool:
+    """
+    Runs application instances on `workers` event loops in worker threads,
+    each instance is started on the loop with the fewest running instances.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.loops = None
+
+    def start(self):
+        if self.loops is None:
+            self.loops = [
+                WorkerLoop("txasgiresource-worker-%s" % (i,))
+                for i in range(self.workers)
+            ]
+
+    def stop(self):
+        loops, self.loops = self.loops or [], None
+        return defer.DeferredList([worker.stop() for worker in loops])
+
+    async def run(self, application, scope, receive, send):
+        self.start()
+        main_loop = asyncio.get_event_loop()
+        worker = min(self.loops, key=lambda worker: worker.active)
+
+        async def worker_receive():
+            future = asyncio.run_coroutine_threadsafe(receive(), main_loop)
+            return await asyncio.wrap_future(future)
+
+        async def worker_send(message):
+            future = asyncio.run_coroutine_threadsafe(send(message), main_loop)
+            await asyncio.wrap_future(future)
+
+        worker.active += 1
+        try:
+            future = asyncio.run_coroutine_threadsafe(
+                application(scope=scope, receive=worker_receive, send=worker_send),
+                worker.loop,
+            )
+            return await asyncio.wrap_future(future)
+        finally:
+            worker.active -= 1
+
+
+def encode_frame(*frame):
+    data = pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL)
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def decode_frames(buffer):
+    """
+    Returns the complete frames in buffer and what is left of it.
+    """
+    frames = []
+    while len(buffer) >= FRAME_HEADER.size:
+        (size,) = FRAME_HEADER.unpack_from(buffer)
+        end = FRAME_HEADER.size + size
+        if len(buffer) < end:
+            break
+        frames.append(pickle.loads(buffer[FRAME_HEADER.size : end]))
+        buffer = buffer[end:]
+    return frames, buffer
+
+
+class InstanceError(Exception):
+    pass
+
+
+class ProcessInstance:
+    def __init__(self, receive, send):
+        self.receive = receive
+        self.send = send
+        self.receiving = set()
+        self.done = asyncio.get_event_loop().create_future()
+        self.done.add_done_callback(self.cancel_receiving)
+
+    def cancel_receiving(self, done):
+        # nobody is left to pass the messages to
+        for task in list(self.receiving):
+            task.cancel()
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    Reactor side of a worker process, instances are multiplexed over
+    its stdin and stdout.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffer = b""
+        self.instances = {}
+        self.exited = False
+        self.ended = defer.Deferred()
+
+    def send_frame(self, *frame):
+        if not self.exited:
+            self.transport.write(encode_frame(*frame))
+
+    def start_instance(self, instance_id, scope, receive, send):
+        instance = self.instances[instance_id] = ProcessInstance(receive, send)
+        # the state is not shared, worker processes run their own lifespan
+        scope = dict(scope)
+        scope.pop("state", None)
+        if "extensions" in scope:
+            scope["extensions"] = {
+                name: value
+                for name, value in scope["extensions"].items()
+                if name not in FILE_EXTENSIONS
+            }
+        self.send_frame("start", instance_id, scope)
+        return instance
+
+    def cancel_instance(self, instance_id):
+        if self.instances.pop(instance_id, None) is not None:
+            self.send_frame("cancel", instance_id, None)
+
+    def childDataReceived(self, fd, data):
+        frames, self.buffer = decode_frames(self.buffer + data)
+        for kind, instance_id, payload in frames:
+            instance = self.instances.get(instance_id)
+            if instance is None:
+                continue
+
+            if kind == "receive":
+                task = asyncio.ensure_future(
+                    self.forward_receive(instance_id, instance)
+                )
+                instance.receiving.add(task)
+                task.add_done_callback(instance.receiving.discard)
+            elif kind == "send":
+                asyncio.ensure_future(self.forward_send(instance_id, instance, payload))
+            elif kind == "done":
+                del self.instances[instance_id]
+                if payload is None:
+                    instance.done.set_result(None)
+                else:
+                    instance.done.set_exception(InstanceError(payload))
+
+    async def forward_receive(self, instance_id, instance):
+        message = await instance.receive()
+        self.send_frame("message", instance_id, message)
+
+    async def forward_send(self, instance_id, instance, message):
+        await instance.send(message)
+        self.send_frame("sent", instance_id, None)
+
+    def processEnded(self, reason):
+        self.exited = True
+        for instance in self.instances.values():
+            if not instance.done.done():
+                instance.done.set_exception(
+                    InstanceError("Worker process ended: %s" % (reason.value,))
+                )
+        self.instances = {}
+        self.ended.callback(None)
+        self.pool.worker_ended(self)
+
+
+class ProcessWorkerPool:
+    """
+    Runs application instances in `workers` worker processes.
+
+    The workers import the application from `application_path`
+    ("module:attribute"), scopes and messages are pickled. Workers that exit
+    are replaced when the next instance is started.
+    """
+
+    def __init__(self, application_path, workers=4):
+        self.application_path = application_path
+        self.workers = workers
+        self.processes = []
+        self.instance_ids = itertools.count()
+
+    def start(self):
+        while len(self.processes) < self.workers:
+            self.processes.append(self.spawn())
+
+    def spawn(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+
+        process = WorkerProcess(self)
+        reactor.spawnProcess(
+            process,
+            sys.executable,
+            [sys.executable, "-m", "txasgiresource.offload", self.application_path],
+            env=env,
+            childFDs={0: "w", 1: "r", 2: 2},
+        )
+        return process
+
+    def worker_ended(self, process):
+        if process in self.processes:
+            logger.warning("Offload worker process ended")
+            self.processes.remove(process)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        processes, self.processes = self.processes, []
+        for process in processes:
+            process.transport.closeStdin()  # the worker exits when stdin closes
+        yield defer.DeferredList([process.ended for process in processes])
+
+    async def run(self, application, scope, receive, send):
+        self.start()
+        process = min(self.processes, key=lambda process: len(process.instances))
+        instance_id = next(self.instance_ids)
+        instance = process.start_instance(instance_id, scope, receive, send)
+        try:
+            await instance.done
+        except asyncio.CancelledError:
+            process.cancel_instance(instance_id)
+            raise
+
+
+class WorkerProcessRunner:
+    """
+    Worker process side of ProcessWorkerPool, runs instances of the application
+    on the event loop of the process.
+    """
+
+    lifespan_timeout = 60
+
+    def __init__(self, application, loop, channel):
+        self.application = application
+        self.loop = loop
+        self.channel = channel
+        self.instances = {}
+        self.write_lock = threading.Lock()
+        self.lifespan_state = None
+
+    def send_frame(self, *frame):
+        with self.write_lock:
+            self.channel.write(encode_frame(*frame))
+            self.channel.flush()
+
+    def read_frames(self):
+        """
+        Reads frames from stdin in a thread until it is closed.
+        """
+        buffer = b""
+        stdin = sys.stdin.buffer.raw
+        while True:
+            data = stdin.read(65536)
+            if not data:
+                break
+            frames, buffer = decode_frames(buffer + data)
+            for frame in frames:
+                self.loop.call_soon_threadsafe(self.handle_frame, *frame)
+        self.loop.call_soon_threadsafe(self.stopped.set_result, None)
+
+    def handle_frame(self, kind, instance_id, payload):
+        if kind == "start":
+            self.start_instance(instance_id, payload)
+            return
+
+        instance = self.instances.get(instance_id)
+        if instance is None:
+            return
+
+        task, receive_waiters, send_waiters = instance
+        if kind == "message":
+            receive_waiters.popleft().set_result(payload)
+        elif kind == "sent":
+            send_waiters.popleft().set_result(None)
+        elif kind == "cancel":
+            task.cancel()
+
+    def start_instance(self, instance_id, scope):
+        receive_waiters, send_waiters = deque(), deque()
+
+        async def receive():
+            future = self.loop.create_future()
+            receive_waiters.append(future)
+            self.send_frame("receive", instance_id, None)
+            return await future
+
+        async def send(message):
+            future = self.loop.create_future()
+            send_waiters.append(future)
+            self.send_frame("send", instance_id, message)
+            await future
+
+        if self.lifespan_state is not None:
+            scope["state"] = dict(self.lifespan_state)
+
+        task = self.loop.create_task(
+            self.application(scope=scope, receive=receive, send=send)
+        )
+        task.add_done_callback(lambda task: self.instance_done(instance_id, task))
+        self.instances[instance_id] = (task, receive_waiters, send_waiters)
+
+    def instance_done(self, instance_id, task):
+        del self.instances[instance_id]
+        error = None
+        if not task.cancelled() and task.exception() is not None:
+            error = repr(task.exception())
+            logger.error("Application instance failed: %s" % (error,))
+        self.send_frame("done", instance_id, error)
+
+    async def lifespan(self, event_type):
+        """
+        Sends a lifespan event and returns the reply, None if the application
+        does not support lifespan.
+        """
+        self.lifespan_events.put_nowait({"type": event_type})
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(self.lifespan_replies.get()), self.lifespan_timeout
+            )
+        except Exception:
+            return None
+
+    async def run(self):
+        self.stopped = self.loop.create_future()
+        self.lifespan_events = asyncio.Queue()
+        self.lifespan_replies = asyncio.Queue()
+
+        state = {}
+
+        async def lifespan_application():
+            scope = {"type": "lifespan", "asgi": {"version": "3.0"}, "state": state}
+            try:
+                await self.application(
+                    scope=scope,
+                    receive=self.lifespan_events.get,
+                    send=self.lifespan_replies.put,
+                )
+            finally:
+                self.lifespan_replies.put_nowait(None)
+
+        lifespan_task = self.loop.create_task(lifespan_application())
+        reply = await self.lifespan("lifespan.startup")
+        supported = reply is not None and reply["type"] == "lifespan.startup.complete"
+        if supported:
+            self.lifespan_state = state
+
+        threading.Thread(target=self.read_frames, daemon=True).start()
+        await self.stopped
+
+        for task, _, _ in list(self.instances.values()):
+            task.cancel()
+
+        if supported:
+            await self.lifespan("lifespan.shutdown")
+        lifespan_task.cancel()
+
+
+def main():
+    # frames go to the original stdout, anything the application prints to stderr
+    channel = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    module, attribute = sys.argv[1].split(":")
+    application = getattr(importlib.import_module(module), attribute)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runner = WorkerProcessRunner(guarantee_single_callable(application), loop, channel)
+    loop.run_until_complete(runner.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,539 @@
+import logging
+import os
+import stat
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from twisted.internet import defer, interfaces, reactor, tcp
+from twisted.web import http, static
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+ZERO_COPY_TURN_LIMIT = 4 * 1024 * 1024  # bytes sent with sendfile(2) per reactor turn
+
+
+class SendfileEntry:
+    """
+    Cached metadata, and possibly an open file descriptor, for a file.
+    """
+
+    fd = None
+    evicted = False
+
+    def __init__(self, path, st, checked_at):
+        self.path = path
+        self.update(st)
+        self.checked_at = checked_at
+        self.users = 0
+
+        content_type, content_encoding = static.getTypeAndEncoding(
+            os.path.basename(path.decode("utf-8", "replace")),
+            static.File.contentTypes,
+            static.File.contentEncodings,
+            "application/octet-stream",
+        )
+        self.content_type = content_type.encode("ascii")
+        self.content_encoding = content_encoding and content_encoding.encode("ascii")
+
+    def update(self, st):
+        self.inode = st.st_ino
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+        self.etag = b"%x-%x-%x" % (self.inode, self.mtime_ns, self.size)
+
+    def matches(self, st):
+        return (
+            self.inode == st.st_ino
+            and self.size == st.st_size
+            and self.mtime_ns == st.st_mtime_ns
+        )
+
+    def acquire(self):
+        """
+        Returns the open file descriptor. When the file is opened, the entry
+        is refreshed if the file was replaced since it was stat'ed.
+        """
+        if self.fd is None:
+            fd = os.open(self.path, os.O_RDONLY)
+            st = os.fstat(fd)
+            if not self.matches(st):
+                logger.debug("File %s changed since it was cached" % (self.path,))
+                self.update(st)
+            self.fd = fd
+        self.users += 1
+        return self.fd
+
+    def release(self):
+        self.users -= 1
+        if self.evicted:
+            self.close()
+
+    def close(self):
+        self.evicted = True
+        if self.fd is not None and self.users <= 0:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SendfileCache:
+    """
+    Bounded LRU of stat results for files served with X-Sendfile.
+
+    A path is only stat'ed again when its entry is older than `check_interval`
+    seconds and the entry is replaced when inode, size or mtime changed.
+    The file descriptors of the `max_open_files` most recently used files
+    are kept open and shared between the requests serving them.
+
+    With `zero_copy` files are sent with sendfile(2) when the request is
+    served over a plain TCP connection, otherwise they are read and written.
+    """
+
+    def __init__(
+        self,
+        max_entries=1024,
+        max_open_files=64,
+        check_interval=1.0,
+        zero_copy=True,
+        clock=reactor,
+    ):
+        self.max_entries = max_entries
+        self.max_open_files = max_open_files
+        self.check_interval = check_interval
+        self.zero_copy = zero_copy and hasattr(os, "sendfile")
+        self.clock = clock
+        self.entries = OrderedDict()
+
+    def get(self, path):
+        """
+        Returns the entry for path or None if it is not a regular file.
+        """
+        now = self.clock.seconds()
+        entry = self.entries.get(path)
+        if entry is not None:
+            self.entries.move_to_end(path)
+            if now - entry.checked_at < self.check_interval:
+                return entry
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+
+        if st is None or not stat.S_ISREG(st.st_mode):
+            if entry is not None:
+                self.remove(path)
+            return None
+
+        if entry is not None and entry.matches(st):
+            entry.checked_at = now
+            return entry
+
+        if entry is not None:
+            self.remove(path)
+
+        entry = self.entries[path] = SendfileEntry(path, st, now)
+        self.prune()
+        return entry
+
+    def remove(self, path):
+        self.entries.pop(path).close()
+
+    def prune(self):
+        while len(self.entries) > self.max_entries:
+            path = next(iter(self.entries))
+            self.remove(path)
+
+        open_files = 0
+        for entry in reversed(self.entries.values()):
+            if entry.fd is None:
+                continue
+            open_files += 1
+            if open_files > self.max_open_files and entry.users <= 0:
+                os.close(entry.fd)
+                entry.fd = None
+
+    def clear(self):
+        for path in list(self.entries.keys()):
+            self.remove(path)
+
+
+@implementer(interfaces.IPullProducer)
+class FileProducer:
+    """
+    Writes `size` bytes from `offset` of a cached file to a request using
+    positional reads, so the file descriptor can be shared.
+    """
+
+    def __init__(self, request, cache, entry, offset, size, finish_request=True):
+        self.request = request
+        self.cache = cache
+        self.entry = entry
+        self.fd = entry.acquire()
+        self.offset = offset
+        self.remaining = size
+        self.finish_request = finish_request
+        self.finished = defer.Deferred()
+
+    def start(self):
+        self.request.registerProducer(self, False)
+        return self.finished
+
+    def resumeProducing(self):
+        if not self.request:
+            return
+
+        data = os.pread(self.fd, min(CHUNK_SIZE, self.remaining), self.offset)
+        if not data:  # file was truncated while we were sending it
+            logger.warning("File %s was truncated while sending" % (self.entry.path,))
+            self.remaining = 0
+        else:
+            self.offset += len(data)
+            self.remaining -= len(data)
+            self.request.write(data)
+
+        if self.remaining <= 0:
+            request = self.request
+            request.unregisterProducer()
+            if self.finish_request:
+                request.finish()
+            self.stopProducing()
+
+    def stopProducing(self):
+        if self.request is None:
+            return
+
+        self.request = None
+        self.entry.release()
+        if self.cache is not None:
+            self.cache.prune()
+        self.finished.callback(None)
+
+
+class TCPWriteBuffer:
+    """
+    The write buffer of a tcp.Server, which Twisted does not expose.
+
+    This is the only place using its internals, the attributes of
+    abstract.FileDescriptor last checked against Twisted 26.4. Transports
+    without them are not supported and get FileProducer instead.
+    """
+
+    attributes = ("dataBuffer", "offset", "_tempDataBuffer", "producerPaused")
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    @classmethod
+    def is_supported(cls, transport):
+        return type(transport) is tcp.Server and all(
+            hasattr(transport, name) for name in cls.attributes
+        )
+
+    def has_data(self):
+        transport = self.transport
+        return len(transport.dataBuffer) > transport.offset or bool(
+            transport._tempDataBuffer
+        )
+
+    def wait_until_written(self):
+        """
+        Pauses the producer of the transport the way the transport does when
+        its buffer is full, it is resumed once everything is written.
+        """
+        transport = self.transport
+        if not transport.producerPaused:
+            transport.producerPaused = True
+            transport.producer.pauseProducing()
+        transport.startWriting()
+
+
+@implementer(interfaces.IPushProducer)
+class ZeroCopyFileProducer:
+    """
+    Sends `size` bytes from `offset` of a cached file directly from the file
+    descriptor to the socket of a plain TCP transport with sendfile(2).
+
+    sendfile(2) is only called while the transport has nothing buffered.
+    Otherwise, and when the socket is full, the HTTP channel is paused the
+    same way the transport pauses it when its own buffer is full, and the
+    transport resumes it once everything is written.
+
+    This needs to look into the write buffer of the transport, see
+    TCPWriteBuffer.
+    """
+
+    paused = False
+    send_call = None
+
+    def __init__(self, request, cache, entry, offset, size, finish_request=True):
+        self.request = request
+        self.transport = request.channel.transport
+        self.write_buffer = TCPWriteBuffer(self.transport)
+        self.cache = cache
+        self.clock = cache.clock if cache is not None else reactor
+        self.entry = entry
+        self.fd = entry.acquire()
+        self.offset = offset
+        self.remaining = size
+        self.finish_request = finish_request
+        self.finished = defer.Deferred()
+
+    @staticmethod
+    def is_supported(request):
+        """
+        The body must go to the socket unchanged, so the response must not be
+        chunked and the connection must be plain TCP.
+        """
+        transport = getattr(request.channel, "transport", None)
+        return (
+            TCPWriteBuffer.is_supported(transport)
+            and not request.isSecure()
+            and not getattr(request, "chunked", False)
+            and request.method != b"HEAD"
+        )
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        self.request.write(b"")  # headers
+        self.send()
+        return self.finished
+
+    def send(self):
+        self.send_call = None
+        sent_this_turn = 0
+        while self.request and not self.paused:
+            if self.write_buffer.has_data():
+                self.write_buffer.wait_until_written()
+                return
+
+            try:
+                sent = os.sendfile(
+                    self.transport.fileno(),
+                    self.fd,
+                    self.offset,
+                    min(self.remaining, ZERO_COPY_TURN_LIMIT),
+                )
+            except BlockingIOError:
+                self.write_buffer.wait_until_written()
+                return
+            except OSError as e:
+                logger.debug("sendfile of %s failed: %s" % (self.entry.path, e))
+                self.transport.abortConnection()
+                self.stopProducing()
+                return
+
+            if not sent:  # file was truncated while we were sending it
+                logger.warning(
+                    "File %s was truncated while sending" % (self.entry.path,)
+                )
+                self.remaining = 0
+            else:
+                self.offset += sent
+                self.remaining -= sent
+                self.request.sentLength += sent
+
+            if self.remaining <= 0:
+                request = self.request
+                request.unregisterProducer()
+                if self.finish_request:
+                    request.finish()
+                self.stopProducing()
+                return
+
+            sent_this_turn += sent
+            if sent_this_turn >= ZERO_COPY_TURN_LIMIT:
+                self.send_call = self.clock.callLater(0, self.send)
+                return
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.request and self.send_call is None:
+            self.send()
+
+    def stopProducing(self):
+        if self.request is None:
+            return
+
+        if self.send_call is not None:
+            if self.send_call.active():
+                self.send_call.cancel()
+            self.send_call = None
+
+        self.request = None
+        self.entry.release()
+        if self.cache is not None:
+            self.cache.prune()
+        self.finished.callback(None)
+
+
+class DescriptorEntry:
+    """
+    A file descriptor owned by the caller, used where producers expect
+    a cache entry.
+    """
+
+    def __init__(self, fd, path=None):
+        self.fd = fd
+        self.path = path or "fd %s" % (fd,)
+
+    def acquire(self):
+        return self.fd
+
+    def release(self):
+        pass
+
+
+def read_range(fd, offset, size):
+    """
+    Reads `size` bytes from `offset` of fd, less if the file is shorter.
+    """
+    chunks = []
+    while size > 0:
+        data = os.pread(fd, min(CHUNK_SIZE, size), offset)
+        if not data:
+            break
+        chunks.append(data)
+        offset += len(data)
+        size -= len(data)
+    return b"".join(chunks)
+
+
+def send_descriptor(request, fd, offset, size, zero_copy=True, path=None):
+    """
+    Writes `size` bytes from `offset` of the open file descriptor fd to request
+    without finishing it, the headers must already be set.
+
+    Returns a Deferred that fires when the bytes are written.
+    """
+    if size <= 0:
+        return defer.succeed(None)
+
+    if not request.startedWriting:
+        request.write(b"")  # decides if the response is chunked
+
+    if zero_copy and ZeroCopyFileProducer.is_supported(request):
+        producer_class = ZeroCopyFileProducer
+    else:
+        producer_class = FileProducer
+    entry = DescriptorEntry(fd, path)
+    return producer_class(
+        request, None, entry, offset, size, finish_request=False
+    ).start()
+
+
+def parse_single_range(range_header, size):
+    """
+    Returns (offset, length) for a single byte range, None if the header
+    should be ignored and (0, 0) if the range is not satisfiable.
+    """
+    try:
+        kind, value = range_header.split(b"=", 1)
+    except ValueError:
+        return None
+
+    if kind.strip() != b"bytes" or b"," in value:
+        return None  # multiple ranges are answered with the whole file
+
+    try:
+        start, end = value.strip().split(b"-", 1)
+        start = start and int(start)
+        end = end and int(end)
+    except ValueError:
+        return None
+
+    if start == b"":
+        if end == b"":
+            return None
+        start, end = max(size - end, 0), size
+    elif end == b"" or end >= size:
+        end = size
+    elif start > end:
+        return None
+    else:
+        end += 1
+
+    if start >= size:
+        return 0, 0
+
+    return start, end - start
+
+
+def send_file(request, cache, path):
+    """
+    Sends the file at path as response to request, answering conditional and
+    range requests from the cached metadata.
+
+    Returns a Deferred that fires when the response is done.
+    """
+    entry = cache.get(path)
+    if entry is not None:
+        # the response is described by the file that is actually sent
+        try:
+            entry.acquire()
+        except OSError:
+            cache.remove(path)
+            entry = None
+
+    if entry is None:
+        request.setResponseCode(http.NOT_FOUND)
+        return defer.succeed(None)
+
+    try:
+        return send_entry(request, cache, entry)
+    finally:
+        entry.release()
+
+
+def send_entry(request, cache, entry):
+    """
+    Sends the file of an acquired entry as response to request.
+    """
+    cached = request.setETag(entry.etag)
+    if not request.getHeader(b"if-none-match"):
+        cached = request.setLastModified(entry.mtime)
+
+    if cached == http.CACHED:
+        return defer.succeed(None)
+
+    if not request.responseHeaders.hasHeader(b"content-type"):
+        request.setHeader(b"content-type", entry.content_type)
+    if entry.content_encoding:
+        request.setHeader(b"content-encoding", entry.content_encoding)
+    request.setHeader(b"accept-ranges", b"bytes")
+
+    offset, size = 0, entry.size
+    byte_range = None
+    range_header = request.getHeader(b"range")
+    if range_header:
+        byte_range = parse_single_range(range_header, entry.size)
+
+    if byte_range == (0, 0):
+        request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+        request.setHeader(b"content-range", b"bytes */%d" % (entry.size,))
+        request.setHeader(b"content-length", b"0")
+        return defer.succeed(None)
+    elif byte_range is not None:
+        offset, size = byte_range
+        request.setResponseCode(http.PARTIAL_CONTENT)
+        request.setHeader(
+            b"content-range",
+            b"bytes %d-%d/%d" % (offset, offset + size - 1, entry.size),
+        )
+    else:
+        request.setResponseCode(http.OK)
+
+    request.setHeader(b"content-length", b"%d" % (size,))
+    if size == 0:
+        return defer.succeed(None)
+
+    if cache.zero_copy and ZeroCopyFileProducer.is_supported(request):
+        producer_class = ZeroCopyFileProducer
+    else:
+        producer_class = FileProducer
+    return producer_class(request, cache, entry, offset, size).start()
@@ -0,0 +1,199 @@
+import logging
+
+from twisted.internet import defer
+
+from .admission import send_overloaded
+
+logger = logging.getLogger(__name__)
+
+# requests carrying any of these are answered for someone in particular
+CREDENTIAL_HEADERS = {b"authorization", b"cookie", b"proxy-authorization"}
+
+EMPTY_REQUEST = {"type": "http.request", "body": b"", "more_body": False}
+
+
+def is_personal(headers):
+    """
+    Returns True if a response must only go to the request it was made for.
+    """
+    for name, value in headers:
+        name = name.lower()
+        if name == b"set-cookie":
+            return True
+        if name == b"cache-control":
+            directives = [d.strip().split(b"=")[0].lower() for d in value.split(b",")]
+            if b"private" in directives or b"no-store" in directives:
+                return True
+    return False
+
+
+def get_vary_values(scope, headers):
+    """
+    Returns the values of the request headers the response varies on,
+    None if it varies on everything.
+    """
+    names = set()
+    for name, value in headers:
+        if name.lower() == b"vary":
+            names.update(v.strip().lower() for v in value.split(b",") if v.strip())
+    if b"*" in names:
+        return None
+    return sorted((name, value) for name, value in scope["headers"] if name in names)
+
+
+class Flight:
+    """
+    One application instance answering several identical requests.
+
+    The flight is the protocol of the instance, every message the
+    application sends is passed to the ASGIHTTPResource of each subscribed
+    request, which writes it at the pace of its own client. The application
+    waits in send() while any of them is paused.
+    """
+
+    def __init__(self, single_flight, key):
+        self.single_flight = single_flight
+        self.key = key
+        self.subscribers = []
+        self.queue = None
+        self.started = False
+
+    def subscribe(self, resource):
+        self.subscribers.append(resource)
+        resource.queue = self.queue
+
+    def set_queue(self, queue):
+        self.queue = queue
+        for resource in self.subscribers:
+            resource.queue = queue
+        queue.put_nowait(dict(EMPTY_REQUEST))
+
+    def is_last(self, resource):
+        return self.subscribers == [resource]
+
+    def unsubscribe(self, resource):
+        """
+        Called from the cleanup of a subscriber, the instance is finished
+        with the last one.
+        """
+        if resource in self.subscribers:
+            self.subscribers.remove(resource)
+        if self.subscribers:
+            return None
+
+        self.single_flight.remove(self)
+        return resource.application.finish_protocol(self)
+
+    def reject(self, retry_after):
+        self.single_flight.remove(self)
+        for resource in self.subscribers:
+            resource.finish_caching()
+            send_overloaded(resource.request, retry_after)
+        self.subscribers = []
+
+    def handle_reply(self, msg):
+        if not self.started:
+            # latecomers would miss the start of the response
+            self.started = True
+            self.single_flight.remove(self)
+            if msg["type"] == "http.response.start":
+                self.split(msg["headers"])
+
+        paused = []
+        for resource in list(self.subscribers):
+            d = resource.handle_reply(msg)
+            if d is not None:
+                paused.append(d)
+
+        if not paused:
+            return None
+        if len(paused) == 1:
+            return paused[0]
+        return defer.DeferredList(paused)
+
+    def split(self, headers):
+        """
+        Sends the subscribers that must not get this response to
+        application instances of their own, the first subscriber keeps it.
+        """
+        if len(self.subscribers) < 2:
+            return
+
+        owner = self.subscribers[0]
+        if is_personal(headers):
+            leaving = self.subscribers[1:]
+        else:
+            vary = get_vary_values(owner.scope, headers)
+            leaving = [
+                resource
+                for resource in self.subscribers[1:]
+                if vary is None or get_vary_values(resource.scope, headers) != vary
+            ]
+
+        for resource in leaving:
+            logger.debug("Response of flight %r is not shared" % (self.key,))
+            self.subscribers.remove(resource)
+            resource.leave_flight()
+
+    def do_cleanup(self):
+        promise = None
+        for resource in list(self.subscribers):
+            promise = resource.do_cleanup() or promise
+        return promise
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical GET requests below the path prefixes in
+    `paths` into one application instance.
+
+    Requests are identical when they have the same method, path and query
+    string, and the same values for the Vary headers known to the response
+    `cache` when there is one. Requests with credentials never join. A
+    request only joins a flight until the application starts its response,
+    responses setting cookies, marked private or varying on headers that
+    differ go to the first request only and the others get an application
+    instance of their own.
+    """
+
+    def __init__(self, paths, cache=None):
+        self.paths = tuple(paths)
+        self.cache = cache
+        self.flights = {}
+
+    def get_key(self, scope):
+        if self.cache is not None:
+            return self.cache.get_key(scope)
+        return (scope["method"], scope["path"], scope["query_string"])
+
+    def is_eligible(self, scope):
+        if scope["method"] != "GET" or not scope["path"].startswith(self.paths):
+            return False
+
+        for name, value in scope["headers"]:
+            if name in CREDENTIAL_HEADERS:
+                return False
+        return True
+
+    def join(self, resource):
+        """
+        Subscribes resource to the flight for its request, returns True if
+        it is the first and has to start the application instance.
+        """
+        key = self.get_key(resource.scope)
+        flight = self.flights.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = self.flights[key] = Flight(self, key)
+        else:
+            logger.debug("Request joined flight for %r" % (key,))
+            if resource.metrics is not None:
+                resource.metrics.increment("txasgi_single_flight_joined_total")
+
+        resource.flight = flight
+        flight.subscribe(resource)
+        return is_leader
+
+    def remove(self, flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
@@ -0,0 +1,133 @@
+import gc
+
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.trial.unittest import TestCase
+
+from ..admission import AdmissionControl, AdmissionRejected
+from ..asgiresource import ASGIResource
+from ..utils import sleep
+from .utils import DummyRequest
+
+
+async def wait_for_disconnect(scope, receive, send):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+class TestAdmissionControl(TestCase):
+    def setUp(self):
+        self.admission = AdmissionControl(
+            http_limit=2,
+            websocket_limit=1,
+            http_route_limits={"/api/": 1, "/api/slow/": 1},
+            queue_size=1,
+            queue_timeout=5,
+        )
+        self.admission.clock = self.clock = task.Clock()
+
+    def test_budgets(self):
+        self.assertEqual(self.admission.budgets("http", "/"), [("http", None)])
+        self.assertEqual(
+            self.admission.budgets("http", "/api/slow/x"),
+            [("http", None), ("http", "/api/slow/")],
+        )
+        self.assertEqual(
+            self.admission.budgets("websocket", "/api/"), [("websocket", None)]
+        )
+
+    def test_separate_budgets(self):
+        self.admission.acquire("http", "/")
+        self.admission.acquire("http", "/")
+        self.assertFalse(self.admission.has_room(self.admission.budgets("http", "/")))
+
+        keys = self.admission.acquire("websocket", "/")
+        self.assertEqual(keys, [("websocket", None)])
+        self.assertRaises(AdmissionRejected, self.admission.acquire, "websocket", "/")
+        self.assertEqual(self.admission.stats(), {(("type", "websocket"),): 1})
+
+    def test_waiter_admitted_on_release(self):
+        keys = self.admission.acquire("http", "/api/a")
+        d = self.admission.acquire("http", "/api/b")
+        self.assertNoResult(d)
+        self.assertFalse(self.admission.check("http", "/api/c"))
+
+        self.admission.release(keys)
+        self.assertEqual(self.successResultOf(d), [("http", None), ("http", "/api/")])
+        self.assertFalse(self.admission.waiters)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_waiter_times_out(self):
+        self.admission.acquire("http", "/api/a")
+        d = self.admission.acquire("http", "/api/b")
+        self.clock.advance(5)
+        self.failureResultOf(d, AdmissionRejected)
+        self.assertFalse(self.admission.waiters)
+
+    def test_cancelled_waiter_is_removed(self):
+        self.admission.acquire("http", "/api/a")
+        d = self.admission.acquire("http", "/api/b")
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertFalse(self.admission.waiters)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+
+class TestAdmissionResource(TestCase):
+    def setUp(self):
+        self.resource = ASGIResource(
+            wait_for_disconnect,
+            max_http_instances=1,
+            admission_queue_size=1,
+            retry_after=3,
+        )
+
+    def tearDown(self):
+        return self.resource.stop()
+
+    def render(self):
+        request = DummyRequest([b""])
+        self.resource.render(request)
+        return request
+
+    @defer.inlineCallbacks
+    def test_over_limit_gets_503(self):
+        self.render()
+        waiting = self.render()
+        self.assertEqual(len(self.resource.application.application_instances), 1)
+
+        refused = self.render()
+        self.assertEqual(refused.responseCode, 503)
+        self.assertEqual(refused.responseHeaders.getRawHeaders(b"retry-after"), [b"3"])
+        self.assertFalse(waiting.finished)
+
+        protocol = list(self.resource.application.application_instances)[0]
+        protocol.queue.put_nowait({"type": "http.disconnect"})
+        protocol.do_cleanup()
+        yield sleep(0)[0]
+        self.assertEqual(len(self.resource.application.application_instances), 1)
+        self.assertNotIn(protocol, self.resource.application.application_instances)
+
+    @defer.inlineCallbacks
+    def test_disconnect_after_admission(self):
+        first = self.render()
+        waiting = self.render()
+        application = self.resource.application
+
+        protocol = list(application.application_instances)[0]
+        first.processingFailed(failure.Failure(Exception()))
+        yield sleep(0)[0]
+        self.assertNotIn(protocol, application.application_instances)
+        self.assertEqual(len(application.application_instances), 1)
+
+        waiting.processingFailed(failure.Failure(Exception()))
+        yield sleep(0)[0]
+        gc.collect()  # reports errors left in the notifyFinish Deferreds
+        self.assertFalse(application.application_instances)
+        self.assertFalse(application.admission.active)
+
+    def test_disconnect_while_waiting(self):
+        self.render()
+        waiting = self.render()
+        waiting.processingFailed(failure.Failure(Exception()))
+        self.assertFalse(self.resource.application.admission.waiters)
@@ -0,0 +1,161 @@
+import asyncio
+
+from twisted.internet import defer, task
+from twisted.internet.testing import StringTransport
+from twisted.trial.unittest import TestCase
+
+from ..application import ApplicationManager, ApplicationQueue
+from ..asgiresource import ASGIResource
+from ..utils import sleep
+from .utils import DummyRequest
+
+
+class TestApplicationQueue(TestCase):
+    def test_buffers_are_released(self):
+        queue = ApplicationQueue()
+        self.assertIsNone(queue.items)
+        queue.put_nowait(1)
+        queue.put_nowait(2)
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.get_nowait(), 1)
+        self.assertEqual(queue.get_nowait(), 2)
+        self.assertIsNone(queue.items)
+        self.assertRaises(asyncio.QueueEmpty, queue.get_nowait)
+
+    @defer.inlineCallbacks
+    def test_get_waits(self):
+        queue = ApplicationQueue()
+        d = defer.Deferred.fromFuture(asyncio.ensure_future(queue.get()))
+        yield sleep(0)[0]
+        self.assertNoResult(d)
+
+        queue.put_nowait("message")
+        result = yield d
+        self.assertEqual(result, "message")
+        self.assertIsNone(queue.getters)
+
+    @defer.inlineCallbacks
+    def test_cancelled_getter_passes_wakeup_on(self):
+        queue = ApplicationQueue()
+        first = asyncio.ensure_future(queue.get())
+        second = defer.Deferred.fromFuture(asyncio.ensure_future(queue.get()))
+        yield sleep(0)[0]
+
+        queue.put_nowait("message")
+        first.cancel()
+        result = yield second
+        self.assertEqual(result, "message")
+
+    def test_full_queue_pauses_producer(self):
+        limit_hits = []
+        queue = ApplicationQueue(2, limit_hits.append, "http")
+        transport = StringTransport()
+        queue.put_nowait(1)
+        queue.put_nowait(2)
+        self.assertTrue(queue.is_full())
+        queue.pause_producer(transport)
+        self.assertEqual(transport.producerState, "paused")
+        self.assertEqual(limit_hits, ["http"])
+
+        queue.get_nowait()
+        self.assertEqual(transport.producerState, "producing")
+
+
+class DummyProtocol:
+    def __init__(self, manager):
+        self.manager = manager
+        self.closed_with = None
+        self.cleaned_up = False
+
+    def handle_reply(self, msg):
+        pass
+
+    def close_connection(self, code):
+        self.closed_with = code
+        self.manager.application_queues[self].put_nowait(
+            {"type": "websocket.disconnect", "code": code}
+        )
+
+    def do_cleanup(self):
+        self.cleaned_up = True
+        return self.manager.finish_protocol(self)
+
+
+async def wait_for_disconnect(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] in ("http.disconnect", "websocket.disconnect"):
+            return
+
+
+class TestDrain(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.manager = ApplicationManager(
+            wait_for_disconnect,
+            drain_timeout=5,
+            close_batch_size=2,
+            close_batch_interval=1,
+        )
+        self.manager.clock = self.clock
+
+    def start(self, scope_type):
+        protocol = DummyProtocol(self.manager)
+        self.manager.create_application_instance(
+            protocol, {"type": scope_type, "path": "/"}
+        )
+        return protocol
+
+    @defer.inlineCallbacks
+    def test_instances_finish_before_deadline(self):
+        protocol = self.start("http")
+        d = self.manager.stop()
+        yield sleep(0)[0]
+        self.assertTrue(self.manager.draining)
+        self.assertNoResult(d)
+
+        self.manager.application_queues[protocol].put_nowait(
+            {"type": "http.disconnect"}
+        )
+        yield sleep(0)[0]
+        yield sleep(0)[0]
+        self.assertFalse(self.clock.getDelayedCalls())
+        yield d
+        self.assertFalse(self.manager.application_instances)
+
+    @defer.inlineCallbacks
+    def test_deadline_cancels(self):
+        protocol = self.start("http")
+        d = self.manager.stop()
+        yield sleep(0)[0]
+        self.assertFalse(protocol.cleaned_up)
+
+        self.clock.advance(5)
+        yield d
+        self.assertTrue(protocol.cleaned_up)
+
+    @defer.inlineCallbacks
+    def test_websockets_closed_in_batches(self):
+        protocols = [self.start("websocket") for _ in range(3)]
+        d = self.manager.stop()
+        self.assertEqual([p.closed_with for p in protocols], [1012, 1012, None])
+
+        self.clock.advance(1)
+        self.assertEqual([p.closed_with for p in protocols], [1012, 1012, 1012])
+
+        yield sleep(0)[0]
+        yield sleep(0)[0]
+        self.assertFalse(self.clock.getDelayedCalls())
+        yield d
+
+    def test_new_requests_refused(self):
+        resource = ASGIResource(None)
+        self.addCleanup(resource.ws_factory.stopFactory)
+        resource.application.draining = True
+
+        request = DummyRequest([b""])
+        resource.render(request)
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b"connection"), [b"close"]
+        )
@@ -0,0 +1,213 @@
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from ..cache import ResponseCache, get_max_age
+from ..http import ASGIHTTPResource
+from ..utils import sleep
+from .utils import DummyApplication, DummyRequest
+
+CACHEABLE = [
+    [b"cache-control", b"public, max-age=60"],
+    [b"etag", b'"v1"'],
+    [b"vary", b"Accept-Language"],
+]
+
+
+class TestGetMaxAge(TestCase):
+    def test_max_age(self):
+        self.assertEqual(get_max_age(200, CACHEABLE), 60)
+        self.assertEqual(
+            get_max_age(200, [[b"Cache-Control", b"public, max-age=60, s-maxage=5"]]),
+            5,
+        )
+
+    def test_not_cacheable(self):
+        self.assertIsNone(get_max_age(404, CACHEABLE))
+        self.assertIsNone(get_max_age(200, [[b"cache-control", b"max-age=60"]]))
+        self.assertIsNone(
+            get_max_age(200, [[b"cache-control", b"public, no-store, max-age=60"]])
+        )
+        self.assertIsNone(get_max_age(200, CACHEABLE + [[b"set-cookie", b"a=b"]]))
+        self.assertIsNone(get_max_age(200, CACHEABLE + [[b"vary", b"*"]]))
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        self.application = DummyApplication()
+        self.cache = ResponseCache(max_size=1024, max_entry_size=100)
+        self.cache.clock = self.clock = task.Clock()
+        self.resources = []
+
+    def tearDown(self):
+        for resource in self.resources:
+            resource.do_cleanup()
+
+    def request(self, *headers, method="GET"):
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": "/page",
+            "query_string": b"a=b",
+            "headers": [[b"accept-language", b"en"]] + list(headers),
+        }
+        request = DummyRequest([b"page"])
+        request.method = method.encode("ascii")
+        for name, value in headers:
+            request.requestHeaders.addRawHeader(name, value)
+        resource = ASGIHTTPResource(self.application, scope, 1, cache=self.cache)
+        resource.clock = self.clock
+        resource.render(request)
+        self.resources.append(resource)
+        return resource, request
+
+    def respond(self, resource, headers=CACHEABLE, body=b"result", status=200):
+        resource.handle_reply(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        resource.handle_reply({"type": "http.response.body", "body": body})
+
+    @defer.inlineCallbacks
+    def test_hit_skips_application(self):
+        resource, request = self.request()
+        self.respond(resource)
+        yield request.notifyFinish()
+        self.assertEqual(len(self.cache.entries), 1)
+
+        self.application.scope = None
+        self.clock.advance(10)
+        resource, request = self.request()
+        self.assertIsNone(self.application.scope)
+        self.assertTrue(request.finished)
+        self.assertEqual(request.written, [b"result"])
+        self.assertEqual(request.responseHeaders.getRawHeaders(b"age"), [b"10"])
+        self.assertEqual(request.responseHeaders.getRawHeaders(b"etag"), [b'"v1"'])
+
+    @defer.inlineCallbacks
+    def test_vary_and_method_are_keyed(self):
+        resource, request = self.request()
+        self.respond(resource)
+        yield request.notifyFinish()
+
+        self.application.scope = None
+        self.request([b"accept-language", b"de"])
+        self.assertIsNotNone(self.application.scope)
+
+        self.application.scope = None
+        self.request(method="HEAD")
+        self.assertIsNotNone(self.application.scope)
+
+    @defer.inlineCallbacks
+    def test_if_none_match_gets_304(self):
+        resource, request = self.request()
+        self.respond(resource)
+        yield request.notifyFinish()
+
+        resource, request = self.request([b"if-none-match", b'"v1"'])
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(request.written, [])
+
+    @defer.inlineCallbacks
+    def test_expired_entry_is_revalidated(self):
+        resource, request = self.request()
+        self.respond(resource)
+        yield request.notifyFinish()
+
+        self.clock.advance(61)
+        resource, request = self.request()
+        self.assertIn([b"if-none-match", b'"v1"'], self.application.scope["headers"])
+        resource.handle_reply(
+            {"type": "http.response.start", "status": 304, "headers": CACHEABLE}
+        )
+        yield request.notifyFinish()
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(request.written, [b"result"])
+
+        self.application.scope = None
+        self.clock.advance(30)
+        self.request()
+        self.assertIsNone(self.application.scope)
+
+    @defer.inlineCallbacks
+    def test_concurrent_misses_are_coalesced(self):
+        resource, first = self.request()
+        self.application.scope = None
+        _, second = self.request()
+        self.assertIsNone(self.application.scope)
+        self.assertFalse(second.finished)
+
+        self.respond(resource)
+        yield first.notifyFinish()
+        self.assertTrue(second.finished)
+        self.assertEqual(second.written, [b"result"])
+
+    @defer.inlineCallbacks
+    def test_coalesced_request_with_other_vary_value(self):
+        resource, first = self.request()
+        self.application.scope = None
+        self.request([b"accept-language", b"de"])  # Vary is not known yet
+        self.assertIsNone(self.application.scope)
+
+        self.respond(resource)
+        yield first.notifyFinish()
+        self.assertIn([b"accept-language", b"de"], self.application.scope["headers"])
+
+    @defer.inlineCallbacks
+    def test_uncacheable_response_releases_waiters(self):
+        resource, first = self.request()
+        self.application.scope = None
+        self.request()
+
+        self.respond(resource, headers=[])
+        yield first.notifyFinish()
+        self.assertIsNotNone(self.application.scope)
+        self.assertFalse(self.cache.entries)
+        self.assertFalse(self.cache.in_flight)
+
+    @defer.inlineCallbacks
+    def test_lru_eviction_by_size(self):
+        for i in range(12):
+            resource, request = self.request([b"x-i", str(i).encode("ascii")])
+            self.respond(resource, CACHEABLE + [[b"vary", b"x-i"]], body=b"x" * 90)
+            yield request.notifyFinish()
+
+        self.assertLessEqual(self.cache.size, 1024)
+        self.assertLess(len(self.cache.entries), 12)
+        self.assertEqual(list(self.cache.entries)[-1][-1], b"11")
+
+        resource, request = self.request()
+        self.respond(resource, body=b"x" * 101)
+        yield request.notifyFinish()
+        self.assertNotIn(("GET", "/page", b"a=b", b"en", b""), self.cache.entries)
+
+    @defer.inlineCallbacks
+    def test_uncacheable_stream_does_not_hold_back_others(self):
+        resource, first = self.request()
+        self.application.scope = None
+        self.request()
+        self.assertIsNone(self.application.scope)
+
+        resource.handle_reply(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [[b"cache-control", b"no-store"]],
+            }
+        )
+        resource.handle_reply(
+            {"type": "http.response.body", "body": b"event", "more_body": True}
+        )
+        yield sleep(0)[0]
+
+        self.assertFalse(first.finished)
+        self.assertIsNotNone(self.application.scope)
+        self.assertFalse(self.cache.in_flight)
+
+    def test_waiting_is_bounded_by_timeout(self):
+        self.request()
+        self.application.scope = None
+        self.request()
+        self.assertIsNone(self.application.scope)
+
+        self.clock.advance(1)
+        self.assertIsNotNone(self.application.scope)
+        self.assertEqual(self.cache.in_flight, {("GET", "/page", b"a=b"): []})
@@ -0,0 +1,164 @@
+import zlib
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from ..compression import ResponseCompression, parse_accept_encoding
+from ..http import ASGIHTTPResource
+from ..utils import sleep
+from .utils import DummyApplication, DummyRequest
+
+
+class TestResponseCompression(TestCase):
+    def setUp(self):
+        self.application = DummyApplication()
+        self.scope = {
+            "type": "http",
+            "scheme": "http",
+            "http_version": "1.1",
+            "method": "GET",
+            "path": "/",
+        }
+        self.compression = ResponseCompression(minimum_size=10, thread_size=None)
+        self.compression.encodings = [b"gzip"]
+
+    def render(self, accept_encoding=b"gzip, deflate"):
+        request = DummyRequest([b""])
+        if accept_encoding:
+            request.requestHeaders.addRawHeader(b"accept-encoding", accept_encoding)
+        resource = ASGIHTTPResource(
+            self.application, self.scope, 1, compression=self.compression
+        )
+        resource.render(request)
+        return request, resource
+
+    def start(self, resource, content_type=b"text/plain", headers=None):
+        resource.handle_reply(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [[b"content-type", content_type]] + (headers or []),
+            }
+        )
+
+    def test_parse_accept_encoding(self):
+        self.assertEqual(
+            parse_accept_encoding(b"gzip;q=0.5, br, identity;q=0, x;q=bad"),
+            {b"gzip": 0.5, b"br": 1.0, b"identity": 0.0, b"x": 0.0},
+        )
+
+    def test_negotiate(self):
+        self.compression.encodings = [b"br", b"gzip"]
+        self.assertEqual(self.compression.negotiate(b"gzip, br"), b"br")
+        self.assertEqual(self.compression.negotiate(b"gzip, br;q=0.5"), b"gzip")
+        self.assertEqual(self.compression.negotiate(b"*"), b"br")
+        self.assertIsNone(self.compression.negotiate(b"gzip;q=0, br;q=0"))
+        self.assertIsNone(self.compression.negotiate(b"identity"))
+        self.assertIsNone(self.compression.negotiate(None))
+
+    @defer.inlineCallbacks
+    def test_streamed_response(self):
+        request, resource = self.render()
+        self.start(resource, headers=[[b"etag", b'"abc"']])
+        resource.handle_reply(
+            {"type": "http.response.body", "body": b"a" * 100, "more_body": True}
+        )
+        yield sleep(0)[0]
+
+        # the first chunk is flushed before the response is done
+        decompressor = zlib.decompressobj(31)
+        self.assertEqual(decompressor.decompress(b"".join(request.written)), b"a" * 100)
+
+        resource.handle_reply({"type": "http.response.body", "body": b"b" * 100})
+        yield request.notifyFinish()
+
+        self.assertEqual(
+            zlib.decompress(b"".join(request.written), 31), b"a" * 100 + b"b" * 100
+        )
+        headers = request.responseHeaders
+        self.assertEqual(headers.getRawHeaders(b"content-encoding"), [b"gzip"])
+        self.assertEqual(headers.getRawHeaders(b"vary"), [b"Accept-Encoding"])
+        self.assertEqual(headers.getRawHeaders(b"etag"), [b'W/"abc"'])
+
+    @defer.inlineCallbacks
+    def test_content_length_removed(self):
+        request, resource = self.render()
+        self.start(resource, headers=[[b"content-length", b"100"]])
+        resource.handle_reply({"type": "http.response.body", "body": b"a" * 100})
+        yield request.notifyFinish()
+
+        self.assertFalse(request.responseHeaders.hasHeader(b"content-length"))
+        self.assertEqual(zlib.decompress(b"".join(request.written), 31), b"a" * 100)
+
+    @defer.inlineCallbacks
+    def test_not_compressed(self):
+        for accept_encoding, content_type, headers, body in [
+            (None, b"text/plain", [], b"a" * 100),
+            (b"gzip", b"image/png", [], b"a" * 100),
+            (b"gzip", b"text/plain", [[b"content-encoding", b"br"]], b"a" * 100),
+            (b"gzip", b"text/plain", [[b"content-length", b"5"]], b"short"),
+            (b"gzip", b"text/plain", [], b"short"),
+        ]:
+            request, resource = self.render(accept_encoding)
+            self.start(resource, content_type, headers)
+            resource.handle_reply({"type": "http.response.body", "body": body})
+            yield request.notifyFinish()
+
+            self.assertEqual(b"".join(request.written), body)
+            self.assertNotEqual(
+                request.responseHeaders.getRawHeaders(b"content-encoding"), [b"gzip"]
+            )
+
+    @defer.inlineCallbacks
+    def test_error_responses_not_compressed(self):
+        for status in (404, 500):
+            request, resource = self.render()
+            resource.handle_reply(
+                {
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [[b"content-type", b"text/html"]],
+                }
+            )
+            resource.handle_reply({"type": "http.response.body", "body": b"a" * 100})
+            yield request.notifyFinish()
+
+            self.assertEqual(b"".join(request.written), b"a" * 100)
+            self.assertFalse(request.responseHeaders.hasHeader(b"content-encoding"))
+
+    @defer.inlineCallbacks
+    def test_flushed_when_transport_is_writable(self):
+        request, resource = self.render()
+        self.start(resource)
+        yield sleep(0)[0]
+        request.producer.pauseProducing()
+        resource.handle_reply(
+            {"type": "http.response.body", "body": b"a" * 100, "more_body": True}
+        )
+        yield sleep(0)[0]
+
+        # nothing can be sent yet, the compressor keeps the chunk
+        decompressor = zlib.decompressobj(31)
+        self.assertEqual(decompressor.decompress(b"".join(request.written)), b"")
+
+        written = len(request.written)
+        request.producer.resumeProducing()
+        self.assertEqual(
+            decompressor.decompress(b"".join(request.written[written:])), b"a" * 100
+        )
+
+        resource.handle_reply({"type": "http.response.body", "body": b"b" * 100})
+        yield request.notifyFinish()
+        self.assertEqual(
+            zlib.decompress(b"".join(request.written), 31), b"a" * 100 + b"b" * 100
+        )
+
+    @defer.inlineCallbacks
+    def test_compress_in_thread(self):
+        self.compression.thread_size = 50
+        request, resource = self.render()
+        self.start(resource)
+        resource.handle_reply({"type": "http.response.body", "body": b"a" * 100})
+        yield request.notifyFinish()
+
+        self.assertEqual(zlib.decompress(b"".join(request.written), 31), b"a" * 100)
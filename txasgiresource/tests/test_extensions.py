@@ -0,0 +1,132 @@
+import os
+import tempfile
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from ..utils import sleep
+from .utils import HTTPChannelTestMixin
+
+
+class TestResponseExtensions(HTTPChannelTestMixin, TestCase):
+    def setUp(self):
+        HTTPChannelTestMixin.setUp(self)
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, b"0123456789")
+        os.close(fd)
+
+    def tearDown(self):
+        HTTPChannelTestMixin.tearDown(self)
+        os.remove(self.path)
+
+    def request(self, version=b"HTTP/1.1"):
+        self.channel.dataReceived(b"GET / " + version + b"\r\nHost: dummy\r\n\r\n")
+        return self.application.protocol
+
+    @defer.inlineCallbacks
+    def wait(self):
+        for _ in range(3):
+            yield sleep(0)[0]
+
+    def test_extensions_advertised(self):
+        self.request()
+        self.assertIn("http.response.trailers", self.application.scope["extensions"])
+        self.assertIn("http.response.pathsend", self.application.scope["extensions"])
+
+    def test_no_trailers_for_http10(self):
+        self.request(b"HTTP/1.0")
+        self.assertNotIn("http.response.trailers", self.application.scope["extensions"])
+        self.assertIn(
+            "http.response.zerocopysend", self.application.scope["extensions"]
+        )
+
+    @defer.inlineCallbacks
+    def test_trailers(self):
+        protocol = self.request()
+        protocol.handle_reply(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [[b"trailer", b"x-checksum"]],
+                "trailers": True,
+            }
+        )
+        protocol.handle_reply(
+            {"type": "http.response.body", "body": b"result", "more_body": False}
+        )
+        yield self.wait()
+        self.assertFalse(self.transport.value().endswith(b"0\r\n\r\n"))
+
+        protocol.handle_reply(
+            {
+                "type": "http.response.trailers",
+                "headers": [[b"x-checksum", b"abc"]],
+                "more_trailers": False,
+            }
+        )
+        yield self.wait()
+
+        response = self.transport.value()
+        self.assertIn(b"Transfer-Encoding: chunked", response)
+        self.assertTrue(
+            response.endswith(b"6\r\nresult\r\n0\r\nx-checksum: abc\r\n\r\n")
+        )
+
+    @defer.inlineCallbacks
+    def test_pathsend(self):
+        protocol = self.request()
+        protocol.handle_reply(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [[b"content-length", b"10"]],
+            }
+        )
+        d = protocol.handle_reply({"type": "http.response.pathsend", "path": self.path})
+        self.assertNoResult(d)
+        yield d
+        yield self.wait()
+
+        response = self.transport.value()
+        self.assertTrue(response.endswith(b"\r\n\r\n0123456789"))
+        self.assertTrue(self.application.finished)
+
+    @defer.inlineCallbacks
+    def test_zerocopysend(self):
+        protocol = self.request()
+        protocol.handle_reply(
+            {"type": "http.response.start", "status": 200, "headers": []}
+        )
+        protocol.handle_reply(
+            {"type": "http.response.body", "body": b"<", "more_body": True}
+        )
+        # send() only returns once the file is sent, it can be closed right after
+        with open(self.path, "rb") as f:
+            d = protocol.handle_reply(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": 2,
+                    "count": 3,
+                    "more_body": True,
+                }
+            )
+            self.assertNoResult(d)
+            yield d
+        protocol.handle_reply({"type": "http.response.body", "body": b">"})
+        yield self.wait()
+
+        response = self.transport.value()
+        self.assertTrue(response.endswith(b"1\r\n<\r\n3\r\n234\r\n1\r\n>\r\n0\r\n\r\n"))
+        self.assertTrue(self.application.finished)
+
+    @defer.inlineCallbacks
+    def test_file_send_after_response_finished(self):
+        protocol = self.request()
+        protocol.handle_reply(
+            {"type": "http.response.start", "status": 200, "headers": []}
+        )
+        protocol.handle_reply({"type": "http.response.body", "body": b"done"})
+        d = protocol.handle_reply({"type": "http.response.pathsend", "path": self.path})
+        yield self.wait()
+        self.successResultOf(d)
@@ -0,0 +1,102 @@
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.trial.unittest import TestCase
+from twisted.web import server
+
+from ..asgiresource import ASGIResource
+from ..metrics import Metrics
+from ..utils import sleep
+from .utils import DummyApplication, upgrade_websocket
+
+
+class TestGroups(TestCase):
+    def setUp(self):
+        self.application = DummyApplication()
+        self.application.metrics = Metrics()
+        self.resource = ASGIResource(None, broadcast_max_buffer_size=100)
+        self.resource.application = self.resource.ws_factory.application = (
+            self.application
+        )
+        self.site = server.Site(self.resource)
+        self.transports = []
+
+    def tearDown(self):
+        for transport in self.transports:
+            transport.protocol.replies.cancel()
+            transport.protocol.connectionLost(failure.Failure(Exception()))
+        self.resource.ws_factory.stopFactory()
+
+    @defer.inlineCallbacks
+    def connect(self, group):
+        _, transport = upgrade_websocket(self.site)
+        self.transports.append(transport)
+        self.assertIn("websocket.broadcast", self.application.scope["extensions"])
+
+        protocol = transport.protocol
+        protocol.handle_reply({"type": "websocket.accept"})
+        protocol.handle_reply({"type": "websocket.group.add", "group": group})
+        yield sleep(0)[0]
+        transport.clear()
+        defer.returnValue(protocol)
+
+    @defer.inlineCallbacks
+    def test_broadcast(self):
+        sender = yield self.connect("chat")
+        receiver = yield self.connect("chat")
+        other = yield self.connect("other")
+
+        sender.handle_reply(
+            {
+                "type": "websocket.broadcast",
+                "group": "chat",
+                "text": "hello",
+                "exclude_self": True,
+            }
+        )
+        yield sleep(0)[0]
+
+        self.assertEqual(receiver.transport.value(), b"\x81\x05hello")
+        self.assertEqual(sender.transport.value(), b"")
+        self.assertEqual(other.transport.value(), b"")
+
+        sent = self.resource.groups.broadcast("chat", bytes=b"\x00\x01")
+        self.assertEqual(sent, 2)
+        self.assertEqual(sender.transport.value(), b"\x82\x02\x00\x01")
+
+    @defer.inlineCallbacks
+    def test_slow_members_are_skipped(self):
+        fast = yield self.connect("feed")
+        slow = yield self.connect("feed")
+        # StringTransport is no TCP transport, it only pauses its producer
+        self.assertIs(slow.transport.producer, slow)
+        slow.transport.producer.pauseProducing()
+
+        groups = self.resource.groups
+        self.assertEqual(groups.broadcast("feed", text="x" * 60), 2)
+        slow.transport.clear()
+        self.assertEqual(groups.broadcast("feed", text="x" * 60), 1)
+        self.assertEqual(slow.transport.value(), b"")
+        self.assertEqual(
+            self.application.metrics.counters[("txasgi_broadcast_skipped_total", ())],
+            1,
+        )
+
+        slow.transport.producer.resumeProducing()
+        self.assertEqual(groups.broadcast("feed", text="tick"), 2)
+        self.assertEqual(slow.transport.value(), b"\x81\x04tick")
+
+    @defer.inlineCallbacks
+    def test_broadcast_needs_payload(self):
+        yield self.connect("chat")
+        self.assertRaises(ValueError, self.resource.groups.broadcast, "chat")
+
+    @defer.inlineCallbacks
+    def test_members_are_removed(self):
+        protocol = yield self.connect("room")
+        protocol.handle_reply({"type": "websocket.group.add", "group": "lobby"})
+        protocol.handle_reply({"type": "websocket.group.discard", "group": "room"})
+        yield sleep(0)[0]
+        self.assertEqual(self.resource.groups.groups, {"lobby": {protocol}})
+
+        protocol.do_cleanup()
+        self.assertEqual(self.resource.groups.groups, {})
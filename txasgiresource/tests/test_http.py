@@ -7,15 +7,22 @@ from twisted.python import failure
 from twisted.trial.unittest import TestCase
 
 from .. import http as asgihttp
+from ..asgiresource import ASGIResource
 from ..http import ASGIHTTPResource
 from ..utils import sleep
-from .utils import DummyApplication, DummyRequest
+from .utils import DummyApplication, DummyRequest, HTTPChannelTestMixin
 
 
 class TestASGIHTTP(TestCase):
     def setUp(self):
         self.application = DummyApplication()
-        self.base_scope = {"_ssl": "", "path": "/"}
+        self.scope = {
+            "type": "http",
+            "scheme": "http",
+            "http_version": "1.0",
+            "method": "GET",
+            "path": "/",
+        }
         self._prepare_request()
         self.temp_path = tempfile.mkdtemp()
 
@@ -24,7 +31,7 @@ class TestASGIHTTP(TestCase):
         self.request.uri = b"http://dummy/test/path?a=b"
         self.request_finished_defer = self.request.notifyFinish()
         self.resource = ASGIHTTPResource(
-            self.application, self.base_scope, 1, use_x_sendfile=True
+            self.application, self.scope, 1, use_x_sendfile=True
         )
 
     def tearDown(self):
@@ -76,6 +83,55 @@ class TestASGIHTTP(TestCase):
         self.assertEqual(self.request.written[0], b"this is the result")
         self.assertEqual(self.request.responseCode, 200)
 
+    @defer.inlineCallbacks
+    def test_http_response_backpressure(self):
+        self.resource.render(self.request)
+        self.assertIsNone(
+            self.resource.handle_reply(
+                {"type": "http.response.start", "status": 200, "headers": []}
+            )
+        )
+        yield sleep(0)[0]
+        self.assertIs(self.request.producer, self.resource)
+
+        self.request.producer.pauseProducing()
+        d = self.resource.handle_reply(
+            {"type": "http.response.body", "body": b"chunk 1", "more_body": True}
+        )
+        self.assertFalse(d.called)
+        yield sleep(0)[0]
+        self.assertEqual(self.request.written, [b"chunk 1"])
+
+        self.request.producer.resumeProducing()
+        self.assertTrue(d.called)
+
+        self.assertIsNone(
+            self.resource.handle_reply(
+                {"type": "http.response.body", "body": b"chunk 2"}
+            )
+        )
+        yield self.request_finished_defer
+
+        self.assertEqual(self.request.written, [b"chunk 1", b"chunk 2"])
+        self.assertIsNone(self.request.producer)
+
+    @defer.inlineCallbacks
+    def test_http_response_batched_body(self):
+        self.resource.render(self.request)
+        self.resource.handle_reply(
+            {"type": "http.response.start", "status": 200, "headers": []}
+        )
+        for i in range(3):
+            self.resource.handle_reply(
+                {"type": "http.response.body", "body": b"%i" % i, "more_body": True}
+            )
+        self.resource.handle_reply({"type": "http.response.body", "body": b"end"})
+        self.resource.handle_reply({"type": "http.response.body", "body": b"ignored"})
+
+        yield self.request_finished_defer
+
+        self.assertEqual(self.request.written, [b"012end"])
+
     @defer.inlineCallbacks
     def test_timeout(self):
         self.resource.render(self.request)
@@ -89,7 +145,7 @@ class TestASGIHTTP(TestCase):
     @defer.inlineCallbacks
     def test_cancel_defer(self):
         self.resource.render(self.request)
-        self.resource.reply_defer.cancel()
+        self.resource.replies.cancel()
 
         yield self.request_finished_defer
 
@@ -131,7 +187,7 @@ class TestASGIHTTP(TestCase):
             },
         )
 
-        self.resource.reply_defer.cancel()
+        self.resource.replies.cancel()
         try:
             yield self.request_finished_defer
         except:
@@ -221,3 +277,112 @@ class TestASGIHTTP(TestCase):
         yield self.request_finished_defer
 
         self.assertEqual(self.request.responseCode, 404)
+
+
+class TestASGIResourceScope(TestCase):
+    def setUp(self):
+        self.application = DummyApplication()
+        self.resource = ASGIResource(None, root_path="/root")
+        self.resource.application = self.application
+
+    def tearDown(self):
+        protocol = getattr(self.application, "protocol", None)
+        if protocol is not None:
+            protocol.replies.cancel()
+        self.resource.ws_factory.stopFactory()
+
+    def test_http_scope(self):
+        request = DummyRequest([b"test", b"p\xc3\xa5th"])
+        request.uri = b"/test/p%C3%A5th?a=b"
+        request.method = b"POST"
+        request.clientproto = b"HTTP/1.1"
+        request.requestHeaders.addRawHeader(b"X-Test", b"1")
+        request.requestHeaders.addRawHeader(b"X-Test", b"2")
+        request.requestHeaders.addRawHeader(b"X_Spoofed", b"nope")
+        self.resource.render(request)
+
+        self.assertEqual(
+            self.application.scope,
+            {
+                "type": "http",
+                "asgi": {"version": "3.0", "spec_version": "2.0"},
+                "scheme": "http",
+                "http_version": "1.1",
+                "method": "POST",
+                "path": "/test/p\xe5th",
+                "raw_path": b"/test/p%C3%A5th",
+                "query_string": b"a=b",
+                "root_path": "/root",
+                "headers": [[b"x-test", b"1"], [b"x-test", b"2"]],
+                "client": None,
+                "server": None,
+                "extensions": {
+                    "http.response.trailers": {},
+                    "http.response.zerocopysend": {},
+                    "http.response.pathsend": {},
+                },
+            },
+        )
+
+    def test_websocket_is_detected(self):
+        request = DummyRequest([b""])
+        request.requestHeaders.addRawHeader(b"Upgrade", b"WebSocket")
+        request.requestHeaders.addRawHeader(b"Sec-WebSocket-Protocol", b"a, b")
+        dispatched = []
+        self.resource.dispatch_websocket = lambda request, scope: dispatched.append(
+            scope
+        )
+        self.resource.render(request)
+
+        self.assertEqual(dispatched[0]["type"], "websocket")
+        self.assertEqual(dispatched[0]["scheme"], "ws")
+        self.assertEqual(dispatched[0]["subprotocols"], ["a ", "b "])
+        self.assertEqual(dispatched[0]["query_string"], b"")
+
+
+class TestASGIHTTPStreaming(HTTPChannelTestMixin, TestCase):
+    def test_streamed_body(self):
+        self.channel.dataReceived(
+            b"POST /test/path HTTP/1.1\r\nHost: dummy\r\nContent-Length: 10\r\n\r\n"
+        )
+        self.assertEqual(self.application.scope["method"], "POST")
+        self.assertEqual(self.application.scope["path"], "/test/path")
+        self.assertTrue(self.application.queue.empty())
+
+        self.channel.dataReceived(b"12345")
+        self.assertEqual(
+            self.application.queue.get_nowait(),
+            {"type": "http.request", "body": b"12345", "more_body": True},
+        )
+
+        self.channel.dataReceived(b"67890")
+        self.assertEqual(
+            self.application.queue.get_nowait(),
+            {"type": "http.request", "body": b"67890", "more_body": True},
+        )
+        self.assertEqual(
+            self.application.queue.get_nowait(),
+            {"type": "http.request", "body": b"", "more_body": False},
+        )
+
+    def test_streamed_body_pauses_transport(self):
+        self.channel.dataReceived(
+            b"POST / HTTP/1.1\r\nHost: dummy\r\nContent-Length: 10\r\n\r\n"
+        )
+        self.application.queue.limit = 2
+
+        self.channel.dataReceived(b"123")
+        self.assertEqual(self.transport.producerState, "producing")
+        self.channel.dataReceived(b"456")
+        self.assertEqual(self.transport.producerState, "paused")
+
+        self.application.queue.get_nowait()
+        self.assertEqual(self.transport.producerState, "producing")
+
+    def test_empty_body_is_not_streamed(self):
+        self.channel.dataReceived(b"GET / HTTP/1.1\r\nHost: dummy\r\n\r\n")
+        self.assertEqual(
+            self.application.queue.get_nowait(),
+            {"type": "http.request", "body": b"", "more_body": False},
+        )
+        self.assertTrue(self.application.queue.empty())
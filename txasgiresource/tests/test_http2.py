@@ -0,0 +1,143 @@
+from twisted.internet import defer
+from twisted.internet.testing import StringTransport
+from twisted.python import failure
+from twisted.trial.unittest import TestCase
+from twisted.web import http, server
+
+from ..asgiresource import ASGIResource
+from ..http import ASGIRequest
+from ..utils import sleep
+from .utils import DummyApplication
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    from twisted.web._http2 import H2Connection
+except ImportError:
+    h2 = None
+
+
+class TestHTTP2(TestCase):
+    if h2 is None or not http.H2_ENABLED:
+        skip = "HTTP/2 support requires the h2 module"
+
+    def setUp(self):
+        self.application = DummyApplication()
+        self.resource = ASGIResource(None)
+        self.resource.application = self.application
+        self.site = server.Site(self.resource, requestFactory=ASGIRequest)
+
+        self.connection = H2Connection()
+        self.connection.requestFactory = ASGIRequest
+        self.connection.site = self.site
+        self.connection.factory = self.site
+        self.transport = StringTransport()
+        self.connection.makeConnection(self.transport)
+
+        self.client = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=True)
+        )
+        self.client.initiate_connection()
+        self.flush_client()
+
+    def tearDown(self):
+        self.connection.connectionLost(failure.Failure(Exception()))
+
+    def flush_client(self):
+        self.connection.dataReceived(self.client.data_to_send())
+
+    def client_events(self):
+        data = self.transport.value()
+        self.transport.clear()
+        events = self.client.receive_data(data)
+        self.flush_client()
+        return events
+
+    def request(self, method, end_stream=True):
+        self.client.send_headers(
+            1,
+            [
+                (":method", method),
+                (":path", "/test/path?a=b"),
+                (":authority", "dummy"),
+                (":scheme", "https"),
+            ],
+            end_stream=end_stream,
+        )
+        self.flush_client()
+
+    @defer.inlineCallbacks
+    def test_request(self):
+        self.request("GET")
+        self.assertEqual(self.application.scope["http_version"], "2")
+        self.assertEqual(self.application.scope["path"], "/test/path")
+        self.assertEqual(self.application.scope["query_string"], b"a=b")
+        self.assertEqual(
+            self.application.queue.get_nowait(),
+            {"type": "http.request", "body": b"", "more_body": False},
+        )
+
+        self.application.protocol.handle_reply(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [[b"connection", b"keep-alive"], [b"x-test", b"yes"]],
+            }
+        )
+        self.application.protocol.handle_reply(
+            {"type": "http.response.body", "body": b"result"}
+        )
+        yield sleep(0)[0]
+        events = self.client_events()
+        yield sleep(0)[0]  # data is sent by the connection in a later turn
+        events += self.client_events()
+
+        response = [e for e in events if isinstance(e, h2.events.ResponseReceived)][0]
+        headers = dict(response.headers)
+        self.assertEqual(headers[b":status"], b"200")
+        self.assertEqual(headers[b"x-test"], b"yes")
+        self.assertNotIn(b"connection", headers)
+
+        data = [e for e in events if isinstance(e, h2.events.DataReceived)]
+        self.assertEqual(b"".join(e.data for e in data), b"result")
+        self.assertTrue([e for e in events if isinstance(e, h2.events.StreamEnded)])
+
+    def test_streamed_body_pauses_stream(self):
+        self.request("POST", end_stream=False)
+        self.assertEqual(self.application.scope["method"], "POST")
+        self.assertEqual(self.application.scope["http_version"], "2")
+        self.application.queue.limit = 1
+
+        self.client.send_data(1, b"12345")
+        self.flush_client()
+        self.assertEqual(
+            self.application.queue.get_nowait(),
+            {"type": "http.request", "body": b"12345", "more_body": True},
+        )
+
+        self.client.send_data(1, b"67890")
+        self.flush_client()
+
+        # only the stream is paused, the connection keeps reading
+        stream = self.connection.streams[1]
+        self.assertFalse(stream.producing)
+        self.assertEqual(self.transport.producerState, "producing")
+
+        self.client.send_data(1, b"abcde", end_stream=True)
+        self.flush_client()
+        self.assertEqual(self.application.queue.qsize(), 1)
+
+        self.assertEqual(
+            self.application.queue.get_nowait(),
+            {"type": "http.request", "body": b"67890", "more_body": True},
+        )
+        self.assertEqual(
+            self.application.queue.get_nowait(),
+            {"type": "http.request", "body": b"abcde", "more_body": True},
+        )
+        self.assertEqual(
+            self.application.queue.get_nowait(),
+            {"type": "http.request", "body": b"", "more_body": False},
+        )
+        self.assertTrue(stream.producing)
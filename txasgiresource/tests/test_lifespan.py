@@ -0,0 +1,92 @@
+from concurrent.futures import Future
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from ..lifespan import Lifespan, LifespanError
+from .utils import DummyApplication
+
+
+class DummyLifespanApplication(DummyApplication):
+    def __init__(self):
+        self.application_instances = {}
+
+    def create_application_instance(self, protocol, scope):
+        queue = DummyApplication.create_application_instance(self, protocol, scope)
+        self.application_instances[protocol] = Future()
+        return queue
+
+    def finish_protocol(self, protocol):
+        DummyApplication.finish_protocol(self, protocol)
+        self.application_instances.pop(protocol, None)
+
+
+class TestLifespan(TestCase):
+    def setUp(self):
+        self.application = DummyLifespanApplication()
+        self.lifespan = Lifespan(self.application, timeout=10)
+        self.lifespan.clock = self.clock = task.Clock()
+
+    @defer.inlineCallbacks
+    def test_startup_and_shutdown(self):
+        d = self.lifespan.startup()
+        self.assertEqual(self.application.scope["type"], "lifespan")
+        self.assertEqual(
+            self.application.queue.get_nowait(), {"type": "lifespan.startup"}
+        )
+        self.assertFalse(d.called)
+
+        self.application.scope["state"]["pool"] = "a pool"
+        self.lifespan.handle_reply({"type": "lifespan.startup.complete"})
+        yield d
+        self.assertTrue(self.lifespan.supported)
+        self.assertEqual(self.lifespan.state, {"pool": "a pool"})
+
+        d = self.lifespan.shutdown()
+        self.assertEqual(
+            self.application.queue.get_nowait(), {"type": "lifespan.shutdown"}
+        )
+        self.assertFalse(self.application.finished)
+        self.lifespan.handle_reply({"type": "lifespan.shutdown.complete"})
+        yield d
+        self.assertTrue(self.application.finished)
+
+    @defer.inlineCallbacks
+    def test_startup_failed(self):
+        d = self.lifespan.startup()
+        self.lifespan.handle_reply(
+            {"type": "lifespan.startup.failed", "message": "no database"}
+        )
+        try:
+            yield d
+        except LifespanError as e:
+            self.assertEqual(str(e), "no database")
+        else:
+            self.fail("Did not raise an exception")
+        self.assertTrue(self.application.finished)
+
+    @defer.inlineCallbacks
+    def test_not_supported(self):
+        d = self.lifespan.startup()
+        self.application.application_instances[self.lifespan].set_exception(
+            KeyError("lifespan")
+        )
+        yield d
+        self.assertFalse(self.lifespan.supported)
+
+        yield self.lifespan.shutdown()
+        self.assertEqual(
+            self.application.queue.get_nowait(), {"type": "lifespan.startup"}
+        )
+        self.assertTrue(self.application.queue.empty())
+
+    @defer.inlineCallbacks
+    def test_startup_timeout(self):
+        d = self.lifespan.startup()
+        self.clock.advance(10)
+        try:
+            yield d
+        except defer.TimeoutError:
+            pass
+        else:
+            self.fail("Did not raise an exception")
@@ -0,0 +1,116 @@
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from ..application import ApplicationManager
+from ..http import ASGIHTTPResource
+from ..metrics import HTTP_LABELS, Metrics, MetricsResource
+from .utils import DummyApplication, DummyRequest
+
+
+class TestMetrics(TestCase):
+    def test_render_prometheus(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.increment("txasgi_http_requests_total")
+        metrics.increment("txasgi_bytes_sent_total", 10, HTTP_LABELS)
+        metrics.increment("txasgi_bytes_sent_total", 5, HTTP_LABELS)
+        metrics.observe("txasgi_http_duration_seconds", 0.05)
+        metrics.observe("txasgi_http_duration_seconds", 0.5)
+        metrics.observe("txasgi_http_duration_seconds", 5)
+        metrics.register_gauge(
+            "txasgi_active_instances", lambda: {(("type", "http"),): 3}
+        )
+
+        output = metrics.render_prometheus().splitlines()
+        self.assertIn("# TYPE txasgi_http_requests_total counter", output)
+        self.assertIn("txasgi_http_requests_total 1", output)
+        self.assertIn('txasgi_bytes_sent_total{protocol="http"} 15', output)
+        self.assertIn("# TYPE txasgi_active_instances gauge", output)
+        self.assertIn('txasgi_active_instances{type="http"} 3', output)
+        self.assertIn("# TYPE txasgi_http_duration_seconds histogram", output)
+        self.assertIn('txasgi_http_duration_seconds_bucket{le="0.1"} 1', output)
+        self.assertIn('txasgi_http_duration_seconds_bucket{le="1.0"} 2', output)
+        self.assertIn('txasgi_http_duration_seconds_bucket{le="+Inf"} 3', output)
+        self.assertIn("txasgi_http_duration_seconds_sum 5.55", output)
+        self.assertIn("txasgi_http_duration_seconds_count 3", output)
+
+    def test_metrics_resource(self):
+        metrics = Metrics()
+        metrics.increment("txasgi_http_requests_total")
+        request = DummyRequest([b""])
+        body = MetricsResource(metrics).render_GET(request)
+        self.assertIn(b"txasgi_http_requests_total 1\n", body)
+        self.assertTrue(
+            request.responseHeaders.getRawHeaders(b"content-type")[0].startswith(
+                b"text/plain"
+            )
+        )
+
+    def test_instance_gauges(self):
+        async def application(scope, receive, send):
+            await receive()
+
+        metrics = Metrics()
+        manager = ApplicationManager(application, metrics=metrics)
+        http_protocol, ws_protocol = object(), object()
+        queue = manager.create_application_instance(http_protocol, {"type": "http"})
+        queue.put_nowait({"type": "http.request"})
+        queue.put_nowait({"type": "http.request"})
+        manager.create_application_instance(ws_protocol, {"type": "websocket"})
+        manager.queue_limit_hit("websocket")
+
+        output = metrics.render_prometheus().splitlines()
+        self.assertIn('txasgi_active_instances{type="http"} 1', output)
+        self.assertIn('txasgi_active_instances{type="websocket"} 1', output)
+        self.assertIn('txasgi_queued_messages{type="http"} 2', output)
+        self.assertIn('txasgi_queue_limit_hits_total{type="websocket"} 1', output)
+
+        manager.finish_protocol(http_protocol)
+        manager.finish_protocol(ws_protocol)
+        self.assertEqual(manager.instance_stats(), ({}, {}))
+
+
+class TestHTTPMetrics(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ASGIHTTPResource, "clock", self.clock)
+        self.metrics = Metrics()
+        self.application = DummyApplication()
+        self.application.metrics = self.metrics
+        self.scope = {"type": "http", "method": "POST", "path": "/"}
+        self.request = DummyRequest([b""])
+        self.request.content.write(b"request body")
+        self.resource = ASGIHTTPResource(self.application, self.scope, 1)
+
+    def histogram(self, name):
+        return self.metrics.histograms[(name, ())]
+
+    def test_request(self):
+        self.resource.render(self.request)
+        self.clock.advance(0.2)
+        self.resource.handle_reply(
+            {"type": "http.response.start", "status": 200, "headers": []}
+        )
+        self.clock.advance(0)
+        self.clock.advance(0.3)
+        self.resource.handle_reply({"type": "http.response.body", "body": b"result"})
+        self.clock.advance(0)
+
+        self.assertTrue(self.request.finished)
+        self.assertEqual(self.histogram("txasgi_http_app_start_seconds").sum, 0)
+        self.assertAlmostEqual(
+            self.histogram("txasgi_http_first_byte_seconds").sum, 0.2
+        )
+        self.assertAlmostEqual(self.histogram("txasgi_http_duration_seconds").sum, 0.5)
+
+        counters = self.metrics.counters
+        self.assertEqual(counters[("txasgi_http_requests_total", ())], 1)
+        self.assertEqual(counters[("txasgi_bytes_received_total", HTTP_LABELS)], 12)
+        self.assertEqual(counters[("txasgi_bytes_sent_total", HTTP_LABELS)], 6)
+
+    def test_timeout(self):
+        self.resource.render(self.request)
+        self.clock.advance(1)
+
+        self.assertEqual(self.request.responseCode, 504)
+        self.assertEqual(self.metrics.counters[("txasgi_http_timeouts_total", ())], 1)
+        self.assertEqual(self.metrics.counters[("txasgi_http_requests_total", ())], 1)
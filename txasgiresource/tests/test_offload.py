@@ -0,0 +1,187 @@
+import asyncio
+import os
+import threading
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from ..application import ApplicationManager
+from ..offload import (
+    STOP_TIMEOUT,
+    ProcessWorkerPool,
+    ThreadWorkerPool,
+    decode_frames,
+    encode_frame,
+)
+from ..utils import sleep
+
+
+async def echo_application(scope, receive, send):
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == "/impatient":
+        try:
+            await asyncio.wait_for(receive(), 0.01)
+        except asyncio.TimeoutError:
+            return
+
+    message = await receive()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send(
+        {
+            "type": "http.response.body",
+            "body": message["body"],
+            "pid": os.getpid(),
+            "thread": threading.get_ident(),
+            "extensions": sorted(scope.get("extensions", {})),
+        }
+    )
+
+
+class DummyProtocol:
+    def __init__(self, path="/"):
+        self.scope = {"type": "http", "path": path}
+        self.replies = []
+
+    def handle_reply(self, msg):
+        self.replies.append(msg)
+
+
+class OffloadTestMixin:
+    @defer.inlineCallbacks
+    def run_instance(self, application, path="/"):
+        protocol = DummyProtocol(path)
+        queue = application.create_application_instance(protocol, protocol.scope)
+        queue.put_nowait({"type": "http.request", "body": b"hello"})
+        yield defer.Deferred.fromFuture(application.application_instances[protocol])
+        application.finish_protocol(protocol)
+        defer.returnValue(protocol.replies)
+
+
+class TestThreadWorkerPool(OffloadTestMixin, TestCase):
+    def setUp(self):
+        self.pool = ThreadWorkerPool(workers=2)
+        self.application = ApplicationManager(
+            echo_application, offload_pool=self.pool, offload_paths=["/heavy/"]
+        )
+
+    def tearDown(self):
+        return self.pool.stop()
+
+    @defer.inlineCallbacks
+    def test_offloaded_path(self):
+        replies = yield self.run_instance(self.application, "/heavy/report")
+        self.assertEqual(replies[0]["status"], 200)
+        self.assertEqual(replies[1]["body"], b"hello")
+        self.assertNotEqual(replies[1]["thread"], threading.get_ident())
+
+    @defer.inlineCallbacks
+    def test_other_path(self):
+        replies = yield self.run_instance(self.application, "/fast")
+        self.assertEqual(replies[1]["body"], b"hello")
+        self.assertEqual(replies[1]["thread"], threading.get_ident())
+
+    def test_should_offload(self):
+        self.assertTrue(self.application.should_offload(DummyProtocol("/heavy/").scope))
+        self.assertFalse(self.application.should_offload(DummyProtocol("/").scope))
+        self.assertFalse(self.application.should_offload({"type": "lifespan"}))
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        protocol = DummyProtocol("/heavy/")
+        self.application.create_application_instance(protocol, protocol.scope)
+        instance = self.application.application_instances[protocol]
+        yield defer.Deferred.fromFuture(asyncio.ensure_future(asyncio.sleep(0.05)))
+
+        self.application.finish_protocol(protocol)
+        try:
+            yield defer.Deferred.fromFuture(instance)
+        except asyncio.CancelledError:
+            pass
+        self.assertTrue(instance.cancelled())
+        self.assertEqual(self.pool.loops[0].active + self.pool.loops[1].active, 0)
+
+    @defer.inlineCallbacks
+    def test_stop_does_not_block_reactor(self):
+        self.pool.start()
+        worker = self.pool.loops[0]
+        worker.clock = clock = task.Clock()
+        blocked = threading.Event()
+        worker.loop.call_soon_threadsafe(blocked.wait)
+
+        d = self.pool.stop()
+        self.assertNoResult(d)
+        clock.advance(STOP_TIMEOUT)
+        yield d
+        self.assertTrue(worker.thread.is_alive())
+
+        blocked.set()
+        yield worker.stopped
+        worker.thread.join()
+
+
+class TestProcessWorkerPool(OffloadTestMixin, TestCase):
+    def setUp(self):
+        self.pool = ProcessWorkerPool(
+            "txasgiresource.tests.test_offload:echo_application", workers=1
+        )
+        self.application = ApplicationManager(echo_application, offload_pool=self.pool)
+
+    def tearDown(self):
+        return self.pool.stop()
+
+    def test_frames(self):
+        data = encode_frame("send", 1, {"type": "x"}) + encode_frame("sent", 1, None)
+        frames, rest = decode_frames(data[:-3])
+        self.assertEqual(frames, [("send", 1, {"type": "x"})])
+        frames, rest = decode_frames(rest + data[-3:])
+        self.assertEqual(frames, [("sent", 1, None)])
+        self.assertEqual(rest, b"")
+
+    @defer.inlineCallbacks
+    def test_offloaded(self):
+        replies = yield self.run_instance(self.application)
+        self.assertEqual(replies[0]["status"], 200)
+        self.assertEqual(replies[1]["body"], b"hello")
+        self.assertNotEqual(replies[1]["pid"], os.getpid())
+
+        replies = yield self.run_instance(self.application)
+        self.assertEqual(replies[1]["body"], b"hello")
+
+    @defer.inlineCallbacks
+    def test_file_extensions_not_offered(self):
+        protocol = DummyProtocol()
+        protocol.scope["extensions"] = {
+            "http.response.pathsend": {},
+            "http.response.trailers": {},
+            "http.response.zerocopysend": {},
+        }
+        queue = self.application.create_application_instance(protocol, protocol.scope)
+        queue.put_nowait({"type": "http.request", "body": b""})
+        yield defer.Deferred.fromFuture(
+            self.application.application_instances[protocol]
+        )
+        self.application.finish_protocol(protocol)
+        self.assertEqual(protocol.replies[1]["extensions"], ["http.response.trailers"])
+
+    @defer.inlineCallbacks
+    def test_receive_cancelled_when_instance_is_done(self):
+        cancelled = []
+
+        async def receive():
+            try:
+                await asyncio.Future()
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def send(message):
+            pass
+
+        scope = {"type": "http", "path": "/impatient"}
+        yield defer.Deferred.fromFuture(
+            asyncio.ensure_future(self.pool.run(None, scope, receive, send))
+        )
+        yield sleep(0)[0]
+        self.assertEqual(cancelled, [True])
@@ -0,0 +1,295 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, protocol, reactor, task, tcp
+from twisted.trial.unittest import TestCase
+from twisted.web import resource, server
+from twisted.web.http import datetimeToString
+
+from ..sendfile import SendfileCache, TCPWriteBuffer, send_descriptor, send_file
+from .utils import DummyRequest
+
+
+class TestSendfile(TestCase):
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_path, "file.txt").encode("utf-8")
+        self.write_file(b"a" * 50)
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.cache = SendfileCache(max_open_files=1, clock=self.clock)
+
+    def tearDown(self):
+        self.cache.clear()
+        shutil.rmtree(self.temp_path)
+
+    def write_file(self, payload, path=None):
+        with open(path or self.path, "wb") as f:
+            f.write(payload)
+
+    def send(self, path=None, **headers):
+        request = DummyRequest([b""])
+        for name, value in headers.items():
+            request.requestHeaders.addRawHeader(name.replace("_", "-"), value)
+        send_file(request, self.cache, path or self.path)
+        return request
+
+    def test_cached_stat(self):
+        entry = self.cache.get(self.path)
+        self.assertIs(self.cache.get(self.path), entry)
+
+        self.write_file(b"b" * 60)
+        self.assertIs(self.cache.get(self.path), entry)
+
+        self.clock.advance(1)
+        new_entry = self.cache.get(self.path)
+        self.assertIsNot(new_entry, entry)
+        self.assertEqual(new_entry.size, 60)
+        self.assertNotEqual(new_entry.etag, entry.etag)
+
+    def test_missing_file(self):
+        self.assertIsNone(self.cache.get(self.path + b".missing"))
+        self.assertIsNone(self.cache.get(self.temp_path.encode("utf-8")))
+
+        request = self.send(self.path + b".missing")
+        self.assertEqual(request.responseCode, 404)
+
+    def test_full_response(self):
+        request = self.send()
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(b"".join(request.written), b"a" * 50)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b"content-length"), [b"50"])
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b"content-type"), [b"text/plain"]
+        )
+        self.assertTrue(request.finished)
+
+    def test_etag_and_last_modified(self):
+        entry = self.cache.get(self.path)
+        request = self.send(if_none_match=entry.etag)
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(request.written, [])
+
+        request = self.send(if_modified_since=datetimeToString(entry.mtime + 10))
+        self.assertEqual(request.responseCode, 304)
+
+        request = self.send(if_modified_since=datetimeToString(entry.mtime - 10))
+        self.assertEqual(request.responseCode, 200)
+
+        self.write_file(b"changed")
+        os.utime(self.path, (entry.mtime + 5, entry.mtime + 5))
+        self.clock.advance(1)
+        request = self.send(if_none_match=entry.etag)
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(b"".join(request.written), b"changed")
+
+    def test_range(self):
+        self.write_file(b"0123456789")
+
+        request = self.send(range=b"bytes=2-4")
+        self.assertEqual(request.responseCode, 206)
+        self.assertEqual(b"".join(request.written), b"234")
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b"content-range"), [b"bytes 2-4/10"]
+        )
+
+        request = self.send(range=b"bytes=-3")
+        self.assertEqual(b"".join(request.written), b"789")
+
+        request = self.send(range=b"bytes=7-")
+        self.assertEqual(b"".join(request.written), b"789")
+
+        request = self.send(range=b"bytes=20-")
+        self.assertEqual(request.responseCode, 416)
+
+        request = self.send(range=b"bytes=0-1,4-5")
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(b"".join(request.written), b"0123456789")
+
+    def test_file_replaced_before_it_is_opened(self):
+        entry = self.cache.get(self.path)
+        old_etag = entry.etag
+
+        replacement = self.path + b".new"
+        self.write_file(b"b" * 80, replacement)
+        os.replace(replacement, self.path)
+
+        request = self.send()
+        self.assertEqual(b"".join(request.written), b"b" * 80)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b"content-length"), [b"80"]
+        )
+        self.assertNotEqual(request.etag, old_etag)
+        self.assertEqual(request.etag, entry.etag)
+
+    def test_open_files_are_reused_and_bounded(self):
+        entry = self.cache.get(self.path)
+        fd = entry.acquire()
+        self.assertEqual(entry.acquire(), fd)
+        entry.release()
+        entry.release()
+
+        other_path = os.path.join(self.temp_path, "other.txt").encode("utf-8")
+        self.write_file(b"other", other_path)
+        self.send(other_path)
+
+        self.cache.prune()
+        self.assertIsNone(entry.fd)
+        self.assertIsNotNone(self.cache.get(other_path).fd)
+
+
+class SendfileResource(resource.Resource):
+    isLeaf = True
+    transport = None
+
+    def __init__(self, cache, path):
+        resource.Resource.__init__(self)
+        self.cache = cache
+        self.path = path
+
+    def render_GET(self, request):
+        self.transport = request.channel.transport
+        send_file(request, self.cache, self.path)
+        return server.NOT_DONE_YET
+
+
+class DescriptorResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, path):
+        resource.Resource.__init__(self)
+        self.path = path
+
+    @defer.inlineCallbacks
+    def send(self, request):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            request.setHeader(b"content-length", b"%d" % (size - 10,))
+            yield send_descriptor(request, fd, 10, size - 10)
+        finally:
+            os.close(fd)
+        request.finish()
+
+    def render_GET(self, request):
+        self.send(request)
+        return server.NOT_DONE_YET
+
+
+class ResponseCollector(protocol.Protocol):
+    def __init__(self, request):
+        self.request = request
+        self.data = []
+        self.done = defer.Deferred()
+
+    def connectionMade(self):
+        self.transport.write(self.request)
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        self.done.callback(b"".join(self.data))
+
+
+class TestZeroCopySendfile(TestCase):
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_path, "file.bin").encode("utf-8")
+        self.payload = os.urandom(4 * 1024 * 1024)
+        with open(self.path, "wb") as f:
+            f.write(self.payload)
+
+        self.sendfile_calls = []
+        sendfile = os.sendfile
+
+        def counting_sendfile(*args):
+            self.sendfile_calls.append(args)
+            return sendfile(*args)
+
+        self.patch(os, "sendfile", counting_sendfile)
+
+        self.cache = SendfileCache()
+        self.resource = SendfileResource(self.cache, self.path)
+        site = server.Site(self.resource)
+        self.port = reactor.listenTCP(0, site, interface="127.0.0.1")
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.port.stopListening()
+        self.cache.clear()
+        shutil.rmtree(self.temp_path)
+
+    @defer.inlineCallbacks
+    def get(self, *headers):
+        request = b"\r\n".join(
+            [b"GET / HTTP/1.1", b"Host: localhost", b"Connection: close"]
+            + list(headers)
+        )
+        client = ResponseCollector(request + b"\r\n\r\n")
+        yield protocol.ClientCreator(reactor, lambda: client).connectTCP(
+            "127.0.0.1", self.port.getHost().port
+        )
+        response = yield client.done
+        head, _, body = response.partition(b"\r\n\r\n")
+        defer.returnValue((head, body))
+
+    @defer.inlineCallbacks
+    def test_full_response(self):
+        head, body = yield self.get()
+        self.assertIn(b" 200 ", head.split(b"\r\n")[0])
+        self.assertEqual(len(body), len(self.payload))
+        self.assertEqual(body, self.payload)
+        self.assertTrue(self.sendfile_calls)
+
+    @defer.inlineCallbacks
+    def test_tcp_write_buffer_internals(self):
+        # zero-copy falls back quietly without them, a new Twisted fails here
+        yield self.get()
+        transport = self.resource.transport
+        self.assertIs(type(transport), tcp.Server)
+        for name in TCPWriteBuffer.attributes:
+            self.assertTrue(hasattr(transport, name), "tcp.Server lost %s" % (name,))
+        self.assertTrue(hasattr(transport, "producer"))
+
+    @defer.inlineCallbacks
+    def test_range(self):
+        head, body = yield self.get(b"Range: bytes=1000-2999")
+        self.assertIn(b" 206 ", head.split(b"\r\n")[0])
+        self.assertEqual(body, self.payload[1000:3000])
+        self.assertEqual(self.sendfile_calls[0][2], 1000)
+
+    @defer.inlineCallbacks
+    def test_send_descriptor(self):
+        yield self.port.stopListening()
+        site = server.Site(DescriptorResource(self.path))
+        self.port = reactor.listenTCP(0, site, interface="127.0.0.1")
+
+        head, body = yield self.get()
+        self.assertEqual(body, self.payload[10:])
+        self.assertEqual(self.sendfile_calls[0][2], 10)
+
+    @defer.inlineCallbacks
+    def test_other_transport_falls_back(self):
+        yield self.port.stopListening()
+        site = server.Site(SendfileResource(self.cache, self.path))
+        socket_path = os.path.join(self.temp_path, "http.sock")
+        self.port = reactor.listenUNIX(socket_path, site)
+
+        client = ResponseCollector(
+            b"GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+        )
+        yield protocol.ClientCreator(reactor, lambda: client).connectUNIX(socket_path)
+        response = yield client.done
+        head, _, body = response.partition(b"\r\n\r\n")
+        self.assertIn(b" 200 ", head.split(b"\r\n")[0])
+        self.assertEqual(body, self.payload)
+        self.assertEqual(self.sendfile_calls, [])
+
+    @defer.inlineCallbacks
+    def test_disabled(self):
+        self.cache.zero_copy = False
+        head, body = yield self.get()
+        self.assertEqual(body, self.payload)
+        self.assertEqual(self.sendfile_calls, [])
@@ -0,0 +1,193 @@
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.trial.unittest import TestCase
+
+from ..asgiresource import ASGIResource
+from ..http import ASGIHTTPResource
+from ..metrics import Metrics
+from ..singleflight import Flight, SingleFlight
+from ..utils import sleep
+from .utils import DummyApplication, DummyRequest
+
+
+class TestSingleFlight(TestCase):
+    def setUp(self):
+        self.application = DummyApplication()
+        self.single_flight = SingleFlight(["/shared/"])
+        self.resources = []
+
+    def tearDown(self):
+        for resource in self.resources:
+            resource.do_cleanup()
+
+    def request(self, path="/shared/page", *headers):
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "query_string": b"",
+            "headers": list(headers),
+        }
+        request = DummyRequest([b""])
+        resource = ASGIHTTPResource(
+            self.application, scope, 1, single_flight=self.single_flight
+        )
+        resource.render(request)
+        self.resources.append(resource)
+        return resource, request
+
+    @defer.inlineCallbacks
+    def test_identical_requests_share_instance(self):
+        _, first = self.request()
+        self.application.protocol = None
+        _, second = self.request()
+        self.assertIsNone(self.application.protocol)
+
+        _, other = self.request("/shared/other")
+        flight = self.application.protocol
+        self.assertIsInstance(flight, Flight)
+        self.assertEqual(
+            flight.queue.get_nowait(),
+            {"type": "http.request", "body": b"", "more_body": False},
+        )
+
+        self.application.protocol = None
+        self.request("/shared/page", [b"authorization", b"secret"])
+        self.assertIsNotNone(self.application.protocol)
+
+        self.application.protocol = None
+        self.request("/private/page")
+        self.assertIsNotNone(self.application.protocol)
+
+        self.application.protocol = None
+        flight = self.single_flight.flights[("GET", "/shared/page", b"")]
+        flight.handle_reply(
+            {"type": "http.response.start", "status": 200, "headers": []}
+        )
+        flight.handle_reply({"type": "http.response.body", "body": b"shared"})
+        yield first.notifyFinish()
+        yield sleep(0)[0]
+
+        for request in (first, second):
+            self.assertTrue(request.finished)
+            self.assertEqual(request.written, [b"shared"])
+        self.assertFalse(other.finished)
+        self.assertNotIn(flight.key, self.single_flight.flights)
+
+        self.request()  # the response has started, it gets its own instance
+        self.assertIsNotNone(self.application.protocol)
+
+    @defer.inlineCallbacks
+    def test_slowest_request_holds_back_application(self):
+        self.request()
+        _, request = self.request()
+        flight = self.application.protocol
+
+        self.assertIsNone(
+            flight.handle_reply(
+                {"type": "http.response.start", "status": 200, "headers": []}
+            )
+        )
+        yield sleep(0)[0]
+        request.producer.pauseProducing()
+
+        d = flight.handle_reply(
+            {"type": "http.response.body", "body": b"chunk", "more_body": True}
+        )
+        self.assertNoResult(d)
+        request.producer.resumeProducing()
+        self.successResultOf(d)
+
+    def test_disconnect_only_when_all_are_gone(self):
+        _, first = self.request()
+        _, second = self.request()
+        flight = self.application.protocol
+        flight.queue.get_nowait()
+
+        first.processingFailed(failure.Failure(Exception()))
+        self.assertTrue(flight.queue.empty())
+        self.assertFalse(self.application.finished)
+
+        second.processingFailed(failure.Failure(Exception()))
+        self.assertEqual(flight.queue.get_nowait(), {"type": "http.disconnect"})
+        self.assertTrue(self.application.finished)
+
+
+class TestSingleFlightResource(TestCase):
+    @defer.inlineCallbacks
+    def test_application_runs_once(self):
+        calls = []
+
+        async def application(scope, receive, send):
+            calls.append(scope["path"])
+            await receive()
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"once"})
+
+        resource = ASGIResource(application, single_flight_paths=["/"])
+        requests = [DummyRequest([b"page"]) for _ in range(3)]
+        for request in requests:
+            resource.render(request)
+
+        yield defer.gatherResults([request.notifyFinish() for request in requests])
+        self.assertEqual(calls, ["/page"])
+        for request in requests:
+            self.assertEqual(request.written, [b"once"])
+
+        yield sleep(0)[0]
+        self.assertFalse(resource.application.application_instances)
+        self.assertFalse(resource.single_flight.flights)
+        yield resource.stop()
+
+    @defer.inlineCallbacks
+    def test_personal_responses_are_not_shared(self):
+        calls = []
+
+        async def application(scope, receive, send):
+            calls.append(scope["path"])
+            session = dict(scope["headers"]).get(b"cookie", b"session=%d" % len(calls))
+            await receive()
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [[b"set-cookie", session]],
+                }
+            )
+            await send({"type": "http.response.body", "body": b"hello " + session})
+
+        metrics = Metrics()
+        resource = ASGIResource(application, single_flight_paths=["/"], metrics=metrics)
+
+        # different credentials never share an instance
+        alice, bob = DummyRequest([b"me"]), DummyRequest([b"me"])
+        alice.requestHeaders.addRawHeader(b"cookie", b"session=alice")
+        bob.requestHeaders.addRawHeader(b"cookie", b"session=bob")
+        resource.render(alice)
+        resource.render(bob)
+        yield defer.gatherResults([alice.notifyFinish(), bob.notifyFinish()])
+        self.assertEqual(alice.written, [b"hello session=alice"])
+        self.assertEqual(bob.written, [b"hello session=bob"])
+        self.assertEqual(
+            bob.responseHeaders.getRawHeaders(b"set-cookie"), [b"session=bob"]
+        )
+
+        # an anonymous response setting a cookie only goes to the first request
+        del calls[:]
+        requests = [DummyRequest([b"me"]) for _ in range(2)]
+        for request in requests:
+            resource.render(request)
+        yield defer.gatherResults([request.notifyFinish() for request in requests])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(metrics.counters[("txasgi_single_flight_joined_total", ())], 1)
+        self.assertEqual(
+            sorted(
+                request.responseHeaders.getRawHeaders(b"set-cookie")[0]
+                for request in requests
+            ),
+            [b"session=1", b"session=2"],
+        )
+
+        yield sleep(0)[0]
+        self.assertFalse(resource.application.application_instances)
+        yield resource.stop()
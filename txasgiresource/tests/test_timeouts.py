@@ -0,0 +1,159 @@
+import asyncio
+import gc
+import weakref
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from ..timeouts import TimingWheel, get_wheel
+from ..utils import ReplyQueue
+
+
+class TestTimingWheel(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimingWheel(clock=self.clock)
+        self.expired = []
+
+    def test_shared_wheel_goes_away_with_clock(self):
+        clock = task.Clock()
+        wheel = get_wheel(clock)
+        self.assertIs(get_wheel(clock), wheel)
+        wheel.schedule(3, lambda: None)
+
+        clock, wheel = weakref.ref(clock), weakref.ref(wheel)
+        gc.collect()
+        self.assertIsNone(clock())
+        self.assertIsNone(wheel())
+
+    def test_expires(self):
+        self.wheel.schedule(3, lambda: self.expired.append(1))
+        self.clock.advance(2)
+        self.assertEqual(self.expired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.expired, [1])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_touch_postpones(self):
+        timeout = self.wheel.schedule(3, lambda: self.expired.append(1))
+        for _ in range(5):
+            self.clock.advance(1)
+            timeout.touch()
+        self.assertEqual(self.expired, [])
+        self.assertTrue(timeout.active)
+
+        self.clock.advance(3)
+        self.assertEqual(self.expired, [1])
+        self.assertFalse(timeout.active)
+
+    def test_one_sweep_for_all(self):
+        timeouts = [
+            self.wheel.schedule(5, lambda: self.expired.append(1)) for _ in range(100)
+        ]
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        for timeout in timeouts[:50]:
+            timeout.cancel()
+        self.clock.advance(5)
+        self.assertEqual(len(self.expired), 50)
+        self.assertEqual(self.wheel.slots, {})
+
+    def test_cancel_stops_sweep(self):
+        timeout = self.wheel.schedule(5, lambda: self.expired.append(1))
+        timeout.cancel()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(10)
+        self.assertEqual(self.expired, [])
+
+
+class TestReplyQueueTimeout(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.replies = ReplyQueue(self.clock)
+
+    def test_timeout_while_waiting(self):
+        d = self.replies.get(2)
+        self.clock.advance(2)
+        self.failureResultOf(d, defer.TimeoutError)
+
+    def test_waiting_again_touches(self):
+        self.replies.get(2)
+        timeout = self.replies.timeout
+        self.clock.advance(1)
+        self.replies.put({"type": "message"})
+        self.clock.advance(0)
+
+        d = self.replies.get(2)
+        self.assertIs(self.replies.timeout, timeout)
+        self.clock.advance(1.5)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d, defer.TimeoutError)
+
+    def test_no_timeout_while_busy(self):
+        d = self.replies.get(2)
+        self.replies.put({"type": "message"})
+        self.clock.advance(0)
+        self.successResultOf(d)
+
+        self.clock.advance(5)  # the consumer is busy with the message
+        self.assertIsNone(self.replies.failure)
+        self.assertIsNone(self.replies.timeout)
+
+        d = self.replies.get(2)
+        self.assertNoResult(d)
+        self.replies.stop_timeout()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class CountingLoop(asyncio.SelectorEventLoop):
+    scheduled = 0
+
+    def call_soon(self, *args, **kwargs):
+        self.scheduled += 1
+        return super().call_soon(*args, **kwargs)
+
+    def run_turn(self):
+        super().call_soon(self.stop)
+        self.run_forever()
+
+
+class TestReplyQueueWakeup(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock._asyncioEventloop = self.loop = CountingLoop()
+        self.addCleanup(self.loop.close)
+        self.replies = ReplyQueue(self.clock)
+
+    def test_one_call_per_batch(self):
+        received = []
+        d = self.replies.get(2)
+        self.replies.put({"type": "http.response.start", "status": 200})
+        for _ in range(10):
+            self.replies.put({"type": "http.response.body", "more_body": True})
+        self.assertEqual(self.loop.scheduled, 1)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)  # the timeout sweep
+
+        self.loop.run_turn()
+        received.extend(self.successResultOf(d))
+
+        # the application sends the rest of the body one chunk per turn
+        for _ in range(5):
+            d = self.replies.get(2)
+            self.replies.put({"type": "http.response.body", "more_body": True})
+            self.loop.run_turn()
+            received.extend(self.successResultOf(d))
+
+        self.assertEqual(len(received), 16)
+        self.assertEqual(self.loop.scheduled, 6)
+        self.replies.stop_timeout()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel_drops_wakeup(self):
+        d = self.replies.get()
+        self.replies.put({"type": "http.response.body"})
+        self.replies.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertIsNone(self.replies.wakeup_call)
+        self.loop.run_turn()
+        self.assertEqual(self.replies.messages, [{"type": "http.response.body"}])
@@ -0,0 +1,98 @@
+import asyncio
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from ..application import ApplicationManager
+from ..metrics import Metrics
+from ..watchdog import LoopWatchdog
+
+
+class DummyProtocol:
+    def __init__(self, path):
+        self.scope = {"type": "http", "path": path}
+
+    def handle_reply(self, msg):
+        pass
+
+
+class TestLoopWatchdog(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.blocked = defer.Deferred()
+
+        async def application(scope, receive, send):
+            message = await receive()
+            if message["type"] == "block":
+                # time passes and the monitor thread looks at the loop
+                self.now += 0.3
+                self.watchdog.check()
+                self.blocked.callback(None)
+            await receive()
+
+        self.metrics = Metrics()
+        self.application = ApplicationManager(application, metrics=self.metrics)
+        self.clock = task.Clock()
+        self.watchdog = LoopWatchdog(
+            self.application,
+            threshold=0.1,
+            interval=0.02,
+            sample_stacks=True,
+            clock=self.clock,
+            timer=lambda: self.now,
+        )
+        # the tests call check() in place of the monitor thread
+        self.patch(self.watchdog, "monitor", lambda: None)
+
+    def tearDown(self):
+        self.watchdog.stop()
+        for protocol in list(self.application.application_instances):
+            self.application.finish_protocol(protocol)
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.clock.advance(seconds)
+
+    @defer.inlineCallbacks
+    def test_reports_blocking_instance(self):
+        self.watchdog.start()
+        protocol = DummyProtocol("/slow")
+        queue = self.application.create_application_instance(protocol, protocol.scope)
+        queue.put_nowait({"type": "block"})
+        yield self.blocked
+        self.assertEqual(self.watchdog.blocked[0], "/slow")
+        self.assertIn("application", self.watchdog.blocked[1])
+
+        self.clock.advance(0.02)  # the heartbeat is 0.28s late
+        self.assertEqual(list(self.watchdog.slow_paths), ["/slow"])
+        self.assertAlmostEqual(self.watchdog.max_lag, 0.28)
+        self.assertEqual(self.metrics.counters[("txasgi_loop_blocked_total", ())], 1)
+        self.assertIsNone(self.watchdog.blocked)
+
+    def test_blocked_by_reactor_callback(self):
+        self.watchdog.start()
+        self.now += 0.2
+        self.watchdog.check()
+        self.clock.advance(0.02)
+        self.assertEqual(list(self.watchdog.slow_paths), ["a reactor callback"])
+
+    def test_quiet_loop(self):
+        self.watchdog.start()
+        for _ in range(5):
+            self.advance(0.02)
+            self.watchdog.check()
+        self.assertEqual(self.watchdog.slow_paths, {})
+        self.assertIsNone(self.watchdog.blocked)
+        self.assertEqual(
+            self.metrics.histograms[("txasgi_loop_lag_seconds", ())].count, 5
+        )
+
+    def test_scope_path(self):
+        protocol = DummyProtocol("/path")
+        self.application.create_application_instance(protocol, protocol.scope)
+        instance = self.application.application_instances[protocol]
+        self.assertEqual(self.watchdog.get_scope_path(instance), "/path")
+        self.assertIsNone(self.watchdog.get_scope_path(None))
+        self.assertIsNone(
+            self.watchdog.get_scope_path(asyncio.ensure_future(asyncio.sleep(0)))
+        )
@@ -1,10 +1,20 @@
 from autobahn.twisted.websocket import ConnectionDeny
+from autobahn.websocket.compress import PerMessageDeflateOffer
 
 from twisted.internet import defer, task
+from twisted.internet.testing import StringTransport
+from twisted.python import failure
 from twisted.trial.unittest import TestCase
+from twisted.web import server
 
-from ..ws import ASGIWebSocketServerFactory, ASGIWebSocketServerProtocol
-from .utils import DummyApplication
+from ..asgiresource import ASGIResource
+from ..utils import sleep
+from ..ws import (
+    ASGIWebSocketServerFactory,
+    ASGIWebSocketServerProtocol,
+    DeflateAccept,
+)
+from .utils import DummyApplication, upgrade_websocket
 
 
 class DummyASGIWebSocketServerProtocol(ASGIWebSocketServerProtocol):
@@ -44,12 +54,13 @@ class TestASGIWebSocket(TestCase):
 
     def setUp(self):
         self.application = DummyApplication()
-        self.base_scope = {"_ssl": ""}
+        self.scope = {"type": "websocket", "scheme": "ws", "subprotocols": []}
         self.factory = DummyASGIWebSocketServerFactory(
-            application=self.application, base_scope=self.base_scope, idle_timeout=600
+            application=self.application, idle_timeout=600
         )
 
         self.clock = task.Clock()
+        self.factory.pending_scope = self.scope
         self.protocol = self.factory.buildProtocol(None)
         self.protocol.clock = self.clock
 
@@ -70,6 +81,7 @@ class TestASGIWebSocket(TestCase):
         self.protocol.handle_reply(
             {"type": "websocket.accept", "subprotocol": "txasgi.best"}
         )
+        self.clock.advance(0)
         subprotocol = yield accept_defer
         self.assertTrue(self.protocol.accepted)
         self.assertEqual(subprotocol, "txasgi.best")
@@ -77,6 +89,7 @@ class TestASGIWebSocket(TestCase):
         self.protocol.handle_reply(
             {"type": "websocket.send", "binary": b"some binary stuff"}
         )
+        self.clock.advance(0)
         self.assertEqual(
             self.protocol._events.pop(), ("send_message", b"some binary stuff", True)
         )
@@ -84,6 +97,7 @@ class TestASGIWebSocket(TestCase):
         self.protocol.handle_reply(
             {"type": "websocket.send", "text": "some text stuff"}
         )
+        self.clock.advance(0)
         self.assertEqual(
             self.protocol._events.pop(), ("send_message", b"some text stuff", False)
         )
@@ -101,6 +115,7 @@ class TestASGIWebSocket(TestCase):
         )
 
         self.protocol.handle_reply({"type": "websocket.close"})
+        self.clock.advance(0)
         self.assertEqual(self.protocol._events.pop(), ("send_close", 1000))
 
     @defer.inlineCallbacks
@@ -119,6 +134,7 @@ class TestASGIWebSocket(TestCase):
     def test_connection_refused(self):
         accept_defer = self.protocol.onConnect(None)
         self.protocol.handle_reply({"type": "websocket.close"})
+        self.clock.advance(0)
         try:
             yield accept_defer
         except ConnectionDeny as e:
@@ -126,6 +142,40 @@ class TestASGIWebSocket(TestCase):
         else:
             self.fail("Did not raise an exception")
 
+    def test_batched_replies(self):
+        self.protocol.onConnect(None)
+        self.protocol.handle_reply({"type": "websocket.accept"})
+        for i in range(3):
+            self.protocol.handle_reply({"type": "websocket.send", "text": str(i)})
+        self.assertEqual(len(self.protocol._events), 0)
+
+        self.clock.advance(0)
+        self.assertEqual(
+            self.protocol._events,
+            [
+                ("send_message", b"0", False),
+                ("send_message", b"1", False),
+                ("send_message", b"2", False),
+            ],
+        )
+        self.protocol.replies.cancel()
+
+    def test_full_queue_pauses_transport(self):
+        self.protocol.transport = StringTransport()
+        self.protocol.onConnect(None)
+        self.protocol.handle_reply({"type": "websocket.accept"})
+        self.clock.advance(0)
+
+        self.application.queue.limit = 3
+        self.protocol.onMessage(b"message 1", False)
+        self.assertEqual(self.protocol.transport.producerState, "producing")
+        self.protocol.onMessage(b"message 2", False)
+        self.assertEqual(self.protocol.transport.producerState, "paused")
+
+        self.application.queue.get_nowait()
+        self.assertEqual(self.protocol.transport.producerState, "producing")
+        self.protocol.replies.cancel()
+
     def test_timeout(self):
         self.protocol.onConnect(None)
         self.protocol.timeoutConnection()
@@ -133,7 +183,7 @@ class TestASGIWebSocket(TestCase):
 
     def test_cancel_defer(self):
         self.protocol.onConnect(None)
-        self.protocol.reply_defer.cancel()
+        self.protocol.replies.cancel()
         self.assertEqual(self.protocol._events.pop(), ("drop_connection", True))
 
     def test_invalid_message_order(self):
@@ -141,8 +191,9 @@ class TestASGIWebSocket(TestCase):
         self.protocol.handle_reply(
             {"type": "websocket.send", "text": "some text stuff"}
         )
+        self.clock.advance(0)
         self.assertEqual(len(self.protocol._events), 0)
-        self.protocol.reply_defer.cancel()
+        self.protocol.replies.cancel()
 
     def test_connection_lost(self):
         self.protocol.onConnect(None)
@@ -154,7 +205,117 @@ class TestASGIWebSocket(TestCase):
             self.application.queue.get_nowait(),
             {"type": "websocket.disconnect", "code": 1000},
         )
-        self.protocol.reply_defer.cancel()
+        self.protocol.replies.cancel()
 
     def test_connection_lost_never_opened(self):
         self.protocol.onClose(True, 1000, "")
+
+
+class TestASGIResourceWebSocket(TestCase):
+    def setUp(self):
+        self.application = DummyApplication()
+        self.resource = ASGIResource(None)
+        self.resource.application = self.resource.ws_factory.application = (
+            self.application
+        )
+        self.site = server.Site(self.resource)
+        self.channels = []
+
+    def tearDown(self):
+        for channel, transport in self.channels:
+            transport.protocol.replies.cancel()
+            transport.protocol.connectionLost(failure.Failure(Exception()))
+        self.resource.ws_factory.stopFactory()
+
+    def _upgrade(self, path, *headers):
+        channel, transport = upgrade_websocket(self.site, path, *headers)
+        self.channels.append((channel, transport))
+        return transport.protocol
+
+    def test_factory_is_shared(self):
+        protocol_1 = self._upgrade(b"/first")
+        self.assertEqual(self.application.scope["path"], "/first")
+        protocol_2 = self._upgrade(b"/second")
+        self.assertEqual(self.application.scope["path"], "/second")
+
+        self.assertIsInstance(protocol_1, ASGIWebSocketServerProtocol)
+        self.assertIs(protocol_1.factory, protocol_2.factory)
+        self.assertEqual(protocol_1.scope["path"], "/first")
+        self.assertIsNone(self.resource.ws_factory.pending_scope)
+
+    @defer.inlineCallbacks
+    def test_close_connection(self):
+        self.resource.ws_factory.setProtocolOptions(closeHandshakeTimeout=0)
+        protocol = self._upgrade(b"/")
+        protocol.handle_reply({"type": "websocket.accept"})
+        yield sleep(0)[0]
+        transport = self.channels[0][1]
+        transport.clear()
+
+        protocol.close_connection(1012)
+        self.assertEqual(transport.value(), b"\x88\x02\x03\xf4")
+
+    def test_protocol_options(self):
+        self.resource.ws_factory.stopFactory()
+        self.resource = ASGIResource(
+            None,
+            websocket_max_message_size=1024,
+            websocket_max_frame_size=512,
+            websocket_auto_fragment_size=256,
+            websocket_utf8_validate=False,
+            websocket_handshake_timeout=2,
+        )
+        factory = self.resource.ws_factory
+        self.assertEqual(factory.maxMessagePayloadSize, 1024)
+        self.assertEqual(factory.maxFramePayloadSize, 512)
+        self.assertEqual(factory.autoFragmentSize, 256)
+        self.assertFalse(factory.utf8validateIncoming)
+        self.assertEqual(factory.openHandshakeTimeout, 2)
+
+    @defer.inlineCallbacks
+    def test_compression_accepted(self):
+        self.resource.ws_factory.stopFactory()
+        self.resource = ASGIResource(None, websocket_compression=True)
+        self.resource.application = self.resource.ws_factory.application = (
+            self.application
+        )
+        self.site = server.Site(self.resource)
+
+        protocol = self._upgrade(
+            b"/",
+            b"Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits",
+        )
+        protocol.handle_reply({"type": "websocket.accept"})
+        yield sleep(0)[0]
+
+        transport = self.channels[0][1]
+        self.assertIn(
+            b"Sec-WebSocket-Extensions: permessage-deflate", transport.value()
+        )
+
+
+class TestDeflateAccept(TestCase):
+    def test_window_bits(self):
+        accept = DeflateAccept(window_bits=12, client_window_bits=10)
+        response = accept([PerMessageDeflateOffer()])
+        self.assertEqual(response.window_bits, 12)
+        self.assertEqual(response.request_max_window_bits, 10)
+        self.assertFalse(response.no_context_takeover)
+
+    def test_client_limits_are_respected(self):
+        accept = DeflateAccept(client_window_bits=10)
+        response = accept(
+            [
+                PerMessageDeflateOffer(
+                    accept_max_window_bits=False,
+                    request_no_context_takeover=True,
+                    request_max_window_bits=9,
+                )
+            ]
+        )
+        self.assertEqual(response.window_bits, 9)
+        self.assertEqual(response.request_max_window_bits, 0)
+        self.assertTrue(response.no_context_takeover)
+
+    def test_no_offer(self):
+        self.assertIsNone(DeflateAccept()([]))
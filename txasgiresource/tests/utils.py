@@ -1,13 +1,29 @@
-import asyncio
 from io import BytesIO
 
-from twisted.web.http import CACHED, NOT_MODIFIED, PRECONDITION_FAILED
+from twisted.internet.testing import StringTransport
+from twisted.python import failure
+from twisted.web import server
+from twisted.web.http import (
+    CACHED,
+    NOT_MODIFIED,
+    PRECONDITION_FAILED,
+    datetimeToString,
+    stringToDatetime,
+)
 from twisted.web.test.requesthelper import DummyRequest as TwistedDummyRequest
 
+from ..application import ApplicationQueue
+from ..asgiresource import ASGIResource
+from ..http import ASGIRequest
+
 
 class DummyApplication:
     finished = False
     fail_to_create = False
+    state = None
+    metrics = None
+    draining = False
+    admission = None
 
     def create_application_instance(self, protocol, scope):
         if self.fail_to_create:
@@ -15,7 +31,7 @@ class DummyApplication:
 
         self.scope = scope
         self.protocol = protocol
-        self.queue = asyncio.Queue()
+        self.queue = ApplicationQueue()
 
         return self.queue
 
@@ -28,6 +44,8 @@ class DummyRequest(TwistedDummyRequest):
     startedWriting = 0
     etag = None
     channel = True
+    producer = None
+    sentLength = 0
 
     def __init__(self, *args, **kwargs):
         self.content = BytesIO()
@@ -48,6 +66,25 @@ class DummyRequest(TwistedDummyRequest):
                 return CACHED
         return None
 
+    def setLastModified(self, when):
+        self.responseHeaders.setRawHeaders(b"Last-Modified", [datetimeToString(when)])
+
+        modified_since = self.getHeader(b"if-modified-since")
+        if modified_since and stringToDatetime(modified_since) >= int(when):
+            self.setResponseCode(NOT_MODIFIED)
+            return CACHED
+        return None
+
+    def registerProducer(self, producer, streaming):
+        if streaming:
+            self.producer = producer
+        else:
+            super(DummyRequest, self).registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self.producer = None
+        super(DummyRequest, self).unregisterProducer()
+
     def write(self, data):
         if not self.startedWriting:
             self.startedWriting = 1
@@ -55,7 +92,49 @@ class DummyRequest(TwistedDummyRequest):
             if self.etag is not None:
                 self.responseHeaders.setRawHeaders(b"ETag", [self.etag])
 
+        self.sentLength += len(data)
         return super(DummyRequest, self).write(data)
 
     def isSecure(self):
         return self._isSecure
+
+
+class HTTPChannelTestMixin:
+    """
+    Serves an ASGIResource with a DummyApplication to an HTTP channel
+    connected to a StringTransport.
+    """
+
+    def setUp(self):
+        self.application = DummyApplication()
+        self.resource = ASGIResource(None)
+        self.resource.application = self.application
+        self.site = server.Site(self.resource, requestFactory=ASGIRequest)
+        self.channel = self.site.buildProtocol(None)
+        self.transport = StringTransport()
+        self.channel.makeConnection(self.transport)
+
+    def tearDown(self):
+        self.channel.connectionLost(failure.Failure(Exception()))
+
+
+def upgrade_websocket(site, path=b"/", *headers):
+    """
+    Connects a new channel of site and upgrades it to a WebSocket,
+    returns the channel and its transport. After the upgrade
+    transport.protocol is the WebSocket protocol.
+    """
+    channel = site.buildProtocol(None)
+    transport = StringTransport()
+    transport.protocol = channel
+    channel.makeConnection(transport)
+    channel.dataReceived(
+        b"GET %s HTTP/1.1\r\n"
+        b"Host: dummy\r\n"
+        b"Upgrade: websocket\r\n"
+        b"Connection: Upgrade\r\n"
+        b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+        b"Sec-WebSocket-Version: 13\r\n%s\r\n"
+        % (path, b"".join(header + b"\r\n" for header in headers))
+    )
+    return channel, transport
@@ -0,0 +1,117 @@
+import math
+
+from twisted.internet import reactor, task
+
+DEFAULT_RESOLUTION = 1.0
+
+
+class Timeout:
+    """
+    A timeout in a TimingWheel, it expires `timeout` seconds after it was
+    last touched.
+    """
+
+    __slots__ = ("wheel", "timeout", "callback", "last_active", "slot")
+
+    def __init__(self, wheel, timeout, callback):
+        self.wheel = wheel
+        self.timeout = timeout
+        self.callback = callback
+        self.last_active = wheel.clock.seconds()
+        self.slot = None
+
+    def touch(self):
+        self.last_active = self.wheel.clock.seconds()
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+
+class TimingWheel:
+    """
+    Coarse timeouts shared by many connections.
+
+    Timeouts are kept in slots of `resolution` seconds and a single sweep
+    runs every `resolution` seconds while there are any. Touching a timeout
+    only updates its timestamp, the sweep moves it to a later slot when it
+    finds it has not expired yet. Timeouts fire up to `resolution` seconds late.
+    """
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION, clock=reactor):
+        self.resolution = resolution
+        self.clock = clock
+        self.slots = {}
+        self.sweeper = None
+
+    def schedule(self, timeout, callback):
+        entry = Timeout(self, timeout, callback)
+        self._insert(entry)
+        return entry
+
+    def cancel(self, entry):
+        if entry.slot is None:
+            return
+
+        entries = self.slots.get(entry.slot)
+        if entries is not None:
+            entries.discard(entry)
+            if not entries:
+                del self.slots[entry.slot]
+        entry.slot = None
+
+        if not self.slots:
+            self._stop_sweeper()
+
+    def _insert(self, entry):
+        slot = int(math.ceil((entry.last_active + entry.timeout) / self.resolution))
+        entries = self.slots.get(slot)
+        if entries is None:
+            entries = self.slots[slot] = set()
+        entries.add(entry)
+        entry.slot = slot
+
+        if self.sweeper is None:
+            self.sweeper = task.LoopingCall(self.sweep)
+            self.sweeper.clock = self.clock
+            self.sweeper.start(self.resolution, now=False)
+
+    def _stop_sweeper(self):
+        if self.sweeper is not None:
+            if self.sweeper.running:
+                self.sweeper.stop()
+            self.sweeper = None
+
+    def sweep(self):
+        now = self.clock.seconds()
+        current = int(math.ceil(now / self.resolution))
+
+        expired = []
+        for slot in [slot for slot in self.slots if slot <= current]:
+            for entry in self.slots.pop(slot):
+                entry.slot = None
+                if entry.last_active + entry.timeout <= now:
+                    expired.append(entry)
+                else:
+                    self._insert(entry)
+
+        if not self.slots:
+            self._stop_sweeper()
+
+        for entry in expired:
+            entry.callback()
+
+
+def get_wheel(clock=reactor):
+    """
+    Returns the TimingWheel shared by everything using clock. It is kept on
+    the clock, so it goes away together with the clock.
+    """
+    try:
+        return clock.txasgi_timing_wheel
+    except AttributeError:
+        wheel = clock.txasgi_timing_wheel = TimingWheel(clock=clock)
+        return wheel
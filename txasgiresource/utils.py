@@ -1,14 +1,124 @@
 from twisted.internet import defer, reactor
 from twisted.web import resource
 
+from .timeouts import get_wheel
+
+ASGI_VERSION = {"version": "3.0", "spec_version": "2.0"}
+
 
 def sleep(secs):
     d = defer.Deferred()
     return d, reactor.callLater(secs, d.callback, None)
 
 
+def call_soon(clock, f):
+    """
+    Calls f on the next turn of clock. With the asyncio reactor this is the loop's
+    call_soon, which skips the DelayedCall and the timer heap callLater(0) needs.
+    """
+    loop = getattr(clock, "_asyncioEventloop", None)
+    if loop is not None:
+        return loop.call_soon(f)
+    return clock.callLater(0, f)
+
+
 def send_error_page(request, status, brief, detail):
     if not request.finished and request.channel:
         error_page = resource.ErrorPage(status, brief, detail).render(request)
         request.write(error_page)
         request.finish()
+
+
+class ReplyQueue:
+    """
+    Messages sent by an application instance waiting to be handled by its protocol.
+
+    Messages are kept in order and never dropped. A waiting consumer is woken up
+    once per reactor turn with everything sent since it last looked, so messages
+    sent in a burst can be handled as a batch. A batch costs a single call_soon,
+    however many messages are in it.
+
+    Timeouts of consumers are kept in the shared timing wheel, waiting again
+    only touches the timeout.
+    """
+
+    __slots__ = ("clock", "messages", "waiter", "wakeup_call", "failure", "timeout")
+
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self.messages = None  # only allocated while there are messages
+        self.waiter = None
+        self.wakeup_call = None
+        self.failure = None
+        self.timeout = None
+
+    def put(self, msg):
+        if self.messages is None:
+            self.messages = []
+        self.messages.append(msg)
+        if self.waiter is not None and self.wakeup_call is None:
+            self.wakeup_call = call_soon(self.clock, self._wakeup)
+
+    def get(self, timeout=None):
+        """
+        Returns a Deferred that fires with a list of all the waiting messages.
+        """
+        if self.failure is not None:
+            return defer.fail(self.failure)
+
+        if self.messages:
+            return defer.succeed(self._pop_all())
+
+        self.waiter = defer.Deferred(self._cancel_waiter)
+        if timeout is not None:
+            if self.timeout is None:
+                self.timeout = get_wheel(self.clock).schedule(timeout, self._timed_out)
+            else:
+                self.timeout.touch()
+
+        return self.waiter
+
+    def fail(self, exc):
+        """
+        Makes the current, or next, consumer fail with `exc`.
+        """
+        if self.waiter is not None:
+            d = self.waiter
+            self._cancel_waiter(d)
+            d.errback(exc)
+        else:
+            self.failure = exc
+
+    def cancel(self):
+        if self.waiter is not None:
+            self.waiter.cancel()
+        else:
+            self.failure = defer.CancelledError()
+        self.stop_timeout()
+
+    def stop_timeout(self):
+        if self.timeout is not None:
+            self.timeout.cancel()
+            self.timeout = None
+
+    def _timed_out(self):
+        self.timeout = None
+        if self.waiter is not None:
+            self.fail(defer.TimeoutError())
+        # otherwise the consumer is busy, the next get() starts a new timeout
+
+    def _pop_all(self):
+        messages, self.messages = self.messages, None
+        return messages
+
+    def _cancel_waiter(self, d):
+        self.waiter = None
+        if self.wakeup_call is not None:
+            self.wakeup_call.cancel()
+            self.wakeup_call = None
+
+    def _wakeup(self):
+        self.wakeup_call = None
+        if self.waiter is not None and self.messages:
+            d, self.waiter = self.waiter, None
+            d.callback(self._pop_all())
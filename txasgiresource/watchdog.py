@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from twisted.internet import reactor, task
+
+logger = logging.getLogger(__name__)
+
+
+class LoopWatchdog:
+    """
+    Reports when the event loop shared by Twisted and the applications is blocked.
+
+    A heartbeat runs on the loop every `interval` seconds and measures how late
+    it is. A monitor thread notices when the heartbeat is more than `threshold`
+    seconds late, looks up the task running on the loop and the scope path of
+    the application instance it belongs to and, with `sample_stacks`, takes the
+    stack of the loop thread. The report is logged from the loop when it is
+    responsive again.
+
+    `clock` runs the heartbeat and `timer` measures how late it is.
+    """
+
+    heartbeat = None
+    thread = None
+    running = False
+    blocked = None
+
+    def __init__(
+        self,
+        application,
+        threshold=0.1,
+        interval=None,
+        sample_stacks=False,
+        clock=reactor,
+        timer=time.monotonic,
+    ):
+        self.application = application
+        self.threshold = threshold
+        self.interval = interval or threshold / 2.0
+        self.sample_stacks = sample_stacks
+        self.clock = clock
+        self.timer = timer
+        self.max_lag = 0.0
+        self.slow_paths = Counter()
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = self.timer()
+
+        self.heartbeat = task.LoopingCall(self.tick)
+        self.heartbeat.clock = self.clock
+        self.heartbeat.start(self.interval, now=False)
+
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.monitor, name="txasgiresource-watchdog", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.heartbeat is not None and self.heartbeat.running:
+            self.heartbeat.stop()
+        self.heartbeat = None
+        self.thread = None
+
+    def tick(self):
+        now = self.timer()
+        lag = max(now - self.last_tick - self.interval, 0.0)
+        self.last_tick = now
+        self.max_lag = max(self.max_lag, lag)
+
+        metrics = self.application.metrics
+        if metrics is not None:
+            metrics.observe("txasgi_loop_lag_seconds", lag)
+
+        if lag >= self.threshold:
+            self.report(lag)
+
+    def monitor(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        """
+        Inspects the loop if the heartbeat is late. Called from the monitor thread.
+        """
+        late = self.timer() - self.last_tick - self.interval
+        if self.blocked is None and late >= self.threshold:
+            self.blocked = self.inspect()
+
+    def inspect(self):
+        """
+        Returns the scope path of the running application instance and
+        optionally the stack of the loop thread. Called from the monitor thread.
+        """
+        try:
+            running_task = asyncio.current_task(self.loop)
+        except RuntimeError:
+            running_task = None
+
+        stack = None
+        if self.sample_stacks:
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                stack = "".join(traceback.format_stack(frame))
+
+        return self.get_scope_path(running_task), stack
+
+    def get_scope_path(self, running_task):
+        if running_task is None:
+            return None
+
+        try:
+            instances = list(self.application.application_instances.items())
+        except RuntimeError:  # changed while we were looking
+            return None
+
+        for protocol, instance in instances:
+            if instance is running_task:
+                scope = getattr(protocol, "scope", None) or {"type": "lifespan"}
+                return scope.get("path", scope["type"])
+        return None
+
+    def report(self, lag):
+        blocked, self.blocked = self.blocked, None
+        path, stack = blocked or (None, None)
+        blocked_by = path or "a reactor callback"
+        self.slow_paths[blocked_by] += 1
+
+        logger.warning("Event loop was blocked for %.3fs by %s" % (lag, blocked_by))
+        if stack:
+            logger.warning("Stack of the blocked event loop:\n%s" % (stack,))
+
+        metrics = self.application.metrics
+        if metrics is not None:
+            metrics.increment("txasgi_loop_blocked_total")
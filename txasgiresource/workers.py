@@ -0,0 +1,121 @@
+import logging
+import sys
+
+from twisted.application.service import Service
+from twisted.internet import defer, endpoints, protocol, reactor
+
+logger = logging.getLogger(__name__)
+
+INHERITED_FD = 3
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, supervisor, worker_id):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        self.supervisor.worker_ended(self, reason)
+
+
+class NoAcceptFactory(protocol.Factory):
+    noisy = False
+
+
+class WorkerSupervisor(Service):
+    """
+    Listens on `description` and shares the listening socket with `workers`
+    worker processes that each accept connections on it.
+
+    Workers are started with `worker_args` followed by the inherited file
+    descriptor and its address family and are restarted if they exit
+    while the supervisor is running. They run in process groups of their
+    own, so they are only stopped by the TERM the supervisor sends them.
+
+    Workers adopt the bare socket, so `description` must be a plain tcp one.
+    """
+
+    restart_delay = 1.0
+
+    def __init__(self, description, workers, worker_args):
+        self.description = description
+        self.workers = workers
+        self.worker_args = worker_args
+        self.processes = {}
+        self.restart_calls = {}
+        self.port = None
+
+    @defer.inlineCallbacks
+    def startService(self):
+        Service.startService(self)
+
+        endpoint = endpoints.serverFromString(reactor, self.description)
+        self.port = yield endpoint.listen(NoAcceptFactory())
+        self.port.stopReading()  # only the workers accept connections
+
+        for worker_id in range(self.workers):
+            self.start_worker(worker_id)
+
+    def start_worker(self, worker_id):
+        self.restart_calls.pop(worker_id, None)
+        if not self.running:
+            return
+
+        args = [sys.executable] + self.worker_args
+        args += [
+            "--inherited_fd",
+            str(INHERITED_FD),
+            "--address_family",
+            str(int(self.port.addressFamily)),
+        ]
+
+        process_protocol = WorkerProcessProtocol(self, worker_id)
+        reactor.spawnProcess(
+            process_protocol,
+            sys.executable,
+            args,
+            env=None,
+            childFDs={0: 0, 1: 1, 2: 2, INHERITED_FD: self.port.fileno()},
+        )
+        self.processes[worker_id] = process_protocol
+        logger.info(
+            "Started worker %s with pid %s"
+            % (worker_id, process_protocol.transport.pid)
+        )
+
+    def worker_ended(self, process_protocol, reason):
+        worker_id = process_protocol.worker_id
+        if self.processes.get(worker_id) is process_protocol:
+            del self.processes[worker_id]
+
+        if self.running:
+            logger.warning(
+                "Worker %s ended unexpectedly (%s), restarting in %s seconds"
+                % (worker_id, reason.value, self.restart_delay)
+            )
+            self.restart_calls[worker_id] = reactor.callLater(
+                self.restart_delay, self.start_worker, worker_id
+            )
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        Service.stopService(self)
+
+        for delayed_call in self.restart_calls.values():
+            delayed_call.cancel()
+        self.restart_calls = {}
+
+        wait_for = []
+        for process_protocol in list(self.processes.values()):
+            wait_for.append(process_protocol.ended)
+            try:
+                process_protocol.transport.signalProcess("TERM")
+            except Exception:
+                logger.exception("Failed to signal worker")
+
+        yield defer.DeferredList(wait_for)
+
+        if self.port is not None:
+            yield self.port.stopListening()
@@ -1,45 +1,68 @@
 import logging
 
+from autobahn.twisted.resource import WebSocketResource
 from autobahn.twisted.websocket import (
     ConnectionDeny,
     WebSocketServerFactory,
     WebSocketServerProtocol,
 )
+from autobahn.websocket.compress import (
+    PerMessageDeflateOffer,
+    PerMessageDeflateOfferAccept,
+)
+
+from zope.interface import implementer
+
+from twisted.internet import defer, interfaces, reactor
 
-from twisted.internet import defer
-from twisted.protocols import policies
+from .admission import AdmissionRejected
+from .groups import DEFAULT_MAX_BUFFER_SIZE, GroupManager
+from .metrics import WEBSOCKET_LABELS
+from .timeouts import get_wheel
+from .utils import ReplyQueue
 
 logger = logging.getLogger(__name__)
 
 
-class ASGIWebSocketServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
+@implementer(interfaces.IPushProducer)
+class ASGIWebSocketServerProtocol(WebSocketServerProtocol):
     accepted = False
     opened = False
     accept_promise = None
     queue = None
+    clock = reactor
+    scope = None
+    group_names = None
+    idle_timer = None
+    producing = True
+    paused_backlog = 0  # bytes broadcast to the connection while it was paused
 
-    def _onConnect(self, request):
-        scope = dict(self.factory.base_scope)
-        scope["type"] = "websocket"
-        scope["scheme"] = "ws%s" % (scope.pop("_ssl"))
-
-        subprotocols = []
-        for name, value in scope.get("headers", []):
-            if name == b"sec-websocket-protocol":
-                subprotocols += [
-                    x.strip() + " " for x in value.decode("ascii").split(",")
-                ]
-
-        scope["subprotocols"] = subprotocols
+    def connectionMade(self):
+        WebSocketServerProtocol.connectionMade(self)
+        # replaces the HTTP channel the connection was upgraded from, so
+        # broadcasts can tell when the transport is full
+        try:
+            self.transport.unregisterProducer()
+        except RuntimeError:  # there was none
+            pass
+        self.transport.registerProducer(self, True)
 
+    def _onConnect(self, request):
         try:
             self.queue = self.factory.application.create_application_instance(
-                self, scope
+                self, self.scope
             )
             self.opened = True
+        except AdmissionRejected:
+            logger.debug("WebSocket refused, no room in its admission budget")
+            self.accept_promise.errback(
+                ConnectionDeny(code=503, reason="Service Unavailable")
+            )
+            self.dropConnection(abort=True)
+            return
         except Exception:
             logger.exception("Failed to create application")
-            self.reply_defer.callback({"type": "websocket.close"})
+            self.replies.put({"type": "websocket.close"})
         else:
             self.queue.put_nowait({"type": "websocket.connect"})
 
@@ -47,9 +70,12 @@ class ASGIWebSocketServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin
 
     def onConnect(self, request):
         self.request = request
-        self.setTimeout(self.factory.idle_timeout)
+        if self.factory.idle_timeout is not None:
+            self.idle_timer = get_wheel(self.clock).schedule(
+                self.factory.idle_timeout, self.timeoutConnection
+            )
         self.accept_promise = defer.Deferred()
-        self.reply_defer = defer.Deferred()
+        self.replies = ReplyQueue(self.clock)
 
         self._onConnect(request)
 
@@ -59,7 +85,7 @@ class ASGIWebSocketServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin
     def send_replies(self):
         while True:
             try:
-                reply = yield self.reply_defer
+                replies = yield self.replies.get()
             except defer.TimeoutError:
                 logger.debug("We hit a timeout")
                 self.dropConnection(abort=True)
@@ -68,36 +94,66 @@ class ASGIWebSocketServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin
                 self.dropConnection(abort=True)
                 return
 
-            if not self.accepted:
-                if reply["type"] == "websocket.accept":
-                    logger.debug("Accepting websocket connection")
-                    self.accepted = True
-                    self.accept_promise.callback(reply.get("subprotocol"))
-                elif reply["type"] == "websocket.close":
-                    self.accept_promise.errback(
-                        ConnectionDeny(code=403, reason="Denied")
-                    )
-                    self.dropConnection(abort=True)
-                    return
-                else:
-                    continue
+            metrics = self.factory.application.metrics
+            for reply in replies:
+                if not self.accepted:
+                    if reply["type"] == "websocket.accept":
+                        logger.debug("Accepting websocket connection")
+                        self.accepted = True
+                        self.accept_promise.callback(reply.get("subprotocol"))
+                    elif reply["type"] == "websocket.close":
+                        self.accept_promise.errback(
+                            ConnectionDeny(code=403, reason="Denied")
+                        )
+                        self.dropConnection(abort=True)
+                        return
+                    else:
+                        continue
+
+                if reply["type"] == "websocket.send":
+                    sent = 0
+                    if reply.get("binary") is not None:
+                        self.sendMessage(reply["binary"], True)
+                        sent += len(reply["binary"])
 
-            if reply["type"] == "websocket.send":
-                if reply.get("binary") is not None:
-                    self.sendMessage(reply["binary"], True)
+                    if reply.get("text") is not None:
+                        payload = reply["text"].encode("utf8")
+                        self.sendMessage(payload, False)
+                        sent += len(payload)
 
-                if reply.get("text") is not None:
-                    self.sendMessage(reply["text"].encode("utf8"), False)
-            elif reply["type"] == "websocket.close":
-                self.sendClose(reply.get("code", 1000))
+                    if metrics is not None:
+                        metrics.increment(
+                            "txasgi_bytes_sent_total", sent, WEBSOCKET_LABELS
+                        )
+                elif reply["type"] == "websocket.close":
+                    self.sendClose(reply.get("code", 1000))
+                elif reply["type"] == "websocket.group.add":
+                    self.factory.groups.add(reply["group"], self)
+                elif reply["type"] == "websocket.group.discard":
+                    self.factory.groups.discard(reply["group"], self)
+                elif reply["type"] == "websocket.broadcast":
+                    self.factory.groups.broadcast(
+                        reply["group"],
+                        text=reply.get("text"),
+                        bytes=reply.get("bytes"),
+                        exclude=self if reply.get("exclude_self") else None,
+                    )
 
-            self.resetTimeout()
+            if self.idle_timer is not None:
+                self.idle_timer.touch()
 
     def onMessage(self, payload, isBinary):
         if not self.accepted:
             defer.returnValue(None)
 
-        self.resetTimeout()
+        if self.idle_timer is not None:
+            self.idle_timer.touch()
+
+        metrics = self.factory.application.metrics
+        if metrics is not None:
+            metrics.increment(
+                "txasgi_bytes_received_total", len(payload), WEBSOCKET_LABELS
+            )
 
         if isBinary:
             self.queue.put_nowait({"type": "websocket.receive", "bytes": payload})
@@ -106,6 +162,10 @@ class ASGIWebSocketServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin
                 {"type": "websocket.receive", "text": payload.decode("utf8")}
             )
 
+        if self.queue.is_full():
+            logger.debug("Application queue is full, pausing transport")
+            self.queue.pause_producer(self.transport)
+
     def onClose(self, wasClean, code, reason):
         if self.opened:
             logger.info("Called onClose")
@@ -115,25 +175,113 @@ class ASGIWebSocketServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin
         self.do_cleanup()
 
     def timeoutConnection(self):
-        logger.debug("Timeout from mixin")
-        self.reply_defer.errback(defer.TimeoutError())
+        logger.debug("Idle timeout")
+        self.idle_timer = None
+        self.replies.fail(defer.TimeoutError())
 
     def handle_reply(self, msg):
-        d = self.reply_defer
-        self.reply_defer = defer.Deferred()
-        d.callback(msg)
+        self.replies.put(msg)
+
+    def pauseProducing(self):
+        self.producing = False
+
+    def resumeProducing(self):
+        self.producing = True
+        self.paused_backlog = 0
+
+    def stopProducing(self):
+        self.resumeProducing()
+
+    def close_connection(self, code):
+        """
+        Closes the connection from the server side, e.g. when draining.
+        """
+        if self.accepted:
+            # sendClose only allows 1000 and application codes, 1012 etc. are valid too
+            self.sendCloseFrame(code=code, isReply=False)
+        else:
+            self.dropConnection(abort=True)
 
     def do_cleanup(self):
-        self.setTimeout(None)
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        if self.group_names:
+            self.factory.groups.remove_protocol(self)
         return self.factory.application.finish_protocol(self)
 
 
+class DeflateAccept:
+    """
+    Accepts the permessage-deflate offer of a client.
+
+    window_bits (9-15) is the window used to compress messages sent by us,
+    client_window_bits is requested from clients that support it. With
+    no_context_takeover the compressor is reset after every message.
+    Smaller windows and no context takeover use less memory per connection
+    but compress repetitive messages less.
+    """
+
+    def __init__(
+        self, window_bits=15, client_window_bits=15, no_context_takeover=False
+    ):
+        self.window_bits = window_bits
+        self.client_window_bits = client_window_bits
+        self.no_context_takeover = no_context_takeover
+
+    def __call__(self, offers):
+        for offer in offers:
+            if not isinstance(offer, PerMessageDeflateOffer):
+                continue
+
+            window_bits = self.window_bits
+            if offer.request_max_window_bits:
+                window_bits = min(window_bits, offer.request_max_window_bits)
+
+            request_max_window_bits = 0
+            if self.client_window_bits < 15 and offer.accept_max_window_bits:
+                request_max_window_bits = self.client_window_bits
+
+            return PerMessageDeflateOfferAccept(
+                offer,
+                request_max_window_bits=request_max_window_bits,
+                no_context_takeover=(
+                    self.no_context_takeover or offer.request_no_context_takeover
+                ),
+                window_bits=window_bits,
+            )
+        return None
+
+
 class ASGIWebSocketServerFactory(WebSocketServerFactory):
     protocol = ASGIWebSocketServerProtocol
+    pending_scope = None
 
     def __init__(self, *args, **kwargs):
         self.application = kwargs.pop("application")
-        self.base_scope = kwargs.pop("base_scope")
         self.idle_timeout = kwargs.pop("idle_timeout")
+        self.groups = GroupManager(
+            self, kwargs.pop("broadcast_max_buffer_size", DEFAULT_MAX_BUFFER_SIZE)
+        )
 
         WebSocketServerFactory.__init__(self, *args, **kwargs)
+
+    def buildProtocol(self, addr):
+        protocol = WebSocketServerFactory.buildProtocol(self, addr)
+        protocol.scope = self.pending_scope
+        return protocol
+
+
+class ASGIWebSocketResource(WebSocketResource):
+    """
+    WebSocketResource where one long-lived factory is shared by all connections,
+    the scope of each connection is handed to its protocol.
+    """
+
+    def render_with_scope(self, request, scope):
+        # the protocol is built synchronously inside render
+        self._factory.pending_scope = scope
+        try:
+            return self.render(request)
+        finally:
+            self._factory.pending_scope = None